@@ -8,18 +8,28 @@ python TrieDedup.py --input input_seq_file -v >uniq_readIDs.txt
 seqtk subseq input_seq_file uniq_readIDs.txt >uniq_seq_file
 
 The format of input_seq_file will be automatically determined by the filename extension
-Allowed extensions include: .fasta .fa .fastq .fq
+Allowed extensions include: .fasta .fa .fastq .fq, optionally followed by .gz (gzip or bgzip compressed)
 """
 
 import sys
 import os
+import json
 import argparse
 import timeit
-import pandas as pd
+from array import array
 import lib.pairwise
 import lib.trie
+import lib.seqReader
+import lib.seqWriter
+import lib.outOfCore
+import lib.sharding
+import lib.groups
+import lib.trieIndex
+from lib.metrics import DedupMetrics, SearchStats
 from lib.restrictedDict import restrictedListDict
 
+TRIE_ENGINES = {'trie': 'node', 'flattrie': 'flat', 'bitset': 'bitset'}   # --function -> engine of lib.trie.collapseSeq
+
 
 def parseArg():
     parser = argparse.ArgumentParser(add_help=True, epilog='''
@@ -29,25 +39,55 @@ If --output_format is set to uniq2dup, I will output to STDOUT 5-column tsv form
     parser.add_argument('--verbose', '-v', default=False, action='store_true',
                         help='Print extra information to the error stream')
     parser.add_argument('--input', '-i', dest='input', type=str, required=True,
-                        help='The path to the input file; can either be a fasta or a fastq file')
+                        help='The path to the input file; can either be a fasta or a fastq file, optionally compressed by gzip or bgzip')
+    parser.add_argument('--load_index', default=None, type=str,
+                        help='The path to an index saved by --save_index; reads that match its unique reads are reported as their duplicates, and the rest are deduplicated as usual')
+    parser.add_argument('--save_index', default=None, type=str,
+                        help='Save the unique reads (and those of --load_index, if given) with their readIDs to an index file, to deduplicate later samples against')
     parser.add_argument('--symbols', '-s', dest='symbols', default='ACGTN', type=str,
                         help='A string of expected characters in the input file; default is ACGTN.')
     parser.add_argument('--ambiguous', '-m', dest='ambiguous', default='N', type=str,
                         help='A string of characters that represent ambiguous bases; default is N; there can be more than one')
     parser.add_argument('--function', '-f', default='trie', type=str,
-                        help='Use which function to deduplicate? [sortuniq, trie, pairwise]')
+                        help='Use which function to deduplicate? [sortuniq, trie, flattrie, bitset, pairwise, pairwise_numpy]')
     parser.add_argument('--max_missing', '-N', dest='N', default=500, type=int,
                         help='The maxinum number of ambiguous characters allowed in a single read, for it to be considered')
+    parser.add_argument('--segments', default=0, type=int,
+                        help='For function pairwise, split reads into this number of segments, and only compare reads sharing a segment without N; the results are the same; default is 0 (compare all)')
     parser.add_argument('--sorted', default=False, action="store_true",
-                        help='Use this option if the input file has been sorted by the number of Ns in each read')
+                        help='Use this option if the input file has been sorted by the number of Ns in each read, to skip bucketing reads by the number of Ns')
     parser.add_argument('--output_format', '-o', default='readID', type=str,
-                        help='Output format of STDOUT; default is readID [readID, sequence, fasta, dup2uniq, uniq2dup]')
+                        help='Output format of STDOUT; default is readID [readID, sequence, fasta, fastq, dup2uniq, uniq2dup, groups]; fastq only for fastq input; groups files of several inputs can be merged by mergeGroups.py')
+    parser.add_argument('--output', default=None, type=str,
+                        help='The path to the output file instead of STDOUT; compressed by gzip if it ends with .gz')
+    parser.add_argument('--metrics', default=None, type=str,
+                        help='Write the duration, number of reads and throughput of each phase, and the read counts, to this JSON file')
+    parser.add_argument('--search_stats', default=None, type=str,
+                        help='Write the cost of the trie search of each read (nodes visited, wildcard branches, backtracks, max depth), aggregated by the number of Ns, with the readIDs of the worst reads, to this JSON file; with --max_visits, the visits of the reads over budget stop at max_visits + 1, and the unique reads compared by their linear scan are counted in fallback_scanned; only for trie, flattrie and bitset functions')
+    parser.add_argument('--max_visits', default=None, type=int,
+                        help='The budget of node visits of each trie search; the reads over budget are searched by a linear scan of the unique reads instead, with the same result, and reported; default is no budget; only for trie and flattrie functions (the search of bitset has no node visits to budget, and its cost does not grow with the Ns)')
+    parser.add_argument('--fallback_report', default=None, type=str,
+                        help='Write the readID and sequence of each read over --max_visits to this tsv file')
+    parser.add_argument('--num_workers', '-p', default=1, type=int,
+                        help='Number of processes to search the trie in, each tier of reads with the same number of Ns at a time; the result is the same as with 1; default is 1; only for trie, flattrie and bitset functions, and not with --tmp_dir, --search_stats and --max_visits; flattrie is the cheapest to share between processes')
+    parser.add_argument('--shards', default=0, type=int,
+                        help='Partition the reads into this number of shards by the bases of an anchor region, and deduplicate the shards in --num_workers processes; the reads with Ns in the anchor are resolved afterwards with the shards they can match; the unique reads are the same as without shards; default is 0 for no sharding; only for trie, flattrie and bitset functions, and not with --tmp_dir, --search_stats and --max_visits')
+    parser.add_argument('--anchor_start', default=0, type=int,
+                        help='The start (0-based) of the anchor region of --shards; should be in a region with few Ns; default is 0')
+    parser.add_argument('--anchor_length', default=8, type=int,
+                        help='The length of the anchor region of --shards; default is 8')
+    parser.add_argument('--tmp_dir', default=None, type=str,
+                        help='Use out-of-core mode for inputs larger than memory, spilling reads to temporary files in this directory; only for trie, flattrie and bitset functions, and readID, sequence, fasta, fastq output formats')
+    parser.add_argument('--tmp_partitions', default=16, type=int,
+                        help='Number of hash partitions of the reads with the same number of Ns in --tmp_dir; default is 16')
+    parser.add_argument('--tmp_partition_size', default=128, type=int,
+                        help='The max size in MB of a partition in --tmp_dir; larger partitions are split, so that exact dedup holds at most this size of reads (about 3 times as much memory) at a time whatever the input size; default is 128')
     args = parser.parse_args().__dict__
     return args
 
 
 def check_seqFile_type(input_path):
-    split_tup = os.path.splitext(input_path)
+    split_tup = os.path.splitext(lib.seqReader.stripCompressedExtension(input_path))
     file_extension = split_tup[1]
     if file_extension == ".fastq" or file_extension == ".fq":
         return "fastq"
@@ -62,59 +102,27 @@ def check_seqFile_type(input_path):
 def read_fasta(input_path):
     names_vec = []
     seqs_vec = []
-    now_name = ''
-    now_seq = ''
-    with open(input_path, 'r') as infile:
-        for line in infile:
-            line = line.rstrip()
-            if line[0] == '>':
-                if now_name != '':
-                    names_vec.append(now_name.split(" ")[0])
-                    seqs_vec.append(now_seq)
-                now_name = line[1:]
-                now_seq = ''
-            else:
-                now_seq += line
-        if now_name != '':
-            names_vec.append(now_name.split(" ")[0])
-            seqs_vec.append(now_seq)
+    for names, seqs in lib.seqReader.readFastaBatches(input_path):
+        names_vec.extend(names)
+        seqs_vec.extend(seqs)
     return names_vec, seqs_vec
 
 
 def read_fastq(input_path):
     names_vec = []
     seqs_vec = []
-    now_name = ''
-    with open(input_path, 'r') as infile:
-        NR = 0
-        for line in infile:
-            NR += 1
-            line = line.rstrip()
-            if NR % 4 == 1:
-                now_name = ''
-                if line[0] == '@':
-                    now_name = line[1:]
-                elif len(line) > 0:
-                    print(f'Warning: {NR}-th line does not start with @, invalid fastq format', file=sys.stderr)
-            elif NR % 4 == 2:
-                if now_name != '':
-                    names_vec.append(now_name.split(" ")[0])
-                    seqs_vec.append(line)
+    for names, seqs in lib.seqReader.readFastqBatches(input_path):
+        names_vec.extend(names)
+        seqs_vec.extend(seqs)
     return names_vec, seqs_vec
 
 
 def read_text(input_path):
     names_vec = []
     seqs_vec = []
-    with open(input_path, 'r') as infile:
-        NR = 0
-        for line in infile:
-            NR += 1
-            line = line.rstrip()
-            if NR == 1 and line == 'seq':  # skip headline of colname 'seq'
-                continue
-            names_vec.append(str(NR))
-            seqs_vec.append(line)
+    for names, seqs in lib.seqReader.readTextBatches(input_path):
+        names_vec.extend(names)
+        seqs_vec.extend(seqs)
     return names_vec, seqs_vec
 
 
@@ -122,38 +130,246 @@ def read_input(input_reads, param_dict):
     """
     :param input_reads: path to the input sequencing file
     :param param_dict: param_dict
-    :return: a pd.DataFrame sorted by number of Ns, containing 3 columns ['name', 'query', 'num_N']
+    :return: 4 columns (names_vec, seqs_vec, num_N_vec, quals_vec) sorted by number of ambiguous characters; num_N_vec is an array('i');
+             quals_vec is None unless the output format is fastq
     """
     input_type = check_seqFile_type(input_reads)
-    # build pd.df of input
-    names_ls = []
-    query_ls = []
-    if input_type == 'fasta':
-        names_ls, query_ls = read_fasta(input_reads)
-    elif input_type == 'fastq':
-        names_ls, query_ls = read_fastq(input_reads)
-    elif input_type == 'text':
-        names_ls, query_ls = read_text(input_reads)
-    #    SeqIO_parser = SeqIO.parse(open(input_reads), input_type)
-    #    for read in SeqIO_parser:
-    #        name, query = read.id, str(read.seq)
-    #        names_ls.append(name)
-    #        query_ls.append(query)
-    input_df = pd.DataFrame({'name': names_ls, 'query': query_ls})
-    input_df["num_N"] = [seq.count('N') for seq in input_df['query']]
-    if not param_dict['sorted']:
-        input_df_sort = input_df.sort_values(by=['num_N'])
-        input_df_sort = input_df_sort.reset_index(drop=True)
+    ambiguous_symbols = param_dict['ambiguous']
+    should_keep_quals = param_dict['output_format'] == 'fastq'
+    # build the columns of input, consuming the input file batch by batch; num_N is counted once per read
+    names_vec = []
+    seqs_vec = []
+    num_N_vec = array('i')
+    quals_vec = [] if should_keep_quals else None
+    tier2names = dict()   # counting sort by num_N: names and seqs (and qualities) of each num_N, in the order of input
+    tier2seqs = dict()
+    tier2quals = dict()
+    for batch in lib.seqReader.readSeqBatches(input_reads, input_type, should_keep_quals=should_keep_quals):
+        names, seqs = batch[0], batch[1]
+        num_Ns = [seq.count(ambiguous_symbols[0]) for seq in seqs]
+        for ch in ambiguous_symbols[1:]:
+            num_Ns = [num_N + seq.count(ch) for num_N, seq in zip(num_Ns, seqs)]
+        if param_dict['sorted']:
+            names_vec.extend(names)
+            seqs_vec.extend(seqs)
+            num_N_vec.extend(num_Ns)
+            if should_keep_quals:
+                quals_vec.extend(batch[2])
+            continue
+        for i, (num_N, name, seq) in enumerate(zip(num_Ns, names, seqs)):
+            if num_N in tier2seqs:
+                tier2names[num_N].append(name)
+                tier2seqs[num_N].append(seq)
+            else:
+                tier2names[num_N] = [name]
+                tier2seqs[num_N] = [seq]
+                tier2quals[num_N] = []
+            if should_keep_quals:
+                tier2quals[num_N].append(batch[2][i])
+    for num_N in sorted(tier2seqs):   # concatenate the tiers in order of num_N
+        names_vec.extend(tier2names[num_N])
+        seqs_vec.extend(tier2seqs[num_N])
+        num_N_vec.extend(array('i', [num_N]) * len(tier2seqs[num_N]))
+        if should_keep_quals:
+            quals_vec.extend(tier2quals[num_N])
     if param_dict['verbose']:
-        input_row_col = input_df_sort.shape
         print(f"[LOG] Reading in {input_reads}", file=sys.stderr)
-        print(f"[LOG] Number of raw reads = {input_row_col[0]}", file=sys.stderr)
+        print(f"[LOG] Number of raw reads = {len(seqs_vec)}", file=sys.stderr)
     if param_dict['N'] is not None:
-        input_df_sort = input_df_sort[input_df_sort["num_N"] <= param_dict['N']]
-        input_row_col = input_df_sort.shape
-        print(f"[LOG] Number of raw reads that have {param_dict['N']} N or less = {input_row_col[0]}", file=sys.stderr)
-    return input_df_sort
-    # return input_df
+        kept = [i for i, num_N in enumerate(num_N_vec) if num_N <= param_dict['N']]
+        if len(kept) < len(seqs_vec):
+            names_vec = [names_vec[i] for i in kept]
+            seqs_vec = [seqs_vec[i] for i in kept]
+            num_N_vec = array('i', [num_N_vec[i] for i in kept])
+            if should_keep_quals:
+                quals_vec = [quals_vec[i] for i in kept]
+        print(f"[LOG] Number of raw reads that have {param_dict['N']} N or less = {len(seqs_vec)}", file=sys.stderr)
+    return names_vec, seqs_vec, num_N_vec, quals_vec
+
+
+def convert_ambiguous(seq, ambiguous_symbols):
+    """
+    Convert all ambiguous symbols to ambiguous_symbols[0], as lib.trie.collapseSeq does
+    """
+    for ch in ambiguous_symbols[1:]:
+        seq = seq.replace(ch, ambiguous_symbols[0])
+    return seq
+
+
+def match_index(index, seqs_vec, ambiguous_symbols, should_traceback):
+    """
+    Search each read in a loaded index of unique reads
+    :return: idx2value: maps each matched read to the value of its unique read in the index, i.e. the index of its readID;
+             value2seq: the sequence of each matched unique read in the index (empty if not should_traceback)
+    """
+    idx2value = dict()
+    value2seq = dict()
+    seq2value = dict()   # each exactly unique read is searched only once
+    for idx, seq in enumerate(seqs_vec):
+        if seq not in seq2value:
+            query = convert_ambiguous(seq, ambiguous_symbols)
+            if should_traceback:
+                matched_seq = index.search_with_traceback(query)
+                seq2value[seq] = None if matched_seq is None else index.get(matched_seq)
+                if matched_seq is not None:
+                    value2seq[seq2value[seq]] = matched_seq
+            else:
+                seq2value[seq] = index.search_value(query)
+        if seq2value[seq] is not None:
+            idx2value[idx] = seq2value[seq]
+    return idx2value, value2seq
+
+
+def save_index(index_path, index, index_names, uniq_seqs, uniq_names, param_dict):
+    """
+    Add the unique reads to the index (a copy loaded by --load_index, or a new one), and save it to index_path
+    """
+    if index is None:
+        index = lib.trie.FlatTrie(allowed_symbols=param_dict['symbols'], ambiguous_symbol=param_dict['ambiguous'][0])
+    names = list(index_names)
+    for seq, readID in zip(uniq_seqs, uniq_names):
+        index.add(convert_ambiguous(seq, param_dict['ambiguous']), len(names))
+        names.append(readID)
+    lib.trieIndex.saveIndex(index_path, index, names)
+    if param_dict['verbose']:
+        print(f'[NOTE] Saved {len(index)} unique reads to the index {index_path}', file=sys.stderr)
+
+
+def dedup_out_of_core(param_dict):
+    """
+    Deduplicate with lib.outOfCore without holding the input reads in memory, then output the unique reads
+    by reading the input file again; the output is in the order of the input file
+    """
+    input_reads = param_dict['input']
+    function = param_dict['function']
+    output_format = param_dict['output_format']
+    if function not in TRIE_ENGINES:
+        raise ValueError(f"[ERROR]: --tmp_dir only supports function trie, flattrie and bitset, not {function}")
+    if output_format not in ('readID', 'sequence', 'fasta', 'fastq'):
+        raise ValueError(f"[ERROR]: --tmp_dir only supports output_format readID, sequence, fasta and fastq, not {output_format}")
+    if param_dict['load_index'] is not None or param_dict['save_index'] is not None:
+        raise ValueError("[ERROR]: --tmp_dir does not support --load_index and --save_index")
+    if param_dict['num_workers'] > 1 or param_dict['shards'] > 0:
+        raise ValueError("[ERROR]: --tmp_dir does not support --num_workers and --shards")
+    if param_dict['tmp_partitions'] < 1 or param_dict['tmp_partition_size'] < 1:
+        raise ValueError("[ERROR]: --tmp_partitions and --tmp_partition_size should be at least 1")
+    input_type = check_seqFile_type(input_reads)
+    check_output_format(output_format, input_type)
+    if param_dict['verbose']:
+        print(f"[LOG] Reading in {input_reads}", file=sys.stderr)
+        print(f'[NOTE] Start deduplicating using {function} algorithm out of core in {param_dict["tmp_dir"]}', file=sys.stderr)
+    metrics = DedupMetrics() if param_dict['metrics'] is not None else None
+    search_stats = new_search_stats(param_dict)
+    fallback_idxes = new_fallback_idxes(param_dict)
+    seqs = lib.seqReader.iterSeqs(lib.seqReader.readSeqBatches(input_reads, input_type))
+    ans_list = lib.outOfCore.collapseSeqOutOfCore(seqs, tmp_dir=param_dict['tmp_dir'], allowed_symbols=param_dict['symbols'],
+                                                  ambiguous_symbols=param_dict['ambiguous'], max_missing=param_dict['N'],
+                                                  engine=TRIE_ENGINES[function], metrics=metrics, search_stats=search_stats,
+                                                  max_visits=param_dict['max_visits'], fallback_idxes=fallback_idxes,
+                                                  num_partitions=param_dict['tmp_partitions'],
+                                                  partition_size=param_dict['tmp_partition_size'] << 20)
+    uniqIdx_vec, time_spent = ans_list
+    is_uniq_vec = bytearray(max(uniqIdx_vec, default=-1) + 1)
+    for idx in uniqIdx_vec:
+        is_uniq_vec[idx] = 1
+    worst_names = dict()   # the readIDs of the worst reads of search_stats, found while reading the input again
+    if search_stats is not None:
+        worst_names = {idx: None for visits, idx, num_N in search_stats.worst()}
+    fallback_reads = dict()   # the (readID, sequence) of the reads over --max_visits, also found while reading the input again
+    if fallback_idxes is not None:
+        fallback_reads = {idx: None for idx in fallback_idxes}
+    should_keep_quals = output_format == 'fastq'
+    idx = 0
+    with lib.seqWriter.SeqWriter(param_dict['output']) as writer:
+        for batch in lib.seqReader.readSeqBatches(input_reads, input_type, should_keep_quals=should_keep_quals):
+            names, seqs = batch[0], batch[1]
+            for i, (readID, seq) in enumerate(zip(names, seqs)):
+                if idx in worst_names:
+                    worst_names[idx] = readID
+                if idx in fallback_reads:
+                    fallback_reads[idx] = (readID, seq)
+                if idx < len(is_uniq_vec) and is_uniq_vec[idx]:
+                    writer.write_record(output_format, readID, seq, batch[2][i] if should_keep_quals else None)
+                idx += 1
+    if fallback_idxes is not None:
+        report_fallbacks([fallback_reads[idx] for idx in fallback_idxes], param_dict, metrics)
+    if metrics is not None:
+        metrics.mark('write_output', idx)
+        write_metrics(metrics, param_dict, len(uniqIdx_vec))
+    if search_stats is not None:
+        write_search_stats(search_stats, param_dict, worst_names)
+    if param_dict['verbose']:
+        print(f'[NOTE] Deduplicating resulted in {len(uniqIdx_vec)} unique reads. Time spent: {time_spent} s', file=sys.stderr)
+
+
+def check_output_format(output_format, input_type):
+    """
+    Check that output_format is known, and that fastq output has a fastq input to take the qualities from
+    """
+    if output_format not in ('readID', 'sequence', 'fasta', 'fastq', 'dup2uniq', 'uniq2dup', 'groups'):
+        raise ValueError(f'[ERROR]: Unknown output_format {output_format}; should be one of [readID, sequence, fasta, fastq, dup2uniq, uniq2dup, groups]')
+    if output_format == 'fastq' and input_type != 'fastq':
+        raise ValueError(f'[ERROR]: output_format fastq requires a fastq input, not {input_type}')
+
+
+def new_search_stats(param_dict):
+    """
+    Return a SearchStats if --search_stats is given, otherwise None
+    """
+    if param_dict['search_stats'] is None:
+        return None
+    if param_dict['function'] not in TRIE_ENGINES:
+        raise ValueError(f"[ERROR]: --search_stats only supports function trie, flattrie and bitset, not {param_dict['function']}")
+    return SearchStats()
+
+
+def new_fallback_idxes(param_dict):
+    """
+    Return a list to collect the indexes of the reads over --max_visits if it is given, otherwise None
+    """
+    if param_dict['max_visits'] is None:
+        if param_dict['fallback_report'] is not None:
+            raise ValueError("[ERROR]: --fallback_report requires --max_visits")
+        return None
+    if param_dict['function'] not in TRIE_ENGINES or param_dict['function'] == 'bitset':
+        raise ValueError(f"[ERROR]: --max_visits only supports function trie and flattrie, not {param_dict['function']}")
+    return []
+
+
+def report_fallbacks(fallback_reads, param_dict, metrics=None):
+    """
+    Report the (readID, sequence) of the reads over --max_visits: their number to STDERR and the metrics,
+    and the reads to the --fallback_report tsv file if given
+    """
+    if len(fallback_reads) > 0:
+        print(f'[NOTE] {len(fallback_reads)} reads exceeded --max_visits {param_dict["max_visits"]} and were searched by a linear scan', file=sys.stderr)
+    if metrics is not None:
+        metrics.count('num_fallbacks', len(fallback_reads))
+    if param_dict['fallback_report'] is not None:
+        with open(param_dict['fallback_report'], 'w') as outfile:
+            for readID, seq in fallback_reads:
+                print(f'{readID}\t{seq}', file=outfile)
+
+
+def write_search_stats(search_stats, param_dict, names):
+    """
+    Write the search stats to the --search_stats JSON file; names maps the index of each read to its readID
+    """
+    output = {'input': param_dict['input'], 'function': param_dict['function']}
+    output.update(search_stats.asDict(names))
+    with open(param_dict['search_stats'], 'w') as outfile:
+        json.dump(output, outfile, indent=1)
+        outfile.write('\n')
+
+
+def write_metrics(metrics, param_dict, num_dedup):
+    """
+    Write the metrics of this run to the --metrics JSON file, with the input and the parameters
+    """
+    metrics.count('num_output', num_dedup)
+    metrics.writeJson(param_dict['metrics'], input=param_dict['input'], function=param_dict['function'],
+                      max_missing=param_dict['N'], output_format=param_dict['output_format'],
+                      out_of_core=param_dict['tmp_dir'] is not None)
 
 
 def main():
@@ -163,72 +379,138 @@ def main():
     """
     # read in arguments
     param_dict = parseArg()
+    if param_dict['tmp_dir'] is not None:
+        dedup_out_of_core(param_dict)
+        return
+    metrics = DedupMetrics() if param_dict['metrics'] is not None else None
+    search_stats = new_search_stats(param_dict)
+    fallback_idxes = new_fallback_idxes(param_dict)
+    if param_dict['num_workers'] > 1 or param_dict['shards'] > 0:
+        if param_dict['function'] not in TRIE_ENGINES:
+            raise ValueError(f"[ERROR]: --num_workers and --shards only support function trie, flattrie and bitset, not {param_dict['function']}")
+        if search_stats is not None or fallback_idxes is not None:
+            raise ValueError("[ERROR]: --num_workers and --shards do not support --search_stats and --max_visits")
     # read in input
     input_reads = param_dict['input']
-    input_df_sort = read_input(input_reads, param_dict)
+    check_output_format(param_dict['output_format'], check_seqFile_type(input_reads))
+    names_vec, seqs_vec, num_N_vec, quals_vec = read_input(input_reads, param_dict)
+    if metrics is not None:
+        metrics.mark('read_input', len(seqs_vec))
     # start timer
     function = param_dict['function']
     output_format = param_dict['output_format']
-    should_traceback = output_format == 'dup2uniq' or output_format == 'uniq2dup'
+    should_traceback = output_format == 'dup2uniq' or output_format == 'uniq2dup' or output_format == 'groups'
+    if output_format == 'groups' and param_dict['load_index'] is not None:
+        raise ValueError("[ERROR]: --load_index does not support output_format groups")
+    # match against the index of previous unique reads, and deduplicate only the rest
+    index = None
+    index_names = []
+    if param_dict['load_index'] is not None:
+        start_time = timeit.default_timer()
+        index, index_names = lib.trieIndex.loadIndex(param_dict['load_index'], copy=param_dict['save_index'] is not None)
+        idx2value, value2seq = match_index(index, seqs_vec, param_dict['ambiguous'], should_traceback)
+        index_time_spent = timeit.default_timer() - start_time
+        if param_dict['verbose']:
+            print(f'[NOTE] {len(idx2value)} reads are duplicates of the {len(index)} unique reads in the index {param_dict["load_index"]}', file=sys.stderr)
+        all_names_vec, all_seqs_vec = names_vec, seqs_vec   # quals_vec is kept as is, for all reads
+        kept = [idx for idx in range(len(seqs_vec)) if idx not in idx2value]
+        names_vec = [all_names_vec[idx] for idx in kept]
+        seqs_vec = [all_seqs_vec[idx] for idx in kept]
+        num_N_vec = array('i', [num_N_vec[idx] for idx in kept])
+        if metrics is not None:
+            metrics.mark('match_index', len(all_seqs_vec))
+            metrics.count('num_index_duplicates', len(idx2value))
     if param_dict['verbose']:
         print(f'[NOTE] Start deduplicating using {function} algorithm', file=sys.stderr)
     # start deduplication
     if function == 'sortuniq':
-        ans_list = lib.trie.collapseSeq(input_df_sort['query'], allowed_symbols=param_dict['symbols'],
+        ans_list = lib.trie.collapseSeq(seqs_vec, allowed_symbols=param_dict['symbols'],
                                         ambiguous_symbols=param_dict['ambiguous'], is_input_sorted=param_dict['sorted'],
-                                        max_missing=param_dict['N'], should_just_uniq_sort=True, should_traceback=should_traceback)
-    elif function == 'trie':
-        ans_list = lib.trie.collapseSeq(input_df_sort['query'], allowed_symbols=param_dict['symbols'],
+                                        max_missing=param_dict['N'], should_just_uniq_sort=True, should_traceback=should_traceback,
+                                        num_N_vec=num_N_vec, metrics=metrics)
+    elif function in TRIE_ENGINES and param_dict['shards'] > 0:
+        ans_list = lib.sharding.collapseSeqSharded(seqs_vec, allowed_symbols=param_dict['symbols'],
+                                                   ambiguous_symbols=param_dict['ambiguous'], max_missing=param_dict['N'],
+                                                   should_traceback=should_traceback, engine=TRIE_ENGINES[function],
+                                                   num_shards=param_dict['shards'], num_workers=param_dict['num_workers'],
+                                                   anchor_start=param_dict['anchor_start'],
+                                                   anchor_length=param_dict['anchor_length'], metrics=metrics)
+    elif function in TRIE_ENGINES:   # trie, flattrie, bitset
+        ans_list = lib.trie.collapseSeq(seqs_vec, allowed_symbols=param_dict['symbols'],
                                         ambiguous_symbols=param_dict['ambiguous'], is_input_sorted=param_dict['sorted'],
-                                        max_missing=param_dict['N'], should_traceback=should_traceback)
+                                        max_missing=param_dict['N'], should_traceback=should_traceback,
+                                        engine=TRIE_ENGINES[function], num_N_vec=num_N_vec, metrics=metrics,
+                                        search_stats=search_stats, max_visits=param_dict['max_visits'],
+                                        fallback_idxes=fallback_idxes, num_workers=param_dict['num_workers'])
     elif function == 'pairwise':
-        ans_list = lib.pairwise.collapseSeq(input_df_sort['query'], max_missing=param_dict['N'], should_traceback=should_traceback)
+        ans_list = lib.pairwise.collapseSeq(seqs_vec, max_missing=param_dict['N'], should_traceback=should_traceback,
+                                            num_segments=param_dict['segments'], metrics=metrics)
+    elif function == 'pairwise_numpy':
+        ans_list = lib.pairwise.collapseSeqNumpy(seqs_vec, max_missing=param_dict['N'], should_traceback=should_traceback,
+                                                 metrics=metrics)
 #    input_df_sort["unqiue"] = ans_list[0]
     time_spent = ans_list[1]
     ans_vec = ans_list[0]
+    if search_stats is not None:   # names_vec is still in the same order as seqs_vec
+        write_search_stats(search_stats, param_dict, names_vec)
+    if fallback_idxes is not None:
+        report_fallbacks([(names_vec[idx], seqs_vec[idx]) for idx in fallback_idxes], param_dict, metrics)
     # end deduplication
+    if param_dict['save_index'] is not None:
+        if should_traceback:
+            uniqIdx_vec = [idx for idx, uniqIdx in enumerate(ans_vec) if idx == uniqIdx]
+        else:
+            uniqIdx_vec = ans_vec
+        save_index(param_dict['save_index'], index, index_names, [seqs_vec[idx] for idx in uniqIdx_vec],
+                   [names_vec[idx] for idx in uniqIdx_vec], param_dict)
+        if metrics is not None:
+            metrics.mark('save_index', len(uniqIdx_vec))
+    if param_dict['load_index'] is not None:   # convert back to the indexes of all reads
+        time_spent += index_time_spent
+        if should_traceback:
+            all_ans_vec = array('q', [-1]) * len(all_seqs_vec)
+            for now_idx, uniqIdx in enumerate(ans_vec):
+                all_ans_vec[kept[now_idx]] = kept[uniqIdx] if uniqIdx >= 0 else -1
+            names_vec, seqs_vec = all_names_vec, all_seqs_vec
+            value2uniqIdx = dict()   # the unique reads in the index are appended after all reads
+            for idx, value in idx2value.items():
+                if value not in value2uniqIdx:
+                    value2uniqIdx[value] = len(names_vec)
+                    names_vec.append(index_names[value])
+                    seqs_vec.append(value2seq[value])
+                all_ans_vec[idx] = value2uniqIdx[value]
+            ans_vec = all_ans_vec
+        else:
+            ans_vec = [kept[uniqIdx] for uniqIdx in ans_vec]
+            names_vec, seqs_vec = all_names_vec, all_seqs_vec
     num_dedup = 0
-    if should_traceback:
-        if output_format == 'dup2uniq':
-            uniqIdx2idxes = dict()
-            for idx, uniqIdx in enumerate(ans_vec):
-                uniqIdx2idxes[uniqIdx] = 1
-                orig_readID = input_df_sort.at[idx, 'name']
-                orig_seq = input_df_sort.at[idx, 'query']
-                if uniqIdx >= 0:
-                    uniq_readID = input_df_sort.at[uniqIdx, 'name']
-                    uniq_seq = input_df_sort.at[uniqIdx, 'query']
-                else:
-                    uniq_readID = '(filtered out, probably too many Ns)'
-                    uniq_seq = '(filtered out, probably too many Ns)'
-                print(f'{orig_readID}\t{orig_seq}\t{uniq_readID}\t{uniq_seq}')
-        if output_format == 'uniq2dup':
-            uniqIdx2idxes = dict()
-            for idx, uniqIdx in enumerate(ans_vec):
-                if uniqIdx >= 0:
-                    if uniqIdx not in uniqIdx2idxes:
-                        uniqIdx2idxes[uniqIdx] = []
-                    uniqIdx2idxes[uniqIdx].append(idx)
-            for uniqIdx, idxes in uniqIdx2idxes.items():
-                uniq_readID = input_df_sort.at[uniqIdx, 'name']
-                uniq_seq = input_df_sort.at[uniqIdx, 'query']
-                now_count = len(idxes)
-                orig_readIDs = ','.join([input_df_sort.at[x, 'name'] for x in idxes])
-                orig_seqs = ','.join([input_df_sort.at[x, 'query'] for x in idxes])
-                print(f'{uniq_readID}\t{uniq_seq}\t{now_count}\t{orig_readIDs}\t{orig_seqs}')
-        num_dedup = len(list(uniqIdx2idxes.keys()))
-    else:
-        for idx in ans_vec:
-#            print(f'idx={idx}', file=sys.stderr)
-            readID = input_df_sort.at[idx, 'name']
-            seq = input_df_sort.at[idx, 'query']
-            if output_format == 'fasta':
-                print(f">{readID}\n{seq}")
-            elif output_format == 'readID':
-                print(readID)
-            elif output_format == 'sequence':
-                print(seq)
-            num_dedup += 1
+    with lib.seqWriter.SeqWriter(param_dict['output']) as writer:
+        if should_traceback:
+            if output_format == 'dup2uniq':
+                filtered_out = '(filtered out, probably too many Ns)'
+                for idx, uniqIdx in enumerate(ans_vec):
+                    if uniqIdx >= 0:
+                        writer.write_dup2uniq(names_vec[idx], seqs_vec[idx], names_vec[uniqIdx], seqs_vec[uniqIdx])
+                    else:
+                        writer.write_dup2uniq(names_vec[idx], seqs_vec[idx], filtered_out, filtered_out)
+            if output_format == 'uniq2dup':
+                uniq_idxes, offsets, members = lib.groups.duplicateGroups(ans_vec)
+                for group, uniqIdx in enumerate(uniq_idxes):
+                    idxes = members[offsets[group]:offsets[group + 1]]
+                    writer.write_uniq2dup(names_vec[uniqIdx], seqs_vec[uniqIdx], len(idxes),
+                                          (names_vec[x] for x in idxes), (seqs_vec[x] for x in idxes))
+            if output_format == 'groups':
+                lib.groups.writeGroups(writer, lib.groups.buildGroups(names_vec, seqs_vec, ans_vec))
+            # the unique reads, and those of the index appended after all reads
+            num_dedup = sum(1 for idx, uniqIdx in enumerate(ans_vec) if idx == uniqIdx) + len(names_vec) - len(ans_vec)
+        else:
+            for idx in ans_vec:
+                writer.write_record(output_format, names_vec[idx], seqs_vec[idx],
+                                    quals_vec[idx] if quals_vec is not None else None)
+            num_dedup = len(ans_vec)
+    if metrics is not None:
+        metrics.mark('write_output', len(ans_vec))
+        write_metrics(metrics, param_dict, num_dedup)
     if param_dict['verbose']:
         print(f'[NOTE] Deduplicating resulted in {num_dedup} unique reads. Time spent: {time_spent} s', file=sys.stderr)
 
@@ -14,6 +14,8 @@ import pandas as pd
 import lib.pairwise
 import lib.trie
 from lib.restrictedDict import restrictedListDict
+from lib.simulate import insertN
+from lib.metrics import MemoryTracker
 
 
 restrictedListDict.addAllowedKeys('ACGTN')
@@ -35,9 +37,9 @@ def parseArg():
     parser.add_argument('--input', '-i', dest='SOURCE_READS', required=True, type=str,
                         help="The source reads that are uniform in length; a csv file with a header of 'seq' and each row is a read")
     parser.add_argument('--function', '-f', dest='TESTED_FUNCTION', required=True, type=str,
-                        help="The type of deduplication algorithm to use [pairwise, trie]")
+                        help="The type of deduplication algorithm to use [pairwise, pairwise_numpy, trie]")
     parser.add_argument('--should_benchmark_memory', '-m', default=False, action='store_true',
-                        help="Whether to document memory usage")
+                        help="Whether to document memory usage: the peak of tracemalloc, the peak RSS and the estimated trie size, in GB")
     parser.add_argument('--symbols', '-s', dest='symbols', default='ACGTN', type=str,
                         help="The bases in the inputl; default = ACGTN ")    # 06172021 added print and ID options. print enables parallel running of multiple benchmark scripts whose outputs
     # are separated by > different file ### this does not work with tsp
@@ -50,25 +52,6 @@ def parseArg():
     return args
 
 
-def insertN(read, readLen, fctN, regionN=[0, 1]):
-    read = read[:readLen]  # only keep the left readLen part of input reads
-    coord_regionN = [int(readLen * regionN[0]),
-                     int(readLen * regionN[1])]  # the coordinates of the specific region of insertion
-    regionLen = coord_regionN[1] - coord_regionN[0]  # the length of the insertion region
-
-    numberN_float = fctN * regionLen  # number of Ns to be inserted into the region
-    decimal = numberN_float % 1
-    numberN = int(numberN_float)
-    if decimal > 0:
-        dice = random.random()
-        if dice <= decimal:
-            numberN = int(numberN_float) + 1
-    N_positions = random.sample(range(coord_regionN[0], coord_regionN[1]), numberN)
-    for pos in N_positions:
-        read = read[:pos] + 'N' + read[pos + 1:]
-    return read
-
-
 def documentResults(param_dict, variable_set):
     # result = pd.read_csv(param_dict['result_path'], sep='\t')
     # new_row = pd.Series(index=variable_set, dtype=object)
@@ -87,6 +70,7 @@ def runRepeats(param_dict, i, inputReads):
     '''
     set up parameters --> mask reads by N with user specifications --> construct Trie and record time -->
     keep the unique reads only --> create a string that's to be documented --> append string to file through listener
+    return a dict of the documented variables; with should_benchmark_memory, also the MEMORY_REPORT of lib.metrics
     '''
     should_benchmark_memory = param_dict['should_benchmark_memory']
     function = param_dict['TESTED_FUNCTION']
@@ -117,22 +101,23 @@ def runRepeats(param_dict, i, inputReads):
     # write a list of bool values to indicate whether each sequence is unique or it has been seen
     hpy_obj = None
     if should_benchmark_memory:
-        from guppy import hpy
-        hpy_obj = hpy()
+        hpy_obj = MemoryTracker()
     if function == 'trie':
         ans_list = lib.trie.collapseSeq(test_inflated["seq"], hp=hpy_obj, allowed_symbols=param_dict['symbols'], ambiguous_symbols='N')
     elif function == 'pairwise':
         ans_list = lib.pairwise.collapseSeq(test_inflated["seq"], hp=hpy_obj)
-    try:
-        test_inflated['UNIQUE'] = ans_list[0]
-    except ValueError:
-        print('gdamn it')
+    elif function == 'pairwise_numpy':
+        ans_list = lib.pairwise.collapseSeqNumpy(test_inflated["seq"], hp=hpy_obj)
+    test_inflated['UNIQUE'] = 0
+    test_inflated.loc[ans_list[0], 'UNIQUE'] = 1   # ans_list[0] is uniqIdx_vec, the indexes of the unique reads
     test_inflated_unique = test_inflated[test_inflated['UNIQUE'] == 1]
     DEMULTIPLEXED_SAMPLE = len(test_inflated_unique)
     TIMESPENT = ans_list[1]
     if should_benchmark_memory:
         # calculate memory usage and convert to gigabyte
         MEMORY_COST = str(ans_list[2].size/1024**3)
+        PEAK_RSS = str(ans_list[2].peak_rss/1024**3)
+        TRIE_MEMORY = str(ans_list[2].trie['estimated_bytes']/1024**3) if ans_list[2].trie else 'NA'
 
     if param_dict['verbose']:
         print(f'[NOTE] Demultiplexing resulted in {DEMULTIPLEXED_SAMPLE} unique reads. Time spent: {TIMESPENT} s', file=sys.stderr)
@@ -140,7 +125,7 @@ def runRepeats(param_dict, i, inputReads):
     # 01192022 no need for ID column --> remove
     variable_set = ['function', 'SAMPLE_SIZE', 'UNIQUE_SAMPLE', 'DEMULTIPLEXED_SAMPLE', 'READ_LENGTH', 'N_REGION', 'NUM_N', 'REGION_N_FCT', 'TOTAL_N_FCT', 'TIMESPENT', 'STARTING_FCT', 'INFLATION_FCT', 'SOURCE_READS']
     if should_benchmark_memory:
-        variable_set.append('MEMORY_COST')
+        variable_set.extend(['MEMORY_COST', 'PEAK_RSS', 'TRIE_MEMORY'])
     variable_set.append('i')
     for var in variable_set:
         if var not in param_dict:
@@ -149,6 +134,10 @@ def runRepeats(param_dict, i, inputReads):
     if param_dict['print']:
         print('\t'.join(variable_set), flush=True)
         print(res, flush=True)
+    result = {var: param_dict[var] for var in variable_set}
+    if should_benchmark_memory:
+        result['MEMORY_REPORT'] = ans_list[2].asDict()
+    return result
 
 
 def main():
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+# Benchmark suite: sweep deduplication functions over a grid of simulated datasets, and compare with a baseline
+"""
+Usage example:
+python3 benchmarkSuite.py --functions trie,flattrie,pairwise --num_reads 1000,10000 --read_lengths 50,200 \
+    --fctN 0.01,0.05 --output bench.json
+python3 benchmarkSuite.py --grid grid.json --output bench_new.json --baseline bench.json
+
+Each configuration runs in its own subprocess, so that the peak RSS of one does not leak into the next.
+Results are written in JSON; with --baseline, configurations whose dedup got slower or bigger than the tolerance,
+or that give a different number of unique reads, are reported as regressions, and the exit status is 1.
+
+A grid file is a JSON object with any of the keys: functions, num_reads, read_lengths, fctN, regionN, dup_rates, repeats,
+num_workers (the processes of the trie search of trie, flattrie and bitset, see collapseSeq())
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import itertools
+import subprocess
+
+import lib.trie
+import lib.pairwise
+from lib.simulate import simulateReads
+from lib.metrics import MemoryTracker, DedupMetrics, peakRSS
+
+TRIE_ENGINES = {'trie': 'node', 'flattrie': 'flat', 'bitset': 'bitset'}   # function -> engine of lib.trie.collapseSeq
+DEFAULT_GRID = {
+    'functions': ['sortuniq', 'trie', 'flattrie', 'bitset', 'pairwise'],
+    'num_reads': [1000, 10000],
+    'read_lengths': [50, 200],
+    'fctN': [0.01, 0.05],
+    'regionN': [[0, 1]],
+    'dup_rates': [0.3],
+    'repeats': 1,
+    'num_workers': [1],
+}
+
+
+def parseArg():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('--grid', default=None, type=str,
+                        help='A JSON file of the parameter grid; the options below override it')
+    parser.add_argument('--functions', '-f', default=None, type=str,
+                        help='Comma-separated deduplication functions [sortuniq, trie, flattrie, bitset, pairwise, pairwise_numpy]')
+    parser.add_argument('--num_reads', default=None, type=str, help='Comma-separated numbers of reads')
+    parser.add_argument('--read_lengths', default=None, type=str, help='Comma-separated read lengths')
+    parser.add_argument('--fctN', default=None, type=str,
+                        help='Comma-separated fractions of bases in the N region converted to N')
+    parser.add_argument('--regionN', default=None, type=str,
+                        help='Comma-separated N regions, each as start-end (from 0~1), e.g. 0-1,0.5-1')
+    parser.add_argument('--dup_rates', default=None, type=str,
+                        help='Comma-separated expected fractions of reads that are duplicates')
+    parser.add_argument('--repeats', default=None, type=int, help='Number of repeats (random seeds) of each configuration')
+    parser.add_argument('--num_workers', default=None, type=str,
+                        help='Comma-separated numbers of processes of the trie search of trie, flattrie and bitset, e.g. 1,4,16; '
+                             'compare their trie_dedup phases for the speedup of the search')
+    parser.add_argument('--output', '-o', default=None, type=str, help='The path to the JSON output; default is STDOUT')
+    parser.add_argument('--baseline', default=None, type=str, help='A JSON output of a previous run to compare with')
+    parser.add_argument('--tolerance', default=0.2, type=float,
+                        help='Relative increase of time or memory over the baseline to flag as a regression; default is 0.2')
+    parser.add_argument('--min_time', default=0.05, type=float,
+                        help='Time increase in seconds below which no time regression is flagged, to ignore noise; default is 0.05')
+    parser.add_argument('--min_memory', default=1.0, type=float,
+                        help='Memory increase in MB below which no memory regression is flagged, to ignore noise; default is 1')
+    parser.add_argument('--timeout', default=3600, type=float, help='Timeout in seconds of each configuration')
+    parser.add_argument('--trace_memory', default=False, action='store_true',
+                        help='Also measure the peak memory of each phase by tracemalloc, and the trie size; this slows down the dedup')
+    parser.add_argument('--verbose', '-v', default=False, action='store_true', help='Print the progress')
+    parser.add_argument('--run_one', default=None, type=str, help=argparse.SUPPRESS)   # used by the subprocesses
+    args = parser.parse_args().__dict__
+    return args
+
+
+def buildGrid(param_dict):
+    """
+    Return the list of configurations in the grid
+    """
+    grid = dict(DEFAULT_GRID)
+    if param_dict['grid'] is not None:
+        with open(param_dict['grid']) as infile:
+            grid.update(json.load(infile))
+    for key, convert in (('functions', str), ('num_reads', int), ('read_lengths', int), ('fctN', float), ('dup_rates', float),
+                         ('num_workers', int)):
+        if param_dict[key] is not None:
+            grid[key] = [convert(x) for x in param_dict[key].split(',')]
+    if param_dict['regionN'] is not None:
+        grid['regionN'] = [[float(x) for x in region.split('-')] for region in param_dict['regionN'].split(',')]
+    if param_dict['repeats'] is not None:
+        grid['repeats'] = param_dict['repeats']
+    configs = []
+    for num_reads, read_length, fctN, regionN, dup_rate, seed in itertools.product(
+            grid['num_reads'], grid['read_lengths'], grid['fctN'], grid['regionN'], grid['dup_rates'], range(1, grid['repeats'] + 1)):
+        for function in grid['functions']:   # the same dataset for all the functions
+            for num_workers in (grid['num_workers'] if function in TRIE_ENGINES else [1]):
+                configs.append({'function': function, 'num_reads': num_reads, 'read_length': read_length, 'fctN': fctN,
+                                'regionN': list(regionN), 'dup_rate': dup_rate, 'seed': seed, 'num_workers': num_workers})
+    return configs
+
+
+def configKey(config):
+    """
+    Return a hashable key of a configuration, to match the results with the baseline
+    """
+    return (config['function'], config['num_reads'], config['read_length'], config['fctN'],
+            tuple(config['regionN']), config['dup_rate'], config['seed'], config.get('num_workers', 1))
+
+
+def runDedup(function, seqs, hp=None, metrics=None, num_workers=1):
+    """
+    Deduplicate with function; return [uniqIdx_vec, time cost, [memory usage]]
+    metrics : lib.metrics.DedupMetrics object to record the phases of the dedup
+    num_workers : the processes of the trie search, only for trie, flattrie and bitset
+    """
+    if function == 'sortuniq':
+        return lib.trie.collapseSeq(seqs, should_just_uniq_sort=True, hp=hp, metrics=metrics)
+    elif function in TRIE_ENGINES:
+        return lib.trie.collapseSeq(seqs, engine=TRIE_ENGINES[function], hp=hp, metrics=metrics, num_workers=num_workers)
+    elif function == 'pairwise':
+        return lib.pairwise.collapseSeq(seqs, hp=hp, metrics=metrics)
+    elif function == 'pairwise_numpy':
+        return lib.pairwise.collapseSeqNumpy(seqs, hp=hp, metrics=metrics)
+    raise ValueError(f'[ERROR]: Unknown function {function}')
+
+
+def runOne(config, trace_memory=False):
+    """
+    Simulate the dataset and deduplicate it in this process; return the result of the configuration
+
+    phases has the time of the simulation, of the whole dedup, and of each phase of the dedup (exact_dedup, filter_N,
+    trie_dedup, ...) recorded by lib.metrics.DedupMetrics; dedup_rss is the growth of the peak RSS during the dedup,
+    so that the memory of the simulated dataset is not counted
+    """
+    phases = dict()
+    start_time = timeit.default_timer()
+    seqs, template_idxes = simulateReads(config['num_reads'], config['read_length'], config['dup_rate'],
+                                         config['fctN'], config['regionN'], config['seed'])
+    phases['simulate'] = timeit.default_timer() - start_time
+    rss_before_dedup = peakRSS()
+    metrics = DedupMetrics()
+    start_time = timeit.default_timer()
+    ans_list = runDedup(config['function'], seqs, MemoryTracker() if trace_memory else None, metrics,
+                        config.get('num_workers', 1))
+    uniqIdx_vec, time_spent = ans_list[:2]
+    phases['dedup'] = timeit.default_timer() - start_time
+    phases['collapseSeq'] = time_spent
+    for phase in metrics.phases:
+        phases[phase['name']] = phase['seconds']
+    peak_rss = peakRSS()
+    result = dict(config)
+    result.update({
+        'status': 'ok',
+        'num_unique': len(uniqIdx_vec),
+        'num_templates': len(set(template_idxes)),
+        'time': phases['dedup'],
+        'phases': phases,
+        'throughput': config['num_reads'] / phases['dedup'] if phases['dedup'] > 0 else None,   # reads per second
+        'peak_rss': peak_rss,
+        'peak_rss_before_dedup': rss_before_dedup,
+        'dedup_rss': peak_rss - rss_before_dedup,
+        'dedup_metrics': metrics.asDict(),
+    })
+    if trace_memory:
+        result['memory'] = ans_list[2].asDict()
+    return result
+
+
+def runInSubprocess(config, timeout, trace_memory=False):
+    """
+    Run a configuration in a new process; return its result, with the wall time of the whole process
+    """
+    start_time = timeit.default_timer()
+    command = [sys.executable, os.path.abspath(__file__), '--run_one', json.dumps(config)]
+    if trace_memory:
+        command.append('--trace_memory')
+    try:
+        proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    except subprocess.TimeoutExpired:
+        result = dict(config)
+        result['status'] = 'timeout'
+        result['wall_time'] = timeit.default_timer() - start_time
+        return result
+    if proc.returncode != 0:
+        result = dict(config)
+        result['status'] = f'failed with exit status {proc.returncode}'
+    else:
+        result = json.loads(proc.stdout.decode().strip().split('\n')[-1])
+    result['wall_time'] = timeit.default_timer() - start_time
+    return result
+
+
+def compareBaseline(results, baseline_results, tolerance, min_time=0.0, min_memory=0):
+    """
+    Return a list of messages of the regressions of results, compared with the baseline results
+
+    The memory compared is that of the dedup: dedup_rss, and the traced peak if both were run with --trace_memory;
+    increases of less than min_time seconds or min_memory bytes are ignored as noise
+    """
+    key2baseline = {configKey(result): result for result in baseline_results}
+    regressions = []
+    for result in results:
+        base = key2baseline.get(configKey(result))
+        if base is None or base['status'] != 'ok':
+            continue
+        name = ' '.join(f'{key}={value}' for key, value in zip(
+            ('function', 'num_reads', 'read_length', 'fctN', 'regionN', 'dup_rate', 'seed', 'num_workers'), configKey(result)))
+        if result['status'] != 'ok':
+            regressions.append(f'{name}: {result["status"]}')
+            continue
+        if result['num_unique'] != base['num_unique']:
+            regressions.append(f'{name}: num_unique {base["num_unique"]} -> {result["num_unique"]}')
+        values = {'time': (base['time'], result['time'], min_time)}
+        if 'dedup_rss' in base:   # not in the results of older versions
+            values['dedup_rss'] = (base['dedup_rss'], result['dedup_rss'], min_memory)
+        if 'memory' in base and 'memory' in result:
+            values['traced_peak'] = (base['memory']['traced_peak'], result['memory']['traced_peak'], min_memory)
+        for metric, (base_value, value, min_increase) in values.items():
+            if value > base_value * (1 + tolerance) and value - base_value > min_increase:
+                increase = f'+{value / base_value - 1:.0%}' if base_value > 0 else 'from 0'
+                regressions.append(f'{name}: {metric} {base_value:.4g} -> {value:.4g} ({increase})')
+    return regressions
+
+
+def main():
+    param_dict = parseArg()
+    if param_dict['run_one'] is not None:
+        print(json.dumps(runOne(json.loads(param_dict['run_one']), param_dict['trace_memory'])), flush=True)
+        return
+    configs = buildGrid(param_dict)
+    results = []
+    for i, config in enumerate(configs):
+        result = runInSubprocess(config, param_dict['timeout'], param_dict['trace_memory'])
+        results.append(result)
+        if param_dict['verbose']:
+            summary = f'{result["time"]:.3f} s, {result["dedup_rss"] / 1024**2:.1f} MB, {result["num_unique"]} unique reads' \
+                if result['status'] == 'ok' else result['status']
+            print(f'[NOTE] {i + 1}/{len(configs)} {" ".join(f"{k}={v}" for k, v in config.items())}: {summary}', file=sys.stderr)
+    output = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+        },
+        'results': results,
+    }
+    regressions = []
+    if param_dict['baseline'] is not None:
+        with open(param_dict['baseline']) as infile:
+            baseline = json.load(infile)
+        regressions = compareBaseline(results, baseline['results'], param_dict['tolerance'], param_dict['min_time'],
+                                      param_dict['min_memory'] * 1024**2)
+        output['regressions'] = regressions
+        for message in regressions:
+            print(f'[WARNING] Regression: {message}', file=sys.stderr)
+        print(f'[NOTE] {len(regressions)} regressions compared with {param_dict["baseline"]}', file=sys.stderr)
+    if param_dict['output'] is None:
+        json.dump(output, sys.stdout, indent=1)
+        print()
+    else:
+        with open(param_dict['output'], 'w') as outfile:
+            json.dump(output, outfile, indent=1)
+    if len(regressions) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# Bit-parallel inverted index, an alternative to the trie for searching unique reads with ambiguous bases
+# for each read length, position and base, keep a bitmap of the reads having that base (or the ambiguous symbol) there;
+# a query matches the reads in the AND of the bitmaps of its bases at its non-ambiguous positions
+# the bitmaps are Python ints, so each AND processes 64 reads per machine word
+
+import sys
+from collections.abc import Set
+
+
+class BitsetIndex(Set):
+    """
+    Bitset index of sequences, with the same add/search interface as TrieNode and FlatTrie
+
+    Sequences of each length are numbered in the order of addition; bit k of _bitmaps[length][pos][col] is set
+    if the k-th sequence has the symbol of column col, or the ambiguous symbol, at pos.
+    The ambiguous symbol has no bitmap of its own, it is set in the bitmaps of all the other symbols.
+    Optionally, each sequence carries a value (e.g. the index of the read), kept in _values in the same numbering;
+    like TrieNode and FlatTrie, adding a sequence again with a value replaces its value.
+    """
+    __slots__ = '_symbols', '_encoder', '_wild', '_bitmaps', '_seqs', '_seq_pos', '_values'
+
+    def __init__(self, iterable=(), allowed_symbols='ACGTN', ambiguous_symbol='N'):
+        symbols = []
+        for x in allowed_symbols:
+            if x != ambiguous_symbol and x not in symbols:
+                symbols.append(x)
+        symbols.append(ambiguous_symbol)   # keep the ambiguous symbol at the last column
+        self._symbols = symbols
+        self._encoder = str.maketrans({x: chr(col) for col, x in enumerate(symbols)})
+        self._wild = len(symbols) - 1   # column of the ambiguous symbol
+        self._bitmaps = dict()   # length -> [position -> [column -> bitmap]]
+        self._seqs = dict()   # length -> the sequences, in the order of addition
+        self._seq_pos = dict()   # sequence -> its number among the sequences of its length
+        self._values = dict()   # length -> the value of each sequence, None if not given
+        for element in iterable:
+            self.add(element)
+
+    def _encode(self, sequence):
+        """
+        Convert a sequence to bytes of column indexes
+        """
+        codes = sequence.translate(self._encoder).encode('latin-1')
+        if codes and max(codes) >= len(self._symbols):
+            for x in sequence:
+                if x not in self._symbols:
+                    raise KeyError(f'Key {x} is not allowed')
+        return codes
+
+    def __contains__(self, element):
+        """
+        Check if self contains the element (sequence) as an entire child
+        """
+        return element in self._seq_pos
+
+    def __iter__(self):
+        """
+        Return an iterator of all the sequences in this index, grouped by length in the order of addition
+        """
+        for seqs in self._seqs.values():
+            yield from seqs
+
+    def __len__(self):
+        """
+        Return the number of the sequences in this index
+        """
+        return len(self._seq_pos)
+
+    def memory_footprint(self):
+        """
+        Return (number of bitmaps, mean bytes per bitmap); the bitmaps play the role of the nodes of a trie
+        """
+        num_bitmaps = 0
+        num_bytes = 0
+        for positions in self._bitmaps.values():
+            for column in positions:
+                num_bitmaps += len(column)
+                num_bytes += sum(sys.getsizeof(bitmap) for bitmap in column)
+        return num_bitmaps, num_bytes / num_bitmaps if num_bitmaps > 0 else 0.0
+
+    def add(self, sequence, value=None):
+        """
+        Add a sequence to this index, optionally with a value; a sequence already in this index gets the new value, if given
+        """
+        if sequence in self._seq_pos:
+            if value is not None:
+                self._values[len(sequence)][self._seq_pos[sequence]] = value
+            return
+        codes = self._encode(sequence)
+        seq_len = len(codes)
+        if seq_len not in self._seqs:
+            self._seqs[seq_len] = []
+            self._values[seq_len] = []
+            self._bitmaps[seq_len] = [[0] * self._wild for _ in range(seq_len)]
+        seqs = self._seqs[seq_len]
+        bit = 1 << len(seqs)
+        seqs.append(sequence)
+        self._values[seq_len].append(value)
+        self._seq_pos[sequence] = len(seqs) - 1
+        wild = self._wild
+        for column, col in zip(self._bitmaps[seq_len], codes):
+            if col == wild:   # the ambiguous symbol matches every symbol
+                for c in range(wild):
+                    column[c] |= bit
+            else:
+                column[col] |= bit
+
+    def _search_bits(self, sequence, counters=None):
+        """
+        Return the bitmap of all the matches of sequence, in the numbering of its length; 0 if none
+        If counters (lib.metrics.SearchCounters) is given, fill in the number of bitmaps ANDed as visits,
+        and the last position checked as max_depth; there is no branch or backtrack
+        """
+        codes = self._encode(sequence)
+        seq_len = len(codes)
+        if seq_len not in self._seqs:
+            if counters is not None:
+                counters.set(0, 0, 0, 0)
+            return 0
+        wild = self._wild
+        matched = (1 << len(self._seqs[seq_len])) - 1
+        if counters is None:
+            for column, col in zip(self._bitmaps[seq_len], codes):
+                if col != wild:
+                    matched &= column[col]
+                    if not matched:
+                        break
+            return matched
+        visits = 0
+        depth = 0
+        for column, col in zip(self._bitmaps[seq_len], codes):
+            depth += 1
+            if col != wild:
+                visits += 1
+                matched &= column[col]
+                if not matched:
+                    break
+        counters.set(visits, 0, 0, depth)
+        return matched
+
+    def search(self, sequence, max_visits=None, counters=None):
+        """
+        Search for any match of sequence in this index; max_visits is not used, the cost does not depend on the Ns
+        """
+        return self._search_bits(sequence, counters) != 0
+
+    def search_with_traceback(self, sequence, max_visits=None, counters=None):
+        """
+        Search for any match of sequence in this index; return the earliest added matched sequence, or None
+        """
+        matched = self._search_bits(sequence, counters)
+        if not matched:
+            return None
+        return self._seqs[len(sequence)][(matched & -matched).bit_length() - 1]
+
+    def search_value(self, sequence, max_visits=None, counters=None):
+        """
+        Search for any match of sequence in this index; return the value of the earliest added matched sequence, or None
+        """
+        matched = self._search_bits(sequence, counters)
+        if not matched:
+            return None
+        return self._values[len(sequence)][(matched & -matched).bit_length() - 1]
+
+    def get(self, sequence, default=None):
+        """
+        Return the value of the sequence (exact match), or default if the sequence is not in this index or has no value
+        """
+        if sequence not in self._seq_pos:
+            return default
+        value = self._values[len(sequence)][self._seq_pos[sequence]]
+        return default if value is None else value
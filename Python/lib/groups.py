@@ -0,0 +1,165 @@
+# Mergeable deduplication results: the groups file of an input, written by TrieDedup.py --output_format groups
+# one line per exactly unique sequence, in the order of first occurrence (or of num_N, then first occurrence):
+# index, sequence, the index of the unique sequence it matches (itself if unique, -1 if filtered out), comma-separated readIDs
+# mergeGroups() merges the groups of several inputs (e.g. lanes) into the groups of their concatenation,
+# searching again only the unique sequences, and the duplicates of those that turn out to be duplicates
+# duplicateGroups() lays out the reads of each unique read of a traceback compactly, in typed arrays
+
+import gzip
+from array import array
+
+from lib.seqReader import isGzipped
+from lib.trie import newTrie
+
+
+def duplicateGroups(mapping_vec):
+    """
+    Return the duplicate groups of a traceback as three arrays('q'), in a compressed sparse row layout:
+    uniq_idxes, offsets, members; the reads of the group of the unique read uniq_idxes[k] are
+    members[offsets[k]:offsets[k + 1]], in increasing order (the unique read itself included)
+
+    The groups are in the order of their first read, like a dict of lists filled in the order of the reads;
+    they are built by one stable counting sort of the reads by their group, with no per-group Python object.
+
+    Arguments:
+      mapping_vec : the traceback of collapseSeq(should_traceback=True); reads filtered out (-1) are in no group
+    """
+    uniq2group = array('q', [-1]) * (max(mapping_vec, default=-1) + 1)   # the group of each unique read, in order of first read
+    uniq_idxes = array('q')
+    offsets = array('q', [0])   # the size of each group, then its offset
+    for uniqIdx in mapping_vec:
+        if uniqIdx < 0:
+            continue
+        group = uniq2group[uniqIdx]
+        if group < 0:
+            group = uniq2group[uniqIdx] = len(uniq_idxes)
+            uniq_idxes.append(uniqIdx)
+            offsets.append(0)
+        offsets[group + 1] += 1
+    for group in range(len(uniq_idxes)):
+        offsets[group + 1] += offsets[group]
+    members = array('q', [0]) * offsets[-1]
+    next_pos = offsets[:-1]   # where the next read of each group goes
+    for idx, uniqIdx in enumerate(mapping_vec):
+        if uniqIdx < 0:
+            continue
+        group = uniq2group[uniqIdx]
+        members[next_pos[group]] = idx
+        next_pos[group] += 1
+    return uniq_idxes, offsets, members
+
+
+def buildGroups(names_vec, seqs_vec, mapping_vec):
+    """
+    Return the groups, a list of [sequence, match, readIDs] of each exactly unique sequence in the order of first occurrence
+
+    Arguments:
+      names_vec : the readIDs
+      seqs_vec : the sequences
+      mapping_vec : the traceback of collapseSeq(seqs_vec, should_traceback=True)
+    """
+    seq2group = dict()
+    groups = []
+    for idx, seq in enumerate(seqs_vec):
+        if seq in seq2group:
+            groups[seq2group[seq]][2].append(names_vec[idx])
+            continue
+        seq2group[seq] = len(groups)
+        groups.append([seq, mapping_vec[idx], [names_vec[idx]]])
+    for group in groups:   # the index of the read to the index of its group
+        if group[1] >= 0:
+            group[1] = seq2group[seqs_vec[group[1]]]
+    return groups
+
+
+def writeGroups(outfile, groups):
+    """
+    Write the groups to the opened text file outfile, or lib.seqWriter.SeqWriter
+    """
+    for i, (seq, match, readIDs) in enumerate(groups):
+        outfile.write(f'{i}\t{seq}\t{match}\t{",".join(readIDs)}\n')
+
+
+def readGroups(input_path):
+    """
+    Return the groups in a groups file, which may be compressed by gzip
+    """
+    groups = []
+    with (gzip.open(input_path, 'rt', encoding='latin-1') if isGzipped(input_path)
+          else open(input_path, encoding='latin-1')) as infile:   # like the readers and SeqWriter
+        for line in infile:
+            index, seq, match, readIDs = line.rstrip('\n').split('\t')
+            if int(index) != len(groups):
+                raise ValueError(f'[ERROR]: Line {len(groups) + 1} of {input_path} has index {index}; not a groups file?')
+            groups.append([seq, int(match), readIDs.split(',')])
+    return groups
+
+
+def mergeGroups(group_lists, allowed_symbols='ACGTN', ambiguous_symbols='N', max_missing=500, engine='node'):
+    """
+    Merge the groups of several inputs into the groups of the concatenation of the inputs, in the same order
+
+    Like collapseSeq(), the exactly unique sequences are searched in the order of (num_N, first occurrence)
+    in a trie of the unique ones before them; but a sequence that was a duplicate in its input is not searched
+    if the unique sequence it matched there is still unique, and keeps it as its match.
+    So the unique sequences are the same as those of collapseSeq() of all the reads of the inputs;
+    the match of a duplicate may differ.
+
+    Arguments:
+      group_lists : a list of the groups of each input, e.g. by readGroups()
+      allowed_symbols : the list of allowed symbols, such as bases 'ACGTN'
+      ambiguous_symbols: the list of ambiguous symbols, such as 'N'
+      max_missing : number of ambiguous characters to allow in a unique sequence; should be that of the inputs
+      engine : which trie to use, see newTrie()
+
+    Returns:
+      merged groups, the indexes of the unique groups in the order of (num_N, first occurrence) like collapseSeq()
+    """
+    ambiguous_symbol = ambiguous_symbols[0]
+    seq2group = dict()
+    merged = []
+    old_matches = []   # the match of each merged group in its input, None if filtered out
+    for groups in group_lists:
+        local2merged = []
+        new_groups = []   # the matches of the groups of sequences not seen before
+        for seq, match, readIDs in groups:
+            for ch in ambiguous_symbols[1:]:   # convert all ambiguous symbols to ambiguous_symbols[0]
+                seq = seq.replace(ch, ambiguous_symbol)
+            if seq in seq2group:   # the same sequence earlier
+                merged[seq2group[seq]][2].extend(readIDs)
+                local2merged.append(seq2group[seq])
+                continue
+            seq2group[seq] = len(merged)
+            local2merged.append(len(merged))
+            merged.append([seq, -1, list(readIDs)])
+            new_groups.append(match)
+        # the match may come later in the input, if it has fewer Ns
+        old_matches.extend(local2merged[match] if match >= 0 else None for match in new_groups)
+
+    tier2groups = dict()   # counting sort by num_N, in the order of first occurrence
+    for i, group in enumerate(merged):
+        num_N = group[0].count(ambiguous_symbol)
+        if num_N > max_missing:
+            continue   # filtered out due to too many Ns
+        if num_N in tier2groups:
+            tier2groups[num_N].append(i)
+        else:
+            tier2groups[num_N] = [i]
+    trie = newTrie(engine, allowed_symbols, ambiguous_symbol)
+    uniq_groups = []
+    for num_N in sorted(tier2groups):
+        for i in tier2groups[num_N]:
+            group = merged[i]
+            old_match = old_matches[i]
+            if old_match is not None and old_match != i and merged[old_match][1] == old_match:
+                group[1] = old_match   # still a duplicate of the unique sequence it matched in its input
+                continue
+            # sequences without N only match the same sequence, already merged
+            matched = trie.search_value(group[0]) if num_N > 0 else None
+            if matched is None:   # not found, uniq after TrieDedup
+                trie.add(group[0], i)
+                group[1] = i
+                uniq_groups.append(i)
+            else:
+                group[1] = matched
+    return merged, uniq_groups
@@ -0,0 +1,115 @@
+# Linear scan of unique reads, the fallback of trie searches that exceed their budget of node visits
+# each read is encoded one byte per position, one-hot in the low 7 bits (the ambiguous symbol sets all 7 bits),
+# and a chunk of reads of the same length is packed into one Python int, so that one AND with the query repeated
+# over the chunk compares it against all the reads at once; the cost does not depend on the Ns
+
+DEFAULT_CHUNK_SIZE = 1024   # number of reads packed in one int
+
+
+class LinearScanner:
+    """
+    Unique reads grouped by length, scanned linearly for the matches of a query
+
+    Two reads match if, at every position, their one-hot bytes share a bit, i.e. the AND of the bytes is nonzero.
+    Each read takes len + 1 bytes in a chunk; the extra guard byte is 0 in both the reads and the query.
+    Adding 0x7F to every byte of the AND sets its bit 7 iff the byte is nonzero, with no carry into the next byte;
+    the bits 7 that are not set mark the mismatched positions, and subtracting them from a bit above each read
+    leaves that bit set iff the read has no mismatch.
+    num_scanned is the number of reads compared with the query by the last search, a chunk at a time.
+    """
+    __slots__ = '_encoder', '_seqs', '_chunks', '_chunk_size', '_masks', 'num_scanned'
+
+    def __init__(self, iterable=(), allowed_symbols='ACGTN', ambiguous_symbol='N', chunk_size=DEFAULT_CHUNK_SIZE):
+        bases = []
+        for x in allowed_symbols:
+            if x != ambiguous_symbol and x not in bases:
+                bases.append(x)
+        if len(bases) > 7:
+            raise ValueError(f'[ERROR]: LinearScanner supports at most 7 non-ambiguous symbols, but got {len(bases)}')
+        encoder = {x: chr(1 << i) for i, x in enumerate(bases)}
+        encoder[ambiguous_symbol] = chr(0x7F)
+        self._encoder = str.maketrans(encoder)
+        self._seqs = dict()   # length -> the reads, in the order of addition
+        self._chunks = dict()   # length -> the packed ints of the full chunks, built when scanned
+        self._chunk_size = chunk_size
+        self._masks = dict()   # (length, chunk size) -> the masks of a full chunk, see _mask()
+        self.num_scanned = 0
+        for element in iterable:
+            self.add(element)
+
+    def __len__(self):
+        return sum(len(seqs) for seqs in self._seqs.values())
+
+    def _encode(self, sequence):
+        return (sequence.translate(self._encoder) + '\0').encode('latin-1')
+
+    def add(self, sequence):
+        """
+        Add a unique read
+        """
+        seq_len = len(sequence)
+        if seq_len not in self._seqs:
+            self._seqs[seq_len] = []
+            self._chunks[seq_len] = []
+        self._seqs[seq_len].append(sequence)
+
+    def _mask(self, seq_len, num_seqs):
+        """
+        Return (0x7F mask, 0x80 mask, guard bits) of a chunk of num_seqs reads of length seq_len;
+        only those of full chunks are cached, the last chunk of each length may have any number of reads
+        """
+        key = (seq_len, num_seqs)
+        if key in self._masks:
+            return self._masks[key]
+        low7 = int.from_bytes((b'\x7F' * seq_len + b'\0') * num_seqs, 'little')
+        high = int.from_bytes((b'\x80' * seq_len + b'\0') * num_seqs, 'little')
+        guard = int.from_bytes((bytes(seq_len) + b'\x80') * num_seqs, 'little')
+        if num_seqs == self._chunk_size:
+            self._masks[key] = (low7, high, guard)
+        return low7, high, guard
+
+    def _iter_chunks(self, seq_len):
+        """
+        Return an iterator of (the index of the first read, number of reads, packed int) of the chunks of length seq_len
+        """
+        seqs = self._seqs.get(seq_len, [])
+        chunks = self._chunks.get(seq_len, [])
+        chunk_size = self._chunk_size
+        for start in range(0, len(seqs), chunk_size):
+            num_seqs = min(chunk_size, len(seqs) - start)
+            k = start // chunk_size
+            if k < len(chunks):
+                packed = chunks[k]
+            else:
+                packed = int.from_bytes(b''.join([self._encode(seq) for seq in seqs[start:start + num_seqs]]), 'little')
+                if num_seqs == chunk_size:   # only cache full chunks, the last one may still grow
+                    chunks.append(packed)
+            yield start, num_seqs, packed
+
+    def search_all(self, sequence):
+        """
+        Return an iterator of all the reads that match sequence, in the order of addition
+        """
+        seq_len = len(sequence)
+        query = self._encode(sequence)
+        repeated = dict()   # number of reads -> the query repeated for a chunk of that many reads
+        self.num_scanned = 0
+        for start, num_seqs, packed in self._iter_chunks(seq_len):
+            self.num_scanned += num_seqs
+            low7, high, guard = self._mask(seq_len, num_seqs)
+            if num_seqs not in repeated:
+                repeated[num_seqs] = int.from_bytes(query * num_seqs, 'little')
+            nonzero = ((packed & repeated[num_seqs]) + low7) & high
+            hits = (guard - (high ^ nonzero)) & guard   # the guard bit of each matched read
+            while hits:
+                bit = hits & -hits
+                yield self._seqs[seq_len][start + (bit.bit_length() - 1) // (8 * (seq_len + 1))]
+                hits ^= bit
+
+    def search(self, sequence):
+        """
+        Search for any match of sequence
+        """
+        for _ in self.search_all(sequence):
+            return True
+        return False
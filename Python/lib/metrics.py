@@ -0,0 +1,282 @@
+# Memory and time measurement of deduplication, without guppy
+# MemoryTracker can be passed as the hp argument of collapseSeq() in place of guppy's hpy() object:
+# its heap() returns a MemoryReport, whose .size is the peak memory in bytes, like the .size of guppy's heap
+# besides the peak, it reports the peak of each phase, the RSS high-water mark, and the trie footprint
+# DedupMetrics records the duration, number of items and throughput of each phase, for the metrics argument
+# SearchStats records the cost of each trie search by the number of Ns of the query, for the search_stats argument
+
+import sys
+import json
+import heapq
+import timeit
+import resource
+import tracemalloc
+
+
+def currentRSS():
+    """
+    Return the current resident set size of this process in bytes, or None if it cannot be read
+    """
+    try:
+        with open('/proc/self/statm') as infile:
+            return int(infile.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def peakRSS():
+    """
+    Return the peak resident set size of this process in bytes
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024   # bytes on macOS, KB on Linux
+
+
+class MemoryReport:
+    """
+    Memory usage of a deduplication, returned by MemoryTracker.heap()
+
+    Attributes:
+      size : the peak memory in bytes; the tracemalloc peak if traced, otherwise the peak RSS
+      traced_peak : the peak of the memory allocated by Python since the tracker started, None if not traced
+      peak_rss : the RSS high-water mark of the process
+      phases : a list of dicts of each phase: name, traced_peak (within the phase), traced_current, rss, peak_rss
+      trie : a dict of the trie footprint: num_nodes, bytes_per_node, estimated_bytes; None if no trie was given
+    """
+    __slots__ = 'size', 'traced_peak', 'peak_rss', 'phases', 'trie'
+
+    def __init__(self, traced_peak, peak_rss, phases, trie=None):
+        self.size = traced_peak if traced_peak is not None else peak_rss
+        self.traced_peak = traced_peak
+        self.peak_rss = peak_rss
+        self.phases = phases
+        self.trie = trie
+
+    def asDict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __repr__(self):
+        return f'MemoryReport({self.asDict()})'
+
+
+class MemoryTracker:
+    """
+    Track the peak memory of each phase of a deduplication, by tracemalloc and the RSS of the process
+
+    tracemalloc measures the memory allocated by Python objects only, and slows allocation down;
+    with trace=False, only the RSS is measured, with no overhead.
+    Call mark() at the end of each phase, and heap() at the end of the deduplication.
+    """
+
+    def __init__(self, trace=True):
+        self.trace = trace
+        self._started_tracing = False
+        self._phases = []
+        self._trie = None
+        self._traced_peak = 0
+        if trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+
+    def mark(self, name, trie=None):
+        """
+        Record the memory of the phase that ends now, named name; and the footprint of trie, if given
+        """
+        phase = {'name': name, 'traced_peak': None, 'traced_current': None, 'rss': currentRSS(), 'peak_rss': peakRSS()}
+        if self.trace:
+            current, peak = tracemalloc.get_traced_memory()
+            phase['traced_peak'] = peak
+            phase['traced_current'] = current
+            self._traced_peak = max(self._traced_peak, peak)
+            tracemalloc.reset_peak()
+        self._phases.append(phase)
+        if trie is not None:
+            num_nodes, bytes_per_node = trie.memory_footprint()
+            self._trie = {'engine': type(trie).__name__, 'num_nodes': num_nodes, 'bytes_per_node': bytes_per_node,
+                          'estimated_bytes': int(num_nodes * bytes_per_node)}
+
+    def heap(self):
+        """
+        Return the MemoryReport of all the phases so far; stop tracemalloc if this tracker started it
+        """
+        if self.trace and tracemalloc.is_tracing():
+            self._traced_peak = max(self._traced_peak, tracemalloc.get_traced_memory()[1])
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+        return MemoryReport(self._traced_peak if self.trace else None, peakRSS(), list(self._phases), self._trie)
+
+
+def markPhase(hp, name, trie=None):
+    """
+    Record the end of phase name in hp if it is a MemoryTracker; a guppy hpy() object has no phases
+    """
+    if isinstance(hp, MemoryTracker):
+        hp.mark(name, trie)
+
+
+class DedupMetrics:
+    """
+    Record the duration, number of items and throughput of each phase of a deduplication, and named counts
+
+    Pass it as the metrics argument of collapseSeq() and the like; each phase runs from the previous mark()
+    (or the creation of the object, or restart()) to the next mark().
+    callback, if given, is called with the dict of each phase as soon as it is recorded, e.g. to log progress.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.phases = []
+        self.counts = dict()
+        self._start_time = timeit.default_timer()
+        self._last_time = self._start_time
+
+    def restart(self):
+        """
+        Start the next phase now, e.g. to exclude the time spent since the last phase by the caller
+        """
+        self._last_time = timeit.default_timer()
+
+    def mark(self, name, items=None):
+        """
+        Record the phase that ends now, named name, which processed items (e.g. reads)
+        """
+        now = timeit.default_timer()
+        seconds = now - self._last_time
+        self._last_time = now
+        phase = {'name': name, 'seconds': seconds, 'items': items,
+                 'throughput': items / seconds if items is not None and seconds > 0 else None}   # items per second
+        self.phases.append(phase)
+        if self.callback is not None:
+            self.callback(phase)
+
+    def count(self, name, value):
+        """
+        Record a named count, e.g. the number of unique reads
+        """
+        self.counts[name] = value
+
+    def asDict(self):
+        return {
+            'total_seconds': timeit.default_timer() - self._start_time,
+            'phases': list(self.phases),
+            'counts': dict(self.counts),
+        }
+
+    def writeJson(self, output_path, **extra):
+        """
+        Write the metrics, with the extra key-value pairs (e.g. the input and parameters), to a JSON file
+        """
+        output = dict(extra)
+        output.update(self.asDict())
+        with open(output_path, 'w') as outfile:
+            json.dump(output, outfile, indent=1)
+            outfile.write('\n')
+
+
+class SearchCounters:
+    """
+    The cost of one trie search, filled in by the search methods given counters=
+
+    Attributes:
+      visits : number of nodes visited (for BitsetIndex, the number of bitmaps ANDed)
+      wildcard_branches : number of extra children pushed at nodes with more than one way to go, because of Ns
+      backtracks : number of dead ends, from which the search went back to the last branch
+      max_depth : the deepest position of the query reached
+    """
+    __slots__ = 'visits', 'wildcard_branches', 'backtracks', 'max_depth'
+
+    def __init__(self):
+        self.set(0, 0, 0, 0)
+
+    def set(self, visits, wildcard_branches, backtracks, max_depth):
+        self.visits = visits
+        self.wildcard_branches = wildcard_branches
+        self.backtracks = backtracks
+        self.max_depth = max_depth
+
+
+def histogramBin(value):
+    """
+    Return the label of the power-of-2 histogram bin of a non-negative integer, e.g. '0', '1', '2-3', '4-7'
+    """
+    if value < 2:
+        return str(value)
+    low = 1 << (value.bit_length() - 1)
+    return f'{low}-{2 * low - 1}'
+
+
+class SearchStats:
+    """
+    Aggregate the cost of trie searches by the number of Ns of the query, and keep the worst queries
+
+    Pass it as the search_stats argument of collapseSeq() or dedupTiers(); each query is recorded with its number of Ns,
+    its index in the input, the SearchCounters of its trie search, and its hash lookups if any (see hash_max_missing).
+    With a budget of node visits (max_visits), the trie search of a read that fell back to the linear scan stopped
+    at max_visits + 1 visits, so its visits are truncated there; the cost of its scan is counted apart,
+    as the number of unique reads scanned (fallback_scanned and max_fallback_scanned).
+    """
+
+    def __init__(self, num_worst=20):
+        self.num_worst = num_worst
+        self.counters = SearchCounters()   # reused for every query
+        self._tiers = dict()   # num_N -> the aggregated cost of its queries
+        self._worst = []   # min-heap of (visits, idx, num_N) of the num_worst queries with the most visits
+
+    def record(self, num_N, idx, is_found, hash_lookups=0, is_searched=True, is_fallback=False, fallback_scanned=0):
+        """
+        Record the query of the read idx with num_N Ns: its hash lookups, and its trie search if is_searched,
+        whose cost has just been filled in self.counters by the search; is_fallback if the search exceeded its budget
+        and fell back to a linear scan, which compared it with fallback_scanned unique reads
+        """
+        if num_N not in self._tiers:
+            self._tiers[num_N] = {'num_queries': 0, 'num_searched': 0, 'num_found': 0, 'num_fallbacks': 0,
+                                  'fallback_scanned': 0, 'max_fallback_scanned': 0, 'hash_lookups': 0,
+                                  'visits': 0, 'max_visits': 0, 'wildcard_branches': 0, 'backtracks': 0, 'max_depth': 0,
+                                  'visits_histogram': dict()}
+        tier = self._tiers[num_N]
+        tier['num_queries'] += 1
+        if is_found:
+            tier['num_found'] += 1
+        tier['hash_lookups'] += hash_lookups
+        if not is_searched:
+            return
+        counters = self.counters
+        tier['num_searched'] += 1
+        if is_fallback:
+            tier['num_fallbacks'] += 1
+            tier['fallback_scanned'] += fallback_scanned
+            tier['max_fallback_scanned'] = max(tier['max_fallback_scanned'], fallback_scanned)
+        tier['visits'] += counters.visits
+        tier['max_visits'] = max(tier['max_visits'], counters.visits)
+        tier['wildcard_branches'] += counters.wildcard_branches
+        tier['backtracks'] += counters.backtracks
+        tier['max_depth'] = max(tier['max_depth'], counters.max_depth)
+        label = histogramBin(counters.visits)
+        tier['visits_histogram'][label] = tier['visits_histogram'].get(label, 0) + 1
+        if len(self._worst) < self.num_worst:
+            heapq.heappush(self._worst, (counters.visits, idx, num_N))
+        elif counters.visits > self._worst[0][0]:
+            heapq.heapreplace(self._worst, (counters.visits, idx, num_N))
+
+    def worst(self):
+        """
+        Return a list of (visits, idx, num_N) of the worst queries, with the most visits first
+        """
+        return sorted(self._worst, key=lambda x: (-x[0], x[1]))
+
+    def asDict(self, names=None):
+        """
+        Return the stats as a dict; the worst queries are identified by names[idx] if names is given, otherwise by idx
+        """
+        by_num_N = dict()
+        for num_N in sorted(self._tiers):
+            tier = dict(self._tiers[num_N])
+            tier['mean_visits'] = tier['visits'] / tier['num_searched'] if tier['num_searched'] > 0 else 0.0
+            tier['visits_histogram'] = dict(sorted(tier['visits_histogram'].items(), key=lambda x: int(x[0].split('-')[0])))
+            by_num_N[str(num_N)] = tier
+        worst = [{'read': names[idx] if names is not None else idx, 'num_N': num_N, 'visits': visits}
+                 for visits, idx, num_N in self.worst()]
+        return {'by_num_N': by_num_N, 'worst': worst}
@@ -0,0 +1,216 @@
+# Out-of-core version of lib.trie.collapseSeq, for inputs larger than memory
+# spill reads into on-disk buckets keyed by num_N (and by hash, so that exact dedup of each bucket fits in memory),
+# then stream the buckets in increasing order of num_N through the trie; only the trie has to stay resident
+# partitions larger than partition_size after the spill are split again by hash, so that exact dedup holds
+# at most partition_size characters of reads (plus the overhead of a dict of them) in memory at a time, whatever the input size
+
+import os
+import sys
+import heapq
+import shutil
+import tempfile
+import timeit
+from array import array
+
+from lib.trie import newTrie, dedupTiers
+
+
+class BucketWriter:
+    """
+    Buffer lines in memory by bucket key, and append them to one file per bucket when the buffer is full
+
+    Files are opened only when flushing, so the number of buckets is not limited by the number of open files
+    """
+
+    def __init__(self, tmp_dir, buffer_size=1 << 26):
+        self.tmp_dir = tmp_dir
+        self.buffer_size = buffer_size   # max number of buffered characters before flushing
+        self.buffers = dict()
+        self.num_buffered = 0
+        self.keys = set()
+
+    def path(self, key):
+        """
+        Return the file path of a bucket key (num_N, partition)
+        """
+        return os.path.join(self.tmp_dir, 'bucket_%d_%d.txt' % key)
+
+    def write(self, key, line):
+        """
+        Add one line to a bucket
+        """
+        if key not in self.buffers:
+            self.buffers[key] = []
+        self.buffers[key].append(line)
+        self.num_buffered += len(line)
+        if self.num_buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Append all the buffered lines to their files
+        """
+        for key, lines in self.buffers.items():
+            with open(self.path(key), 'a') as outfile:
+                outfile.write(''.join(lines))
+            self.keys.add(key)
+        self.buffers = dict()
+        self.num_buffered = 0
+
+
+def readBucket(path):
+    """
+    Return an iterator of (idx, seq) in a bucket file
+    """
+    with open(path, 'r') as infile:
+        for line in infile:
+            idx, seq = line.rstrip('\n').split('\t')
+            yield int(idx), seq
+
+
+def splitLargePartitions(writer, num_partitions, partition_size):
+    """
+    Split each bucket partition file of writer larger than partition_size characters into enough partitions of
+    about partition_size each, by another part of the hash of the sequence; equal sequences stay in the same partition,
+    and each new partition is still in increasing order of idx. Return the number of partitions split
+    """
+    num_split = 0
+    next_partition = dict()   # num_N -> the next unused partition number
+    for num_N, partition in writer.keys:
+        next_partition[num_N] = max(next_partition.get(num_N, 0), partition + 1)
+    for key in sorted(writer.keys):
+        path = writer.path(key)
+        num_subpartitions = -(-os.path.getsize(path) // partition_size)
+        if num_subpartitions <= 1:
+            continue
+        num_N = key[0]
+        first = next_partition[num_N]
+        next_partition[num_N] += num_subpartitions
+        for idx, seq in readBucket(path):
+            # hash(seq) % num_partitions is the same for all the reads of this partition, so use the rest of it
+            writer.write((num_N, first + hash(seq) // num_partitions % num_subpartitions), f'{idx}\t{seq}\n')
+        writer.flush()
+        os.remove(path)
+        writer.keys.discard(key)
+        num_split += 1
+    return num_split
+
+
+def dedupBucketPartition(path, mapping_vec=None):
+    """
+    Exact dedup of a bucket partition; overwrite it with the exactly unique reads, still in increasing order of idx
+
+    If mapping_vec is given, mapping_vec[idx] is set to the idx of the first occurrence of the same sequence
+    """
+    seq2uniqIdx = dict()
+    for idx, seq in readBucket(path):
+        if seq in seq2uniqIdx:
+            if mapping_vec is not None:
+                mapping_vec[idx] = seq2uniqIdx[seq]
+        else:
+            seq2uniqIdx[seq] = idx
+            if mapping_vec is not None:
+                mapping_vec[idx] = idx
+    with open(path, 'w') as outfile:
+        outfile.write(''.join([f'{idx}\t{seq}\n' for seq, idx in seq2uniqIdx.items()]))
+    return len(seq2uniqIdx)
+
+
+def collapseSeqOutOfCore(seqs, tmp_dir=None, allowed_symbols='ACGTN', ambiguous_symbols='N', max_missing=500,
+                         should_traceback=False, engine='node', hash_max_missing=2, num_partitions=16, buffer_size=1 << 26,
+                         metrics=None, search_stats=None, max_visits=None, fallback_idxes=None, partition_size=1 << 27):
+    """
+    Removes duplicate sequences, keeping only the trie in memory; give the same result as lib.trie.collapseSeq
+
+    Arguments:
+      seqs : the input sequences; any iterable, e.g. lib.seqReader.iterSeqs() streaming from a file
+      tmp_dir : the directory to create the temporary bucket files in; default is the system temporary directory
+      allowed_symbols : the list of allowed symbols, such as bases 'ACGTN'
+      ambiguous_symbols: the list of ambiguous symbols, such as 'N'
+      max_missing : number of ambiguous characters to allow in a unique sequence.
+      should_traceback : should I return mapping_vec instead of uniqIdx_vec?
+      engine : which trie to use, 'node' for TrieNode, 'flat' for the array-backed FlatTrie, or 'bitset' for BitsetIndex
+      hash_max_missing : for reads with at most this number of Ns, look up unique reads without N by hash instead of the trie
+      num_partitions : number of hash partitions of each num_N bucket at the spill; exact dedup holds one partition in memory at a time
+      buffer_size : number of characters buffered in memory before appending to the bucket files
+      metrics : lib.metrics.DedupMetrics object to record the phases spill, exact_dedup and trie_dedup
+      search_stats : lib.metrics.SearchStats object to record the cost of the trie search of each read, by its index in seqs
+      max_visits : the budget of node visits of each trie search; the reads over budget are searched by a linear scan
+                   instead, with the same results; None for no budget
+      fallback_idxes : a list to append the index in seqs of each read searched by the linear scan to
+      partition_size : max number of characters of a partition file (about the read length + 10 per read); larger partitions
+                       are split after the spill, which bounds the memory of exact dedup whatever the input size
+
+    Returns:
+      uniqIdx_vec, time cost
+      (or mapping_vec as an array('q'), time cost if should_traceback=True)
+          mapping_vec[i] = -1 if seqs[i] is discarded
+          mapping_vec[i] = j  if seqs[i] is duplicates of j (j=i means uniq)
+    """
+    start_time = timeit.default_timer()
+    if metrics is not None:
+        metrics.restart()
+    trie = newTrie(engine, allowed_symbols, ambiguous_symbols[0])
+    work_dir = tempfile.mkdtemp(prefix='TrieDedup.', dir=tmp_dir)
+    try:
+        # spill the reads into buckets by num_N and hash
+        writer = BucketWriter(work_dir, buffer_size)
+        num_seqs = 0
+        for idx, seq in enumerate(seqs):
+            num_seqs += 1
+            for ch in ambiguous_symbols[1:]:   # convert all ambiguous symbols to ambiguous_symbols[0]
+                seq = seq.replace(ch, ambiguous_symbols[0])
+            num_N = seq.count(ambiguous_symbols[0])
+            if num_N <= max_missing:
+                writer.write((num_N, hash(seq) % num_partitions), f'{idx}\t{seq}\n')
+        writer.flush()
+        num_split = splitLargePartitions(writer, num_partitions, partition_size)
+        print(f"[NOTE] Number of reads (raw) = {num_seqs}", file=sys.stderr)
+        if num_split > 0:
+            print(f"[NOTE] Split {num_split} partitions larger than {partition_size} characters", file=sys.stderr)
+        if metrics is not None:
+            metrics.mark('spill', num_seqs)
+            metrics.count('num_reads', num_seqs)
+        mapping_vec = None
+        if should_traceback:
+            mapping_vec = array('q', [-1]) * num_seqs
+
+        # exact dedup of each bucket partition, which share no sequence with each other
+        num_unique = 0
+        for key in sorted(writer.keys):
+            num_unique += dedupBucketPartition(writer.path(key), mapping_vec)
+        print(f"[NOTE] Number of reads (filtering out exact matches) that have {max_missing} N or less = {num_unique}", file=sys.stderr)
+        if metrics is not None:
+            metrics.mark('exact_dedup', num_seqs)
+            metrics.count('num_kept', num_unique)
+
+        # stream the buckets in increasing order of num_N, merging the partitions back in the order of idx
+        def iterTier(num_N):
+            partitions = [readBucket(writer.path(key)) for key in sorted(writer.keys) if key[0] == num_N]
+            for idx, seq in heapq.merge(*partitions):
+                yield seq, idx
+
+        tiers = ((num_N, iterTier(num_N)) for num_N in sorted(set(key[0] for key in writer.keys)))
+        uniqIdx_vec = []
+        for uniqIdx, matchedIdx in dedupTiers(tiers, trie, allowed_symbols, ambiguous_symbols, should_traceback, hash_max_missing,
+                                              search_stats, max_visits, fallback_idxes):
+            if should_traceback:
+                mapping_vec[uniqIdx] = matchedIdx
+            elif matchedIdx == uniqIdx:
+                uniqIdx_vec.append(uniqIdx)
+        if metrics is not None:
+            metrics.mark('trie_dedup', num_unique)
+            if not should_traceback:
+                metrics.count('num_unique', len(uniqIdx_vec))
+    finally:
+        shutil.rmtree(work_dir)
+
+    if should_traceback:
+        # exact duplicates point to their first occurrence, which now points to its unique read
+        for idx in range(num_seqs):
+            if mapping_vec[idx] >= 0:
+                mapping_vec[idx] = mapping_vec[mapping_vec[idx]]
+        TIMESPENT = timeit.default_timer() - start_time
+        return [mapping_vec, TIMESPENT]
+    TIMESPENT = timeit.default_timer() - start_time
+    return [uniqIdx_vec, TIMESPENT]
@@ -6,8 +6,11 @@ import sys
 
 import timeit
 import re
+import heapq
 from itertools import zip_longest
 
+from lib.metrics import markPhase
+
 
 ### reference: pRESTO https://bitbucket.org/kleinstein/presto/src/master/bin/CollapseSeq.py
 class DuplicateSet:
@@ -33,8 +36,77 @@ class DuplicateSet:
         return len(self.keys)
 
 
+class SegmentIndex:
+    """
+    Pigeonhole index of the unique sequences, to find the candidates that a query may equal without scanning all
+
+    Sequences are padded and split into segments of equal length. For each segment, the unique sequences are
+    bucketed by the exact content of the segment, or put in the wildcard list of the segment if it has an 'N'.
+    A query equals a unique sequence only if, in any segment without 'N' in the query, the unique sequence has
+    the same content or an 'N', so the candidates are one bucket plus the wildcard list of that segment.
+    This is lossless as long as the query has a segment without 'N', e.g. if it has fewer Ns than segments.
+
+    Attributes:
+      seg_len : the length of each segment
+      buckets : a list of dict for each segment; keys are the contents, values are lists of (order, sequence)
+      wildcards : a list of (order, sequence) for each segment, of the unique sequences having 'N' in the segment
+      count : number of the sequences added; the order of each sequence is the count when it is added
+    """
+
+    def __init__(self, num_segments, max_len, ignore_char='N'):
+        self.seg_len = max(1, -(-max_len // num_segments))
+        self.num_segments = max(1, -(-max_len // self.seg_len))
+        self.ignore_char = ignore_char
+        self.buckets = [dict() for _ in range(self.num_segments)]
+        self.wildcards = [[] for _ in range(self.num_segments)]
+        self.count = 0
+
+    def segments(self, seq):
+        """
+        Return the contents of the segments of seq, padded with '\\0' like the None of zip_longest in checkSeqEqual()
+        """
+        total_len = self.seg_len * self.num_segments
+        padded = seq[:total_len].ljust(total_len, '\0')
+        return [padded[start:start + self.seg_len] for start in range(0, total_len, self.seg_len)]
+
+    def add(self, seq):
+        """
+        Add a unique sequence
+        """
+        entry = (self.count, seq)
+        self.count += 1
+        for bucket, wildcard, content in zip(self.buckets, self.wildcards, self.segments(seq)):
+            if self.ignore_char in content:
+                wildcard.append(entry)
+            elif content in bucket:
+                bucket[content].append(entry)
+            else:
+                bucket[content] = [entry]
+
+    def candidates(self, seq):
+        """
+        Return an iterator of the unique sequences that seq may equal, in the order of addition;
+        or None if every segment of seq has an 'N', then all the unique sequences have to be checked
+        """
+        best = None
+        best_size = None
+        for bucket, wildcard, content in zip(self.buckets, self.wildcards, self.segments(seq)):
+            if self.ignore_char in content:
+                continue
+            exact = bucket.get(content, [])
+            if best is None or len(exact) + len(wildcard) < best_size:
+                best = (exact, wildcard)
+                best_size = len(exact) + len(wildcard)
+        if best is None:
+            return None
+        exact, wildcard = best
+        if len(wildcard) == 0 or len(exact) == 0:
+            return (seq for order, seq in (exact or wildcard))
+        return (seq for order, seq in heapq.merge(exact, wildcard))
+
+
 def findUniqueSeq(uniq_dict, search_keys, seq_dict, max_missing=3,
-                  inner=False):
+                  inner=False, seg_index=None):
     """
     Finds unique sequences
 
@@ -44,6 +116,7 @@ def findUniqueSeq(uniq_dict, search_keys, seq_dict, max_missing=3,
       seq_dict : a SeqRecords dictionary generated by SeqIO.index().
       max_missing : the number of missing characters to allow in a unique sequences.
       inner : if True exclude consecutive outer ambiguous characters from iterations and matching.
+      seg_index : a SegmentIndex of the keys of uniq_dict, to check only the candidates instead of all the keys; updated for new keys
 
     Returns:
       tuple: (uniq_dict, search_keys, dup_keys) modified from passed values.
@@ -89,7 +162,12 @@ def findUniqueSeq(uniq_dict, search_keys, seq_dict, max_missing=3,
             match = uid if uid in search_dict else None
         # Check for ambiguous matches
         else:
-            for key in search_dict:
+            candidates = None
+            if seg_index is not None:
+                candidates = seg_index.candidates(uid)
+            if candidates is None:
+                candidates = search_dict
+            for key in candidates:
                 if checkSeqEqual(uid, key):
                     match = key
                     break
@@ -121,6 +199,8 @@ def findUniqueSeq(uniq_dict, search_keys, seq_dict, max_missing=3,
 
         if match is None:
             uniq_dict[uid] = DuplicateSet(seq_str, key=key, missing=ambig_count)
+            if seg_index is not None:
+                seg_index.add(uid)
         else:
             # Updated sequence, count, ambiguous character count, and count sets
             dup_key = key
@@ -135,7 +215,7 @@ def findUniqueSeq(uniq_dict, search_keys, seq_dict, max_missing=3,
     return uniq_dict, search_keys, dup_keys
 
 
-def collapseSeq(seqs, max_missing=500, inner=False, hp=None, should_traceback=False):
+def collapseSeq(seqs, max_missing=500, inner=False, hp=None, should_traceback=False, num_segments=0, metrics=None):
     """
     Removes duplicate sequences
 
@@ -143,8 +223,11 @@ def collapseSeq(seqs, max_missing=500, inner=False, hp=None, should_traceback=Fa
       seqs : the input sequences
       max_missing : number of ambiguous characters to allow in a unique sequence.
       inner : if True exclude consecutive outer ambiguous characters from iterations and matching.
-      hp : hyp() object for memory benchmarking.
+      hp : lib.metrics.MemoryTracker (or guppy's hpy()) object for memory benchmarking.
       should_traceback : should I return mapping_vec instead of uniqIdx_vec?
+      num_segments : if > 0, split reads into this number of segments, and check only the unique reads sharing
+                     a segment with the query (see SegmentIndex); the results are the same
+      metrics : lib.metrics.DedupMetrics object to record the phase pairwise_dedup
 
     Returns:
       uniqIdx_vec, time cost, [memory usage]
@@ -152,6 +235,8 @@ def collapseSeq(seqs, max_missing=500, inner=False, hp=None, should_traceback=Fa
           mapping_vec[i] = -1 if seqs[i] is discarded
           mapping_vec[i] = j  if seqs[i] is duplicates of j (j=i means uniq)
     """
+    if metrics is not None:
+        metrics.restart()
     seq_dict = {}
     for i in range(len(seqs)):
         seq_dict[i] = seqs[i]   # the dict of input sequences, key = idx, value = sequence
@@ -164,9 +249,12 @@ def collapseSeq(seqs, max_missing=500, inner=False, hp=None, should_traceback=Fa
     # list of seqs
     search_keys = list(seq_dict.keys())
     dup_keys = []
+    seg_index = None
+    if num_segments > 0:
+        seg_index = SegmentIndex(num_segments, max((len(seq) for seq in seq_dict.values()), default=0))
     for n in range(0, max_missing + 1):
         # Find unique sequences
-        uniq_dict, search_keys, dup_list = findUniqueSeq(uniq_dict, search_keys, seq_dict, n, inner)
+        uniq_dict, search_keys, dup_list = findUniqueSeq(uniq_dict, search_keys, seq_dict, n, inner, seg_index)
 
         # Update list of duplicates
         dup_keys.extend(dup_list)
@@ -174,7 +262,12 @@ def collapseSeq(seqs, max_missing=500, inner=False, hp=None, should_traceback=Fa
         # Break if no keys to search remain
         if len(search_keys) == 0:  break
     TIMESPENT = timeit.default_timer() - start_time
+    if metrics is not None:
+        metrics.mark('pairwise_dedup', len(seqs))
+        metrics.count('num_reads', len(seqs))
+        metrics.count('num_unique', len(uniq_dict))
     if hp:
+        markPhase(hp, 'pairwise_dedup')
         h = hp.heap()
 #    is_uniq_vec = [0] * len(seqs)
 #    for i in range(len(seqs)):
@@ -204,3 +297,163 @@ def collapseSeq(seqs, max_missing=500, inner=False, hp=None, should_traceback=Fa
     if hp:
         return [uniqIdx_vec, TIMESPENT, h]
     return [uniqIdx_vec, TIMESPENT]
+
+
+PREFIX_WORDS = 1   # number of 8-byte words (8 positions) compared for all the pairs of reads in collapseSeqNumpy()
+
+
+def encodeSeqWords(np, seqs, num_words, ambiguous_symbol='N'):
+    """
+    Encode sequences as matrices of uint64 words, one row per sequence, 8 latin-1 codes per word, padded with 0
+
+    Returns:
+      codes : the words of the sequences
+      not_ambiguous : the words of masks, 0xFF for each byte of codes that is not ambiguous_symbol, otherwise 0x00
+    """
+    width = 8 * num_words
+    padded = ''.join([seq.ljust(width, '\0') for seq in seqs])
+    codes = np.frombuffer(padded.encode('latin-1'), dtype=np.uint8).reshape(len(seqs), width)
+    not_ambiguous = (codes != ord(ambiguous_symbol)).astype(np.uint8) * np.uint8(0xFF)
+    return codes.view(np.uint64), not_ambiguous.view(np.uint64)
+
+
+def collapseSeqNumpy(seqs, max_missing=500, inner=False, hp=None, should_traceback=False,
+                     query_chunk_size=1024, max_chunk_cells=1 << 18, metrics=None):
+    """
+    Removes duplicate sequences; the same algorithm and results as collapseSeq(), vectorized by numpy
+
+    Like findUniqueSeq(), the reads of each number of ambiguous characters are checked in order against the unique
+    reads found so far, in the order of their addition; a read is the duplicate of the first unique read it equals,
+    excluding the positions where either is 'N' (the shorter read is padded, and only matches 'N' in the longer one).
+    Instead of scanning the unique reads one by one, a chunk of reads is compared against all the unique reads
+    at once by broadcasting; then the reads in the chunk that match none are checked against each other in order.
+    Reads are packed 8 bytes per uint64 word, and compared by XOR, masking out the bytes of 'N'.
+
+    Arguments:
+      seqs : the input sequences
+      max_missing : number of ambiguous characters to allow in a unique sequence.
+      inner : if True exclude consecutive outer ambiguous characters from iterations and matching.
+      hp : lib.metrics.MemoryTracker (or guppy's hpy()) object for memory benchmarking.
+      should_traceback : should I return mapping_vec instead of uniqIdx_vec?
+      query_chunk_size : number of reads compared against the unique reads at once
+      max_chunk_cells : max number of words in the arrays of one comparison, to bound the memory usage
+      metrics : lib.metrics.DedupMetrics object to record the phases exact_dedup and pairwise_dedup
+
+    Returns:
+      uniqIdx_vec, time cost, [memory usage]
+      (or mapping_vec, time cost, [memory usage] if should_traceback=True)
+          mapping_vec[i] = -1 if seqs[i] is discarded
+          mapping_vec[i] = j  if seqs[i] is duplicates of j (j=i means uniq)
+    """
+    import numpy as np
+
+    start_time = timeit.default_timer()
+    if metrics is not None:
+        metrics.restart()
+    ambig_re = re.compile(r'[\.\-N]')
+    seq_strs = [seq.strip('.-N') if inner else seq for seq in seqs]
+    mapping_vec = [-1] * len(seqs)
+    uniqIdx_vec = []
+    # level 0: exact matching
+    level2idxes = dict()
+    seq2uniqIdx = dict()
+    for idx, seq_str in enumerate(seq_strs):
+        ambig_count = len(ambig_re.findall(seq_str))
+        if ambig_count > max_missing:
+            continue
+        if ambig_count > 0:
+            if ambig_count not in level2idxes:
+                level2idxes[ambig_count] = []
+            level2idxes[ambig_count].append(idx)
+        elif seq_str in seq2uniqIdx:
+            mapping_vec[idx] = seq2uniqIdx[seq_str]
+        else:
+            seq2uniqIdx[seq_str] = idx
+            mapping_vec[idx] = idx
+            uniqIdx_vec.append(idx)
+    markPhase(hp, 'exact_dedup')
+    if metrics is not None:
+        metrics.mark('exact_dedup', len(seqs))
+
+    if len(level2idxes) > 0:
+        num_words = (max(len(seq_str) for seq_str in seq_strs) + 7) // 8
+        # the encoded unique reads, in the order of addition; rows beyond num_uniq are not used yet
+        num_uniq = len(uniqIdx_vec)
+        capacity = max(num_uniq, query_chunk_size)
+        uniq_codes = np.zeros((capacity, num_words), dtype=np.uint64)
+        uniq_not_N = np.zeros((capacity, num_words), dtype=np.uint64)
+        uniq_codes[:num_uniq], uniq_not_N[:num_uniq] = encodeSeqWords(np, [seq_strs[idx] for idx in uniqIdx_vec], num_words)
+        for level in sorted(level2idxes):
+            idxes = level2idxes[level]
+            for chunk_start in range(0, len(idxes), query_chunk_size):
+                chunk_idxes = idxes[chunk_start:chunk_start + query_chunk_size]
+                query_codes, query_not_N = encodeSeqWords(np, [seq_strs[idx] for idx in chunk_idxes], num_words)
+                # the first matched unique read found before this chunk, -1 if none
+                first_match = np.full(len(chunk_idxes), -1, dtype=np.int64)
+                uniq_chunk_size = max(1, max_chunk_cells // (len(chunk_idxes) * min(PREFIX_WORDS, num_words)))
+                for uniq_start in range(0, num_uniq, uniq_chunk_size):
+                    pending = np.flatnonzero(first_match < 0)
+                    if len(pending) == 0:
+                        break
+                    uniq_end = min(num_uniq, uniq_start + uniq_chunk_size)
+                    is_match = _matchMatrix(np, query_codes[pending], query_not_N[pending],
+                                            uniq_codes[uniq_start:uniq_end], uniq_not_N[uniq_start:uniq_end])
+                    has_match = is_match.any(axis=1)
+                    first_match[pending[has_match]] = uniq_start + is_match[has_match].argmax(axis=1)
+                # the reads matching no unique read before this chunk, checked against each other in order
+                pending = np.flatnonzero(first_match < 0)
+                if len(pending) > 0:
+                    is_match = _matchMatrix(np, query_codes[pending], query_not_N[pending], query_codes[pending], query_not_N[pending])
+                    new_uniq = []   # positions in pending of the new unique reads, in the order of addition
+                    for j in range(len(pending)):
+                        matched = np.flatnonzero(is_match[j, new_uniq])
+                        if len(matched) > 0:
+                            first_match[pending[j]] = num_uniq + matched[0]
+                        else:
+                            new_uniq.append(j)
+                    if num_uniq + len(new_uniq) > capacity:   # double the capacity
+                        capacity *= 2
+                        uniq_codes = np.concatenate([uniq_codes, np.zeros_like(uniq_codes)])
+                        uniq_not_N = np.concatenate([uniq_not_N, np.zeros_like(uniq_not_N)])
+                    uniq_codes[num_uniq:num_uniq + len(new_uniq)] = query_codes[pending[new_uniq]]
+                    uniq_not_N[num_uniq:num_uniq + len(new_uniq)] = query_not_N[pending[new_uniq]]
+                    for k in new_uniq:
+                        uniqIdx_vec.append(chunk_idxes[pending[k]])
+                    num_uniq += len(new_uniq)
+                for j, idx in enumerate(chunk_idxes):
+                    mapping_vec[idx] = uniqIdx_vec[first_match[j]] if first_match[j] >= 0 else idx
+    TIMESPENT = timeit.default_timer() - start_time
+    if metrics is not None:
+        metrics.mark('pairwise_dedup', sum(len(idxes) for idxes in level2idxes.values()))
+        metrics.count('num_reads', len(seqs))
+        metrics.count('num_unique', len(uniqIdx_vec))
+    if hp:
+        markPhase(hp, 'pairwise_dedup')
+        h = hp.heap()
+    if should_traceback:
+        if hp:
+            return [mapping_vec, TIMESPENT, h]
+        return [mapping_vec, TIMESPENT]
+    if hp:
+        return [uniqIdx_vec, TIMESPENT, h]
+    return [uniqIdx_vec, TIMESPENT]
+
+
+def _matchMatrix(np, query_codes, query_not_N, uniq_codes, uniq_not_N, prefix_words=PREFIX_WORDS):
+    """
+    Return a boolean matrix of whether each query equals each unique read, excluding the positions where either is 'N'
+
+    All the pairs are compared on the first prefix_words words, which already tell most pairs apart;
+    only the remaining candidate pairs are compared on the rest words.
+    """
+    prefix_words = min(prefix_words, query_codes.shape[1])
+    mismatch = query_codes[:, None, :prefix_words] ^ uniq_codes[None, :, :prefix_words]
+    mismatch &= query_not_N[:, None, :prefix_words]
+    mismatch &= uniq_not_N[None, :, :prefix_words]
+    is_match = ~mismatch.any(axis=2)
+    if prefix_words < query_codes.shape[1]:
+        query_pos, uniq_pos = np.nonzero(is_match)
+        mismatch = ((query_codes[query_pos, prefix_words:] ^ uniq_codes[uniq_pos, prefix_words:])
+                    & query_not_N[query_pos, prefix_words:] & uniq_not_N[uniq_pos, prefix_words:])
+        is_match[query_pos, uniq_pos] = ~mismatch.any(axis=1)
+    return is_match
@@ -0,0 +1,215 @@
+# Streaming readers of sequence files (fasta, fastq, or plain text with one sequence per line)
+# read the file in large binary chunks, split records with str methods on the whole chunk,
+# and yield the records in batches of (names, seqs), without building the whole file in memory
+# (or of (names, seqs, quals) from fastq, to keep the qualities for fastq output)
+# gzip and BGZF (blocked gzip) files are recognized by their magic bytes, and decompressed in a background thread
+
+import sys
+import gzip
+import queue
+import threading
+
+CHUNK_SIZE = 1 << 22   # read 4MB at a time
+GZIP_MAGIC = b'\x1f\x8b'
+COMPRESSED_EXTENSIONS = ('.gz', '.bgz', '.bgzf')
+
+
+def isGzipped(input_path):
+    """
+    Check if the file starts with the gzip magic bytes; BGZF files are also valid gzip files
+    """
+    with open(input_path, 'rb') as infile:
+        return infile.read(2) == GZIP_MAGIC
+
+
+def stripCompressedExtension(input_path):
+    """
+    Remove the compression extension (.gz, .bgz, .bgzf) of the file name, if any
+    """
+    for extension in COMPRESSED_EXTENSIONS:
+        if input_path.endswith(extension):
+            return input_path[:-len(extension)]
+    return input_path
+
+
+def iterRawChunks(input_path, chunk_size=CHUNK_SIZE):
+    """
+    Return an iterator of binary chunks of the (decompressed) input file
+    """
+    if isGzipped(input_path):
+        yield from _iterGzipChunks(input_path, chunk_size)
+        return
+    with open(input_path, 'rb') as infile:
+        while True:
+            chunk = infile.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _iterGzipChunks(input_path, chunk_size, max_queued_chunks=4):
+    """
+    Decompress in a background thread, so that parsing overlaps with inflating; zlib releases the GIL while inflating
+    """
+    chunks = queue.Queue(maxsize=max_queued_chunks)
+
+    def decompress():
+        try:
+            with gzip.open(input_path, 'rb') as infile:   # gzip handles the multiple members of BGZF
+                while True:
+                    chunk = infile.read(chunk_size)
+                    chunks.put(chunk)
+                    if not chunk:
+                        break
+        except Exception as e:
+            chunks.put(e)
+
+    threading.Thread(target=decompress, daemon=True).start()
+    while True:
+        chunk = chunks.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        if not chunk:
+            break
+        yield chunk
+
+
+def iterChunks(input_path, chunk_size=CHUNK_SIZE):
+    """
+    Return an iterator of decoded text chunks of the (decompressed) input file; '\\r' are removed
+    """
+    for chunk in iterRawChunks(input_path, chunk_size):
+        text = chunk.decode('latin-1')
+        if '\r' in text:
+            text = text.replace('\r', '')
+        yield text
+
+
+def readFastaBatches(input_path, chunk_size=CHUNK_SIZE):
+    """
+    Return an iterator of (names, seqs) batches from a fasta file; sequence lines of a record are joined
+    """
+    carry = ''
+    is_first = True
+    for text in iterChunks(input_path, chunk_size):
+        text = carry + text
+        end = text.rfind('\n>')   # the last record may be incomplete, keep it for the next chunk
+        if end < 0:
+            carry = text
+            continue
+        carry = text[end + 1:]
+        names, seqs = _parseFastaRecords(text[:end], is_first)
+        is_first = False
+        yield names, seqs
+    if carry:
+        names, seqs = _parseFastaRecords(carry, is_first)
+        yield names, seqs
+
+
+def _parseFastaRecords(text, is_first):
+    """
+    Parse complete fasta records in text; the text before the first '>' of the file is skipped
+    """
+    records = text.split('\n>')
+    if records[0].startswith('>'):
+        records[0] = records[0][1:]
+    elif is_first:
+        records = records[1:]   # skip the lines before the first record
+    names = []
+    seqs = []
+    for record in records:
+        header, _, body = record.partition('\n')
+        header = header.rstrip()
+        if header == '':
+            continue
+        names.append(header.split(' ')[0])
+        seqs.append(body.replace('\n', ''))
+    return names, seqs
+
+
+def readFastqBatches(input_path, chunk_size=CHUNK_SIZE, should_keep_quals=False):
+    """
+    Return an iterator of (names, seqs) batches from a fastq file of 4 lines per record;
+    of (names, seqs, quals) batches if should_keep_quals
+    """
+    carry = ''
+    NR = 0   # number of lines already parsed
+    for text in iterChunks(input_path, chunk_size):
+        lines = (carry + text).split('\n')
+        num_complete = (len(lines) - 1) // 4 * 4   # the last line may be incomplete, keep it for the next chunk
+        carry = '\n'.join(lines[num_complete:])
+        yield _parseFastqLines(lines[:num_complete], NR, should_keep_quals)
+        NR += num_complete
+    if carry:
+        yield _parseFastqLines(carry.split('\n'), NR, should_keep_quals)
+
+
+def _parseFastqLines(lines, NR, should_keep_quals=False):
+    """
+    Parse the name and sequence (and quality, if should_keep_quals) of each record in lines of complete fastq records
+    """
+    names = []
+    seqs = []
+    quals = []
+    for i, (header, seq) in enumerate(zip(lines[0::4], lines[1::4])):
+        if header[:1] == '@':
+            names.append(header[1:].rstrip().split(' ')[0])
+            seqs.append(seq)
+            if should_keep_quals:
+                quals.append(lines[4 * i + 3] if 4 * i + 3 < len(lines) else '')
+        elif len(header.rstrip()) > 0:
+            print(f'Warning: {NR + 4 * i + 1}-th line does not start with @, invalid fastq format', file=sys.stderr)
+    if should_keep_quals:
+        return names, seqs, quals
+    return names, seqs
+
+
+def readTextBatches(input_path, chunk_size=CHUNK_SIZE):
+    """
+    Return an iterator of (names, seqs) batches from a text file of one sequence per line; names are line numbers
+    """
+    carry = ''
+    NR = 0   # number of lines already parsed
+    for text in iterChunks(input_path, chunk_size):
+        lines = (carry + text).split('\n')
+        carry = lines.pop()   # the last line may be incomplete, keep it for the next chunk
+        yield _parseTextLines(lines, NR)
+        NR += len(lines)
+    if carry:
+        yield _parseTextLines([carry], NR)
+
+
+def _parseTextLines(lines, NR):
+    """
+    Use the line numbers as names; skip the headline of colname 'seq'
+    """
+    seqs = [line.rstrip() for line in lines]
+    names = [str(x) for x in range(NR + 1, NR + len(lines) + 1)]
+    if NR == 0 and len(seqs) > 0 and seqs[0] == 'seq':
+        names = names[1:]
+        seqs = seqs[1:]
+    return names, seqs
+
+
+def readSeqBatches(input_path, input_type, chunk_size=CHUNK_SIZE, should_keep_quals=False):
+    """
+    Return an iterator of (names, seqs) batches from the input file of input_type [fasta, fastq, text];
+    of (names, seqs, quals) batches if should_keep_quals, only for fastq
+    """
+    if should_keep_quals and input_type != 'fastq':
+        raise ValueError(f'[ERROR]: Only fastq input has qualities, not {input_type}')
+    if input_type == 'fasta':
+        return readFastaBatches(input_path, chunk_size)
+    elif input_type == 'fastq':
+        return readFastqBatches(input_path, chunk_size, should_keep_quals)
+    elif input_type == 'text':
+        return readTextBatches(input_path, chunk_size)
+    raise ValueError(f'[ERROR]: Unknown input type {input_type}; should be one of [fasta, fastq, text]')
+
+
+def iterSeqs(batches):
+    """
+    Return an iterator of the sequences in (names, seqs) batches, e.g. to stream into collapseSeq
+    """
+    for names, seqs in batches:
+        yield from seqs
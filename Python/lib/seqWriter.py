@@ -0,0 +1,148 @@
+# Buffered writer of the output records (readID, sequence, fasta, fastq, dup2uniq, uniq2dup, or any text)
+# records are appended as string pieces to a buffer, which is handed over as one chunk of pieces at a time
+# to a background thread that joins, encodes and writes it (compressed by gzip), so that the main thread only appends
+# the members of a uniq2dup cluster are streamed into the buffer, without joining them into one string first
+
+import sys
+import gzip
+import queue
+import threading
+from itertools import chain, islice, repeat
+
+BUFFER_SIZE = 1 << 16   # number of pieces buffered before they are joined into one chunk
+
+
+class SeqWriter:
+    """
+    Write records to output_path in large chunks; STDOUT if output_path is None, compressed by gzip if it ends with .gz
+
+    Use it as a context manager, or call close() at the end, to write the rest of the buffer and wait for the writes.
+    write() makes it a text file object too, e.g. for print(..., file=writer).
+    """
+
+    def __init__(self, output_path=None, buffer_size=BUFFER_SIZE, compresslevel=6, max_queued_chunks=4):
+        self.output_path = output_path
+        self.buffer_size = buffer_size
+        self._pieces = []
+        if output_path is None:
+            sys.stdout.flush()   # keep the order with what was printed before
+            self._outfile = sys.stdout.buffer
+        elif output_path.endswith('.gz'):
+            self._outfile = gzip.open(output_path, 'wb', compresslevel=compresslevel)
+        else:
+            self._outfile = open(output_path, 'wb')
+        self._chunks = queue.Queue(maxsize=max_queued_chunks)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_chunks, daemon=True)
+        self._thread.start()
+
+    def _write_chunks(self):
+        while True:
+            pieces = self._chunks.get()
+            if pieces is None:
+                break
+            if self._error is None:   # after an error, keep taking the chunks so that the main thread is not blocked
+                try:
+                    self._outfile.write(''.join(pieces).encode('latin-1'))   # the readers decode the input as latin-1
+                except Exception as e:
+                    self._error = e
+
+    def flush(self):
+        """
+        Hand the buffered pieces to the background thread as one chunk, to be joined, encoded and written there
+        """
+        if self._error is not None:
+            raise self._error
+        if self._pieces:
+            self._chunks.put(self._pieces)
+            self._pieces = []
+
+    def close(self):
+        """
+        Write the rest of the buffer, wait for the background thread, and close the output file (but not STDOUT)
+        """
+        if self._thread is None:
+            return
+        self.flush()
+        self._chunks.put(None)
+        self._thread.join()
+        self._thread = None
+        if self.output_path is None:
+            self._outfile.flush()
+        else:
+            self._outfile.close()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, text):
+        self._pieces.append(text)
+        if len(self._pieces) >= self.buffer_size:
+            self.flush()
+
+    def _extend(self, pieces):
+        self._pieces.extend(pieces)
+        if len(self._pieces) >= self.buffer_size:
+            self.flush()
+
+    def _extend_joined(self, sep, items):
+        """
+        Append the items separated by sep, a slice of buffer_size items at a time
+        """
+        items = iter(items)
+        is_first = True
+        while True:
+            start = len(self._pieces)
+            self._pieces.extend(chain.from_iterable(zip(repeat(sep), islice(items, self.buffer_size))))
+            if len(self._pieces) == start:
+                break
+            if is_first:
+                self._pieces[start] = ''   # no separator before the first item
+                is_first = False
+            if len(self._pieces) >= self.buffer_size:
+                self.flush()
+
+    def write_readID(self, readID):
+        self._extend((readID, '\n'))
+
+    def write_sequence(self, seq):
+        self._extend((seq, '\n'))
+
+    def write_fasta(self, readID, seq):
+        self._extend(('>', readID, '\n', seq, '\n'))
+
+    def write_fastq(self, readID, seq, qual):
+        self._extend(('@', readID, '\n', seq, '\n+\n', qual, '\n'))
+
+    def write_dup2uniq(self, orig_readID, orig_seq, uniq_readID, uniq_seq):
+        self._extend((orig_readID, '\t', orig_seq, '\t', uniq_readID, '\t', uniq_seq, '\n'))
+
+    def write_uniq2dup(self, uniq_readID, uniq_seq, count, orig_readIDs, orig_seqs):
+        """
+        Write a cluster: orig_readIDs and orig_seqs are iterables of its count reads, streamed into the buffer
+        """
+        self._extend((uniq_readID, '\t', uniq_seq, '\t', str(count), '\t'))
+        self._extend_joined(',', orig_readIDs)
+        self.write('\t')
+        self._extend_joined(',', orig_seqs)
+        self.write('\n')
+
+    def write_record(self, output_format, readID, seq, qual=None):
+        """
+        Write a unique read in output_format [readID, sequence, fasta, fastq]
+        """
+        if output_format == 'fasta':
+            self.write_fasta(readID, seq)
+        elif output_format == 'readID':
+            self.write_readID(readID)
+        elif output_format == 'sequence':
+            self.write_sequence(seq)
+        elif output_format == 'fastq':
+            self.write_fastq(readID, seq, qual)
+        else:
+            raise ValueError(f'[ERROR]: Unknown output_format {output_format}; should be one of [readID, sequence, fasta, fastq]')
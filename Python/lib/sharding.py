@@ -0,0 +1,160 @@
+# Sharded deduplication on multiple cores, partitioning the reads by the bases of an anchor region
+# two reads can only match if their anchors match; reads whose anchor has no N are grouped by the anchor,
+# and the groups are hashed into shards, deduplicated independently by collapseSeq() in a pool of processes
+# reads with Ns in the anchor may match reads of several groups; they are resolved afterwards by a Deduper,
+# seeded with the shard results of the groups they can match, which gives the same unique reads as collapseSeq()
+
+import io
+import sys
+import timeit
+import contextlib
+import multiprocessing
+from array import array
+
+from lib.trie import collapseSeq, expandAmbiguous, Deduper
+
+
+def _collapseShard(args):
+    """
+    Deduplicate the reads of one shard; run in a worker process, with the notes of collapseSeq() muted
+    """
+    seqs, kwargs = args
+    with contextlib.redirect_stderr(io.StringIO()):
+        ans_vec = collapseSeq(seqs, **kwargs)[0]
+    return array('q', ans_vec)
+
+
+def compatibleAnchors(anchor, anchors, ambiguous_symbol='N', bases='ACGT'):
+    """
+    Return the anchors in the set anchors (without N) that anchor (with Ns) matches
+    """
+    num_N = anchor.count(ambiguous_symbol)
+    if len(bases) ** num_N <= len(anchors):   # fill in the Ns
+        return [x for x in expandAmbiguous(anchor, ambiguous_symbol, bases) if x in anchors]
+    return [x for x in anchors if len(x) == len(anchor) and
+            all(a == ambiguous_symbol or a == b for a, b in zip(anchor, x))]
+
+
+def collapseSeqSharded(seqs, allowed_symbols='ACGTN', ambiguous_symbols='N', max_missing=500, should_traceback=False,
+                       engine='node', hash_max_missing=2, num_shards=16, num_workers=4, anchor_start=0, anchor_length=8,
+                       metrics=None):
+    """
+    Removes duplicate sequences like collapseSeq(), with the reads sharded by an anchor region over num_workers processes
+
+    The unique reads are the same as those of collapseSeq(); with should_traceback, a duplicate is mapped to a unique
+    read that it matches, which may not be the one that collapseSeq() finds first.
+    The reads with Ns in the anchor, and all the reads they can match, are resolved in this process,
+    so the anchor should be in a region of the reads with few Ns, e.g. the start.
+
+    Arguments:
+      seqs : the input sequences; any iterable
+      allowed_symbols : the list of allowed symbols, such as bases 'ACGTN'
+      ambiguous_symbols: the list of ambiguous symbols, such as 'N'
+      max_missing : number of ambiguous characters to allow in a unique sequence.
+      should_traceback : should I return mapping_vec instead of uniqIdx_vec?
+      engine : which trie to use in each shard, see collapseSeq()
+      hash_max_missing : for reads with at most this number of Ns, look up unique reads without N by hash instead of the trie
+      num_shards : number of shards, each deduplicated by one task of the pool
+      num_workers : number of worker processes
+      anchor_start : the start of the anchor region in each read (0-based)
+      anchor_length : the length of the anchor region; reads shorter than its end are anchored by what they have of it
+      metrics : lib.metrics.DedupMetrics object to record the phases shard, shard_dedup and merge
+
+    Returns:
+      uniqIdx_vec, time cost
+      (or mapping_vec, time cost if should_traceback=True)
+          mapping_vec[i] = -1 if seqs[i] is discarded
+          mapping_vec[i] = j  if seqs[i] is duplicates of j (j=i means uniq)
+    """
+    start_time = timeit.default_timer()
+    if metrics is not None:
+        metrics.restart()
+    ambiguous_symbol = ambiguous_symbols[0]
+    bases = [x for x in allowed_symbols if x not in ambiguous_symbols]
+    anchor_end = anchor_start + anchor_length
+
+    # group the reads by the anchor; those with Ns in the anchor are kept apart
+    seqs_vec = []
+    anchor2idxes = dict()
+    ambiguous_idxes = []   # the reads with Ns in the anchor
+    for idx, seq in enumerate(seqs):
+        for ch in ambiguous_symbols[1:]:   # convert all ambiguous symbols to ambiguous_symbols[0]
+            seq = seq.replace(ch, ambiguous_symbol)
+        seqs_vec.append(seq)
+        anchor = seq[anchor_start:anchor_end]
+        if ambiguous_symbol in anchor:
+            ambiguous_idxes.append(idx)
+        elif anchor in anchor2idxes:
+            anchor2idxes[anchor].append(idx)
+        else:
+            anchor2idxes[anchor] = [idx]
+    print(f"[NOTE] Number of reads (raw) = {len(seqs_vec)}", file=sys.stderr)
+    print(f"[NOTE] Number of reads with {ambiguous_symbol} in the anchor {anchor_start}-{anchor_end} = {len(ambiguous_idxes)}", file=sys.stderr)
+
+    # the groups that the reads with Ns in the anchor can match are resolved again with them
+    merged_anchors = set()
+    for anchor in set(seqs_vec[idx][anchor_start:anchor_end] for idx in ambiguous_idxes):
+        merged_anchors.update(compatibleAnchors(anchor, anchor2idxes, ambiguous_symbol, bases))
+    shard2idxes = [[] for _ in range(num_shards)]
+    for anchor, idxes in anchor2idxes.items():
+        if anchor not in merged_anchors:
+            shard2idxes[hash(anchor) % num_shards].extend(idxes)
+    shard2idxes = [sorted(idxes) for idxes in shard2idxes if len(idxes) > 0]   # keep the order of the input in each shard
+    # the groups to merge are deduplicated with traceback in a shard of their own, to seed the Deduper
+    merged_idxes = sorted(idx for anchor in merged_anchors for idx in anchor2idxes[anchor])
+    if metrics is not None:
+        metrics.mark('shard', len(seqs_vec))
+        metrics.count('num_reads', len(seqs_vec))
+        metrics.count('num_anchor_N', len(ambiguous_idxes))
+
+    # deduplicate each shard
+    kwargs = {'allowed_symbols': allowed_symbols, 'ambiguous_symbols': ambiguous_symbol, 'max_missing': max_missing,
+              'engine': engine, 'hash_max_missing': hash_max_missing, 'should_traceback': should_traceback}
+    tasks = [([seqs_vec[idx] for idx in idxes], kwargs) for idxes in shard2idxes]
+    if len(merged_idxes) > 0:
+        shard2idxes.append(merged_idxes)
+        tasks.append(([seqs_vec[idx] for idx in merged_idxes], dict(kwargs, should_traceback=True)))
+    if num_workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(num_workers, len(tasks))) as pool:
+            shard_ans = pool.map(_collapseShard, tasks, chunksize=1)
+    else:
+        shard_ans = [_collapseShard(task) for task in tasks]
+    mapping_vec = array('q', [-1]) * len(seqs_vec) if should_traceback else None
+    uniqIdx_vec = []
+    merged_mapping = []
+    for idxes, ans_vec in zip(shard2idxes, shard_ans):
+        if idxes is merged_idxes:
+            merged_mapping = [merged_idxes[matchedIdx] if matchedIdx >= 0 else -1 for matchedIdx in ans_vec]
+        elif should_traceback:
+            for idx, matchedIdx in zip(idxes, ans_vec):
+                mapping_vec[idx] = idxes[matchedIdx] if matchedIdx >= 0 else -1
+        else:
+            uniqIdx_vec.extend(idxes[uniqIdx] for uniqIdx in ans_vec)
+    if metrics is not None:
+        metrics.mark('shard_dedup', len(seqs_vec) - len(ambiguous_idxes))
+
+    # resolve the reads with Ns in the anchor with the reads they can match, in the order of the input
+    if len(ambiguous_idxes) > 0:
+        seeded = dict(zip(merged_idxes, merged_mapping))
+        merged_idxes = sorted(ambiguous_idxes + merged_idxes)
+        idx2pos = {idx: pos for pos, idx in enumerate(merged_idxes)}
+        match_idxes = [idx2pos[seeded[idx]] if seeded.get(idx, -1) >= 0 else None for idx in merged_idxes]
+        deduper = Deduper(allowed_symbols, ambiguous_symbol, max_missing, hash_max_missing)
+        deduper.add_batch([seqs_vec[idx] for idx in merged_idxes], merged_idxes, match_idxes)
+        if should_traceback:
+            for idx, matchedIdx in zip(merged_idxes, deduper.results(should_traceback=True)):
+                mapping_vec[idx] = matchedIdx if matchedIdx is not None else -1
+        else:
+            uniqIdx_vec.extend(deduper.results())
+    if metrics is not None:
+        metrics.mark('merge', len(merged_idxes))
+        metrics.count('num_merged', len(merged_idxes))
+
+    TIMESPENT = timeit.default_timer() - start_time
+    if should_traceback:
+        return mapping_vec, TIMESPENT
+    # the unique reads in the order of (num_N, first occurrence), like collapseSeq()
+    uniqIdx_vec.sort(key=lambda idx: (seqs_vec[idx].count(ambiguous_symbol), idx))
+    if metrics is not None:
+        metrics.count('num_unique', len(uniqIdx_vec))
+    return uniqIdx_vec, TIMESPENT
@@ -0,0 +1,249 @@
+# Simulation of sequencing reads with duplicates and ambiguous bases, for benchmarking
+# @Author : Jianqiao Hu & Adam Yongxin Ye @ BCH
+
+import random
+
+
+def insertN(read, readLen, fctN, regionN=[0, 1]):
+    read = read[:readLen]  # only keep the left readLen part of input reads
+    coord_regionN = [int(readLen * regionN[0]),
+                     int(readLen * regionN[1])]  # the coordinates of the specific region of insertion
+    regionLen = coord_regionN[1] - coord_regionN[0]  # the length of the insertion region
+
+    numberN_float = fctN * regionLen  # number of Ns to be inserted into the region
+    decimal = numberN_float % 1
+    numberN = int(numberN_float)
+    if decimal > 0:
+        dice = random.random()
+        if dice <= decimal:
+            numberN = int(numberN_float) + 1
+    N_positions = random.sample(range(coord_regionN[0], coord_regionN[1]), numberN)
+    for pos in N_positions:
+        read = read[:pos] + 'N' + read[pos + 1:]
+    return read
+
+
+def simulateReads(num_reads, read_length, dup_rate, fctN, regionN=[0, 1], seed=1, bases='ACGT'):
+    """
+    Simulate reads: random unique templates, sampled with replacement up to num_reads, then masked by insertN()
+
+    Arguments:
+      num_reads : number of reads to simulate
+      read_length : length of the reads
+      dup_rate : the expected fraction of reads that are duplicates of a template; num_reads * (1 - dup_rate) templates
+      fctN : the fraction of bases in the N region converted to N, as insertN()
+      regionN : the region [start, end] (from 0~1) of the read where Ns are inserted, as insertN()
+      seed : random seed; the same arguments give the same reads
+
+    Returns:
+      reads, the template index of each read
+    """
+    random.seed(seed)
+    num_templates = max(1, round(num_reads * (1 - dup_rate)))
+    templates = [''.join(random.choices(bases, k=read_length)) for _ in range(num_templates)]
+    template_idxes = list(range(num_templates)) + random.choices(range(num_templates), k=max(0, num_reads - num_templates))
+    random.shuffle(template_idxes)
+    template_idxes = template_idxes[:num_reads]
+    reads = [insertN(templates[idx], read_length, fctN, regionN) for idx in template_idxes]
+    return reads, template_idxes
+
+
+# Vectorized simulation by numpy, streamed in batches, for test sets too large to simulate read by read
+# each read is a row of a uint8 matrix; the records of each batch are laid out in one matrix and written at once
+
+FAMILY_DISTRIBUTIONS = ('fixed', 'poisson', 'geometric')
+N_PROFILES = ('uniform', 'region', 'quality')
+PHRED_OFFSET = 33
+MIN_QUALITY = 2     # the quality of N, as Illumina reports
+MAX_QUALITY = 41
+
+
+def sampleFamilySizes(rng, num_templates, distribution='poisson', mean=2.0):
+    """
+    Sample the number of reads (>= 1) of each template
+
+    Arguments:
+      distribution : 'fixed' (all round(mean)), 'poisson' (1 + Poisson(mean - 1)) or 'geometric' (mean 1 / p)
+      mean : the mean family size, >= 1
+    """
+    if mean < 1:
+        raise ValueError(f'[ERROR]: The mean family size should be >= 1, but got {mean}')
+    if distribution == 'fixed':
+        return rng.integers(round(mean), round(mean) + 1, size=num_templates)
+    elif distribution == 'poisson':
+        return 1 + rng.poisson(mean - 1, size=num_templates)
+    elif distribution == 'geometric':
+        return rng.geometric(1 / mean, size=num_templates)
+    raise ValueError(f'[ERROR]: Unknown family size distribution {distribution}; choose from {FAMILY_DISTRIBUTIONS}')
+
+
+def qualityProfile(np, read_length, profile):
+    """
+    Return the mean quality of each cycle, linearly interpolated from profile, a list of means evenly spaced along the read
+    """
+    profile = np.asarray(profile, dtype=np.float64)
+    if len(profile) == 1:
+        return np.full(read_length, profile[0])
+    return np.interp(np.linspace(0, 1, read_length), np.linspace(0, 1, len(profile)), profile)
+
+
+def insertNRegion(np, rng, codes, fctN, regionN=[0, 1], symbol_N=ord('N')):
+    """
+    Convert bases of each row of codes to N in place, vectorized with the same semantics as insertN():
+    fctN * regionLen Ns at random distinct positions of the region, the fraction being rounded up with its probability
+    """
+    num_reads, read_length = codes.shape
+    start, end = int(read_length * regionN[0]), int(read_length * regionN[1])
+    numberN_float = fctN * (end - start)
+    numberN = np.full(num_reads, int(numberN_float))
+    numberN += rng.random(num_reads) <= numberN_float % 1
+    max_numberN = min(int(numberN.max()), end - start) if num_reads > 0 else 0
+    if max_numberN == 0:
+        return
+    if max_numberN > 16:   # a random permutation of the region of each read; faster than drawing many one by one
+        positions = rng.random((num_reads, end - start), dtype=np.float32).argsort(axis=1)[:, :max_numberN] + start
+    else:   # draw the positions one by one, redrawing those already drawn in the same read
+        positions = np.empty((num_reads, max_numberN), dtype=np.int64)
+        for j in range(max_numberN):
+            drawn = rng.integers(start, end, size=num_reads)
+            redraw = np.flatnonzero((positions[:, :j] == drawn[:, None]).any(axis=1))
+            while len(redraw) > 0:
+                drawn[redraw] = rng.integers(start, end, size=len(redraw))
+                redraw = redraw[(positions[redraw, :j] == drawn[redraw, None]).any(axis=1)]
+            positions[:, j] = drawn
+    rows, cols = np.nonzero(np.arange(max_numberN) < numberN[:, None])
+    codes[rows, positions[rows, cols]] = symbol_N
+
+
+def simulateReadBatches(num_reads, read_length, family='poisson', family_mean=2.0, n_profile='region',
+                        fctN=0.01, regionN=[0, 1], quality_profile=[36, 20], quality_sd=8.0,
+                        seed=1, bases='ACGT', batch_size=1 << 16):
+    """
+    Simulate reads in batches, vectorized by numpy: random templates, each duplicated by a sampled family size, with Ns
+
+    The reads of each batch are shuffled; the families of different batches do not mix, which dedup does not depend on.
+
+    Arguments:
+      num_reads : number of reads to simulate; the last family is truncated to it
+      read_length : length of the reads
+      family, family_mean : the distribution of family sizes, see sampleFamilySizes()
+      n_profile : how to insert Ns
+                  'uniform' : fctN of the bases of the whole read, as insertN()
+                  'region' : fctN of the bases of regionN, as insertN()
+                  'quality' : sample the quality of each base from Normal(mean of its cycle, quality_sd), clipped to
+                              [MIN_QUALITY, MAX_QUALITY]; the bases at MIN_QUALITY are N
+      fctN, regionN : for 'uniform' and 'region'
+      quality_profile : for 'quality', the mean qualities evenly spaced along the read, linearly interpolated to each cycle
+      quality_sd : for 'quality', the standard deviation of qualities around the mean of the cycle
+      seed : random seed; the same arguments give the same reads
+      batch_size : approximate number of reads of each batch
+
+    Returns:
+      a generator of (read_ids, template_ids, codes, qualities) of each batch;
+      codes and qualities are uint8 matrices of ASCII, a row per read; qualities is None unless n_profile='quality'
+    """
+    import numpy as np
+
+    if n_profile not in N_PROFILES:
+        raise ValueError(f'[ERROR]: Unknown N profile {n_profile}; choose from {N_PROFILES}')
+    if n_profile == 'uniform':
+        regionN = [0, 1]
+    rng = np.random.default_rng(seed)
+    base_codes = np.frombuffer(bases.encode('latin-1'), dtype=np.uint8)
+    mean_quality = qualityProfile(np, read_length, quality_profile) if n_profile == 'quality' else None
+    templates_per_batch = max(1, int(batch_size / max(family_mean, 1)))
+    num_done = 0
+    num_templates_done = 0
+    while num_done < num_reads:
+        sizes = sampleFamilySizes(rng, templates_per_batch, family, family_mean)
+        ends = np.cumsum(sizes)
+        num_templates = min(len(sizes), int(np.searchsorted(ends, num_reads - num_done)) + 1)
+        sizes = sizes[:num_templates]
+        sizes[-1] -= max(0, int(ends[num_templates - 1]) - (num_reads - num_done))
+        template_codes = base_codes[rng.integers(0, len(base_codes), size=(num_templates, read_length))]
+        template_ids = np.repeat(np.arange(num_templates_done, num_templates_done + num_templates), sizes)
+        order = rng.permutation(len(template_ids))
+        template_ids = template_ids[order]
+        codes = template_codes[template_ids - num_templates_done]
+        qualities = None
+        if n_profile == 'quality':
+            qualities = np.rint(mean_quality + quality_sd * rng.standard_normal(codes.shape, dtype=np.float32))
+            qualities = np.clip(qualities, MIN_QUALITY, MAX_QUALITY).astype(np.uint8)
+            codes[qualities == MIN_QUALITY] = ord('N')
+            qualities += PHRED_OFFSET
+        else:
+            insertNRegion(np, rng, codes, fctN, regionN)
+        read_ids = np.arange(num_done, num_done + len(template_ids))
+        yield read_ids, template_ids, codes, qualities
+        num_done += len(template_ids)
+        num_templates_done += num_templates
+
+
+def _digits(np, values, width):
+    """
+    Return a uint8 matrix of the zero-padded decimal ASCII digits of values, a row per value
+    """
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    return (values[:, None] // powers % 10 + ord('0')).astype(np.uint8)
+
+
+def _layoutRecords(np, fields, num_rows):
+    """
+    Lay out the records of a batch in one uint8 matrix; fields are bytes (the same in all rows) or uint8 matrices
+    """
+    widths = [len(field) if isinstance(field, bytes) else field.shape[1] for field in fields]
+    records = np.empty((num_rows, sum(widths)), dtype=np.uint8)
+    offset = 0
+    for field, width in zip(fields, widths):
+        records[:, offset:offset + width] = np.frombuffer(field, dtype=np.uint8) if isinstance(field, bytes) else field
+        offset += width
+    return records
+
+
+def writeSimulatedReads(output_path, truth_path=None, num_reads=10000, read_length=200, output_format=None,
+                        read_prefix='read', **kwargs):
+    """
+    Simulate reads by simulateReadBatches(), and stream them to output_path, with the ground truth to truth_path
+
+    Arguments:
+      output_path : the path to the output fasta or fastq file; compressed by gzip if it ends with .gz
+      truth_path : the path to the ground truth tsv file (readID, templateID), a line per read; None to skip it;
+                   compressed by gzip if it ends with .gz
+      output_format : 'fasta' or 'fastq'; None to determine it by the extension of output_path
+      read_prefix : the readIDs are read_prefix followed by the zero-padded index of the read
+      kwargs : the other arguments of simulateReadBatches()
+
+    Returns:
+      number of reads, number of templates
+    """
+    import gzip
+    import numpy as np
+
+    if output_format is None:
+        stripped = output_path[:-3] if output_path.endswith('.gz') else output_path
+        output_format = 'fastq' if stripped.endswith(('.fastq', '.fq')) else 'fasta'
+    id_width = len(str(max(num_reads - 1, 0)))
+    read_prefix = read_prefix.encode()
+    open_binary = lambda path: gzip.open(path, 'wb', compresslevel=1) if path.endswith('.gz') else open(path, 'wb')
+    outfile = open_binary(output_path)
+    truthfile = open_binary(truth_path) if truth_path is not None else None
+    num_templates = 0
+    try:
+        for read_ids, template_ids, codes, qualities in simulateReadBatches(num_reads, read_length, **kwargs):
+            names = _digits(np, read_ids, id_width)
+            if output_format == 'fastq':
+                if qualities is None:
+                    qualities = np.where(codes == ord('N'), MIN_QUALITY, MAX_QUALITY).astype(np.uint8) + PHRED_OFFSET
+                fields = [b'@' + read_prefix, names, b'\n', codes, b'\n+\n', qualities, b'\n']
+            else:
+                fields = [b'>' + read_prefix, names, b'\n', codes, b'\n']
+            outfile.write(_layoutRecords(np, fields, len(read_ids)).tobytes())
+            if truthfile is not None:   # templateIDs are padded to the same width as readIDs
+                fields = [read_prefix, names, b'\t', _digits(np, template_ids, id_width), b'\n']
+                truthfile.write(_layoutRecords(np, fields, len(read_ids)).tobytes())
+            num_templates = int(template_ids.max()) + 1
+    finally:
+        outfile.close()
+        if truthfile is not None:
+            truthfile.close()
+    return num_reads, num_templates
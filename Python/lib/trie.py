@@ -1,25 +1,48 @@
 # Custom class of the trie (prefix tree) node: TrieNode
-# the recursive algorithm for checking if a query sequence exists in the input trie
+# the depth-first algorithm for checking if a query sequence exists in the input trie
 # @Author : Jianqiao Hu & Adam Yongxin Ye @ BCH
 
 
 # JH 020322 testing v2 v3 collapseSeq ——> two ways of using list comprehension to drop exact,  filter and sort Ns
 import sys
+import heapq
+import multiprocessing
+from multiprocessing.connection import wait
 
 from lib.restrictedDict import restrictedListDict
+from lib.bitIndex import BitsetIndex
+from lib.linearScan import LinearScanner
+from lib.metrics import markPhase
 from collections.abc import Set
+from array import array
+from itertools import product, chain
 import timeit
 
+
+class SearchBudgetExceeded(RuntimeError):
+    """
+    Raised when a single trie search visits more nodes than its max_visits budget
+    """
+
+    def __init__(self, sequence, visits):
+        super().__init__(f'Search visited more than {visits - 1} nodes for query {sequence}')
+        self.sequence = sequence
+        self.visits = visits
+
+
 class TrieNode(Set):
     """
     Initialize data structure here
+
+    _end is False for a node that ends no sequence; otherwise it is the value of the sequence ending at this node
+    (e.g. the index of the read), or True if the sequence was added without a value
     """
     __slots__ = '_keys', '_child', '_end'
 
     def __init__(self, iterable=()):
         self._keys = []   # bases stored in this node, a list of the keys of dict ._child; keep 'N' at the last element
         self._child = restrictedListDict()   # a dict of TrieNode; values are TrieNode, keys are the bases also stored in _keys
-        self._end = False   # set this flag for the child node of the end base of sequence
+        self._end = False   # set this flag (or the value) for the child node of the end base of sequence
         for element in iterable:
             self.add(element)
 
@@ -32,7 +55,7 @@ class TrieNode(Set):
             if k not in node._keys:
                 return False
             node = node._child[k]
-        return node._end
+        return node._end is not False
 
     def __iter__(self):
         """
@@ -43,7 +66,7 @@ class TrieNode(Set):
         while stack:
             for k, node in stack[-1]:
                 element.append(k)
-                if node._end:
+                if node._end is not False:
                     yield ''.join(element)
                 stack.append(iter(node._child.items()))
                 break
@@ -57,9 +80,27 @@ class TrieNode(Set):
         """
         return sum(1 for _ in self)
 
-    def add(self, sequence):
+    def memory_footprint(self, sample_size=1024):
         """
-        Add a sequence from this node
+        Return (number of nodes, estimated bytes per node) of the trie from this node;
+        bytes per node is the mean shallow size of the first sample_size nodes, with their _keys and _child
+        """
+        num_nodes = 0
+        sample_bytes = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if num_nodes < sample_size:
+                sample_bytes += (sys.getsizeof(node) + sys.getsizeof(node._keys)
+                                 + sys.getsizeof(node._child) + sys.getsizeof(node._child.storage))
+            num_nodes += 1
+            stack.extend(node._child[k] for k in node._keys)
+        return num_nodes, sample_bytes / min(num_nodes, sample_size)
+
+    def add(self, sequence, value=None):
+        """
+        Add a sequence from this node, optionally with a value, e.g. the index of the read;
+        a sequence already added keeps its value unless a new one is given
         """
         node = self
         for base in sequence:
@@ -72,106 +113,915 @@ class TrieNode(Set):
                 #
                 node._child[base] = TrieNode()
             node = node._child[base]
-        node._end = True
+        if value is not None:
+            node._end = value
+        elif node._end is False:
+            node._end = True
 
-    def search(self, sequence, i=0):
+    def get(self, sequence, default=None):
         """
-        Search for any match of sequence[i:] starting at node self
+        Return the value of the sequence (exact match), or default if the sequence is not from this node or has no value
         """
-        # Assume sequence[:i] has already matched, search for sequence[i:] starting at node self
-        if i == len(sequence):
-            if self._end:
-                return True
-        else:
-            for base in self._keys:
-                if sequence[i] == base or sequence[i] == 'N' or base == 'N':
-                    if self._child[base].search(sequence, i + 1):
-                        return True
-        return False
+        node = self
+        for k in sequence:
+            if k not in node._keys:
+                return default
+            node = node._child[k]
+        return default if node._end is False or node._end is True else node._end
+
+    def _search_path(self, sequence, i=0, max_visits=None, counters=None):
+        """
+        Depth-first search for any match of sequence[i:] starting at node self, using an explicit stack
 
-    def search_with_traceback(self, sequence, i=0):
+        Return (the list of matched bases (the first i elements are left empty), the end node of the match), or None
+        If counters (lib.metrics.SearchCounters) is given, fill in the cost of this search
+        """
+        # Every node sits at a unique depth of the trie, so each (node, position) pair is visited at most once per query
+        seq_len = len(sequence)
+        path = [''] * seq_len
+        stack = [(self, i, '')]   # (node, position in sequence, base leading to node)
+        visits = 0
+        should_count = counters is not None
+        branches = backtracks = max_depth = 0
+        try:
+            while stack:
+                node, depth, base = stack.pop()
+                visits += 1
+                if max_visits is not None and visits > max_visits:
+                    raise SearchBudgetExceeded(sequence, visits)
+                if depth > i:
+                    path[depth - 1] = base
+                if should_count:
+                    num_pushed = len(stack)
+                    max_depth = max(max_depth, depth)
+                if depth == seq_len:
+                    if node._end is not False:
+                        return path, node
+                    if should_count:
+                        backtracks += 1
+                    continue
+                query_base = sequence[depth]
+                if query_base == 'N':   # try every child; push in reverse to keep the order of _keys
+                    for base in reversed(node._keys):
+                        stack.append((node._child[base], depth + 1, base))
+                else:   # try the exact base first, then 'N' which is always the last element of _keys
+                    if node._keys and node._keys[-1] == 'N':
+                        stack.append((node._child['N'], depth + 1, 'N'))
+                    if query_base in node._keys:
+                        stack.append((node._child[query_base], depth + 1, query_base))
+                if should_count:
+                    num_pushed = len(stack) - num_pushed
+                    if num_pushed == 0:
+                        backtracks += 1
+                    else:
+                        branches += num_pushed - 1
+            return None
+        finally:
+            if should_count:
+                counters.set(visits, branches, backtracks, max_depth - i)
+
+    def search(self, sequence, i=0, max_visits=None, counters=None):
         """
         Search for any match of sequence[i:] starting at node self
+
+        Raise SearchBudgetExceeded if more than max_visits nodes are visited
+        """
+        return self._search_path(sequence, i, max_visits, counters) is not None
+
+    def search_with_traceback(self, sequence, i=0, max_visits=None, counters=None):
+        """
+        Search for any match of sequence[i:] starting at node self; return the matched sequence[i:], or None
+
+        Raise SearchBudgetExceeded if more than max_visits nodes are visited
+        """
+        found = self._search_path(sequence, i, max_visits, counters)
+        if found is None:
+            return None
+        return ''.join(found[0])
+
+    def search_value(self, sequence, i=0, max_visits=None, counters=None):
+        """
+        Search for any match of sequence[i:] starting at node self; return the value of the matched sequence, or None
+        (also if it was added without a value); the matched sequence is not built
+
+        Raise SearchBudgetExceeded if more than max_visits nodes are visited
+        """
+        found = self._search_path(sequence, i, max_visits, counters)
+        if found is None or found[1]._end is True:
+            return None
+        return found[1]._end
+
+    def search_order_key(self, sequence, match):
+        """
+        Return the sort key of match (a sequence in this trie that matches sequence) in the order that the search
+        of sequence visits the matches, so that the first match found by search_with_traceback() has the min key
+        """
+        key = []
+        node = self
+        for query_base, base in zip(sequence, match):
+            if query_base == 'N':   # the order of _keys
+                key.append(node._keys.index(base))
+            else:   # the exact base, then 'N'
+                key.append(0 if base == query_base else 1)
+            node = node._child[base]
+        return key
+
+
+class FlatTrie(Set):
+    """
+    Array-backed trie: the whole trie is stored in contiguous integer arrays instead of TrieNode objects
+
+    Node 0 is the root. Each symbol owns one column (an array of child node indexes, 0 = no child),
+    and one bit per node in _end flags the end base of a sequence.
+    The ambiguous symbol is always kept in the last column, just like 'N' is kept last in TrieNode._keys.
+    Optionally, each sequence carries a non-negative integer value (e.g. the index of the read) in _value, -1 = no value;
+    _value is only allocated once the first value is added.
+    A FlatTrie loaded read-only by lib.trieIndex.loadIndex() keeps memoryviews of the index file instead of arrays.
+    """
+    __slots__ = '_symbols', '_encoder', '_wild', '_child', '_end', '_value', '_size', '_capacity', '_num_seqs', '_readonly'
+
+    def __init__(self, iterable=(), allowed_symbols='ACGTN', ambiguous_symbol='N', capacity=1024):
+        symbols = []
+        for x in allowed_symbols:
+            if x != ambiguous_symbol and x not in symbols:
+                symbols.append(x)
+        symbols.append(ambiguous_symbol)   # keep the ambiguous symbol at the last column
+        self._symbols = symbols
+        self._encoder = str.maketrans({x: chr(col) for col, x in enumerate(symbols)})
+        self._wild = len(symbols) - 1   # column of the ambiguous symbol
+        capacity = max(capacity, 1)
+        self._child = [array('i', bytes(4 * capacity)) for _ in symbols]
+        self._end = bytearray((capacity >> 3) + 1)
+        self._value = None
+        self._size = 1   # number of used nodes, including the root
+        self._capacity = capacity
+        self._num_seqs = 0
+        self._readonly = False
+        for element in iterable:
+            self.add(element)
+
+    @classmethod
+    def fromBuffers(cls, symbols, child, end, value, size, num_seqs, readonly=False):
+        """
+        Build a FlatTrie on existing buffers, e.g. arrays or memoryviews of a saved index;
+        symbols[-1] is the ambiguous symbol, child[col] is the column of symbols[col], and all buffers hold size nodes
+        """
+        trie = cls.__new__(cls)
+        trie._symbols = list(symbols)
+        trie._encoder = str.maketrans({x: chr(col) for col, x in enumerate(symbols)})
+        trie._wild = len(symbols) - 1
+        trie._child = child
+        trie._end = end
+        trie._value = value
+        trie._size = size
+        trie._capacity = size
+        trie._num_seqs = num_seqs
+        trie._readonly = readonly
+        return trie
+
+    def toBuffers(self):
+        """
+        Return (symbols, child, end, value, size, num_seqs), the arguments of fromBuffers();
+        the buffers may have capacity beyond the size used nodes
+        """
+        return self._symbols, self._child, self._end, self._value, self._size, self._num_seqs
+
+    def _encode(self, sequence):
+        """
+        Convert a sequence to bytes of column indexes
+        """
+        codes = sequence.translate(self._encoder).encode('latin-1')
+        if codes and max(codes) >= len(self._symbols):
+            for x in sequence:
+                if x not in self._symbols:
+                    raise KeyError(f'Key {x} is not allowed')
+        return codes
+
+    def _grow(self):
+        """
+        Double the capacity of all the arrays
+        """
+        extra = max(self._capacity, 1)
+        for child in self._child:
+            child.frombytes(bytes(4 * extra))
+        self._end.extend(bytes((extra >> 3) + 1))
+        if self._value is not None:
+            self._value.extend(array('q', [-1]) * extra)
+        self._capacity += extra
+
+    def _is_end(self, node):
+        return (self._end[node >> 3] >> (node & 7)) & 1
+
+    def __contains__(self, element):
         """
-        # Assume sequence[:i] has already matched, search for sequence[i:] starting at node self
-        if i == len(sequence):
-            if self._end:
-                return ''
+        Check if self contains the element (sequence) as an entire child
+        """
+        return self._find_node(element) >= 0
+
+    def __iter__(self):
+        """
+        Return an iterator of all the sequences in this trie
+        """
+        for element, node in self._iter_nodes():
+            yield element
+
+    def _iter_nodes(self):
+        """
+        Return an iterator of (sequence, end node) of all the sequences in this trie, in column order
+        """
+        stack = [(0, '')]
+        while stack:
+            node, element = stack.pop()
+            if self._is_end(node):
+                yield element, node
+            for col in range(len(self._symbols) - 1, -1, -1):   # push in reverse to visit in column order
+                nxt = self._child[col][node]
+                if nxt != 0:
+                    stack.append((nxt, element + self._symbols[col]))
+
+    def __len__(self):
+        """
+        Return the number of the sequences in this trie
+        """
+        return self._num_seqs
+
+    def memory_footprint(self):
+        """
+        Return (number of nodes, bytes per node): a child index per symbol, an end bit, and a value if any
+        """
+        bytes_per_node = sum(child.itemsize for child in self._child) + 1 / 8
+        if self._value is not None:
+            bytes_per_node += self._value.itemsize
+        return self._size, bytes_per_node
+
+    def add(self, sequence, value=None):
+        """
+        Add a sequence to this trie, optionally with a non-negative integer value
+        """
+        if self._readonly:
+            raise TypeError('This FlatTrie is read-only; load the index with copy=True to add sequences')
+        node = 0
+        for col in self._encode(sequence):
+            nxt = self._child[col][node]
+            if nxt == 0:
+                if self._size == self._capacity:
+                    self._grow()
+                nxt = self._size
+                self._size += 1
+                self._child[col][node] = nxt
+            node = nxt
+        if not self._is_end(node):
+            self._end[node >> 3] |= 1 << (node & 7)
+            self._num_seqs += 1
+        if value is not None:
+            if self._value is None:
+                self._value = array('q', [-1]) * self._capacity
+            self._value[node] = value
+
+    def discard(self, sequence):
+        """
+        Remove a sequence (and its value) from this trie if it is present; its nodes are kept, just no longer an end
+        """
+        if self._readonly:
+            raise TypeError('This FlatTrie is read-only; load the index with copy=True to remove sequences')
+        node = self._find_node(sequence)
+        if node < 0:
+            return
+        self._end[node >> 3] &= ~(1 << (node & 7)) & 0xFF
+        if self._value is not None:
+            self._value[node] = -1
+        self._num_seqs -= 1
+
+    def _find_node(self, sequence):
+        """
+        Return the end node of the entire sequence, or -1 if it is not in this trie
+        """
+        node = 0
+        for col in self._encode(sequence):
+            node = self._child[col][node]
+            if node == 0:
+                return -1
+        return node if self._is_end(node) else -1
+
+    def _node_value(self, node):
+        if self._value is None or self._value[node] < 0:
+            return None
+        return self._value[node]
+
+    def get(self, sequence, default=None):
+        """
+        Return the value of the sequence (exact match), or default if the sequence is not in this trie or has no value
+        """
+        node = self._find_node(sequence)
+        value = self._node_value(node) if node >= 0 else None
+        return default if value is None else value
+
+    def items(self):
+        """
+        Return an iterator of (sequence, value) of all the sequences in this trie; value is None if not given
+        """
+        for element, node in self._iter_nodes():
+            yield element, self._node_value(node)
+
+    def _search_path(self, sequence, max_visits=None, counters=None):
+        """
+        Depth-first search for any match of sequence; return (end node, the matched path as bytes of column indexes), or None
+        If counters (lib.metrics.SearchCounters) is given, fill in the cost of this search
+        """
+        codes = self._encode(sequence)
+        seq_len = len(codes)
+        wild = self._wild
+        child = self._child
+        end = self._end
+        path = bytearray(seq_len)
+        stack = [(0, 0, 0)]   # (node, depth, column leading to node)
+        visits = 0
+        should_count = counters is not None
+        branches = backtracks = max_depth = 0
+        try:
+            while stack:
+                node, depth, col = stack.pop()
+                visits += 1
+                if max_visits is not None and visits > max_visits:
+                    raise SearchBudgetExceeded(sequence, visits)
+                if depth > 0:
+                    path[depth - 1] = col
+                if should_count:
+                    num_pushed = len(stack)
+                    max_depth = max(max_depth, depth)
+                if depth == seq_len:
+                    if (end[node >> 3] >> (node & 7)) & 1:
+                        return node, path
+                    if should_count:
+                        backtracks += 1
+                    continue
+                query_col = codes[depth]
+                if query_col == wild:   # query is ambiguous, try every child; push in reverse to visit in column order
+                    for c in range(wild, -1, -1):
+                        nxt = child[c][node]
+                        if nxt != 0:
+                            stack.append((nxt, depth + 1, c))
+                else:   # try the ambiguous child after the exact base
+                    nxt = child[wild][node]
+                    if nxt != 0:
+                        stack.append((nxt, depth + 1, wild))
+                    nxt = child[query_col][node]
+                    if nxt != 0:
+                        stack.append((nxt, depth + 1, query_col))
+                if should_count:
+                    num_pushed = len(stack) - num_pushed
+                    if num_pushed == 0:
+                        backtracks += 1
+                    else:
+                        branches += num_pushed - 1
+            return None
+        finally:
+            if should_count:
+                counters.set(visits, branches, backtracks, max_depth)
+
+    def search(self, sequence, max_visits=None, counters=None):
+        """
+        Search for any match of sequence in this trie
+
+        Raise SearchBudgetExceeded if more than max_visits nodes are visited
+        """
+        return self._search_path(sequence, max_visits, counters) is not None
+
+    def search_with_traceback(self, sequence, max_visits=None, counters=None):
+        """
+        Search for any match of sequence in this trie; return the matched sequence, or None
+
+        Raise SearchBudgetExceeded if more than max_visits nodes are visited
+        """
+        found = self._search_path(sequence, max_visits, counters)
+        if found is None:
+            return None
+        return ''.join([self._symbols[col] for col in found[1]])
+
+    def search_order_key(self, sequence, match):
+        """
+        Return the sort key of match (a sequence in this trie that matches sequence) in the order that the search
+        of sequence visits the matches, so that the first match found by search_with_traceback() has the min key
+        """
+        wild = self._wild
+        return [col if query_col == wild else int(col != query_col)   # column order, or the exact base then wild
+                for query_col, col in zip(self._encode(sequence), self._encode(match))]
+
+    def search_values(self, sequence):
+        """
+        Return an iterator of the values of all the matches of sequence in this trie, in depth-first order
+        """
+        codes = self._encode(sequence)
+        seq_len = len(codes)
+        wild = self._wild
+        child = self._child
+        end = self._end
+        stack = [(0, 0)]   # (node, depth)
+        while stack:
+            node, depth = stack.pop()
+            if depth == seq_len:
+                if (end[node >> 3] >> (node & 7)) & 1:
+                    yield self._node_value(node)
+                continue
+            query_col = codes[depth]
+            if query_col == wild:
+                for c in range(wild, -1, -1):
+                    nxt = child[c][node]
+                    if nxt != 0:
+                        stack.append((nxt, depth + 1))
+            else:
+                nxt = child[wild][node]
+                if nxt != 0:
+                    stack.append((nxt, depth + 1))
+                nxt = child[query_col][node]
+                if nxt != 0:
+                    stack.append((nxt, depth + 1))
+
+    def search_value(self, sequence, max_visits=None, counters=None):
+        """
+        Search for any match of sequence in this trie; return the value of the matched sequence, or None
+
+        Raise SearchBudgetExceeded if more than max_visits nodes are visited
+        """
+        found = self._search_path(sequence, max_visits, counters)
+        if found is None:
+            return None
+        return self._node_value(found[0])
+
+
+def expandAmbiguous(sequence, ambiguous_symbol='N', bases='ACGT'):
+    """
+    Return an iterator of all the sequences made by replacing each ambiguous symbol in sequence with one of bases
+    """
+    parts = sequence.split(ambiguous_symbol)
+    for fill in product(bases, repeat=len(parts) - 1):
+        yield ''.join([part + base for part, base in zip(parts, fill)]) + parts[-1]
+
+
+def newTrie(engine='node', allowed_symbols='ACGTN', ambiguous_symbol='N'):
+    """
+    Return an empty trie of engine 'node' (TrieNode), 'flat' (FlatTrie), or 'bitset' (lib.bitIndex.BitsetIndex)
+    """
+    restrictedListDict.addAllowedKeys(allowed_symbols)
+    if engine == 'flat':
+        return FlatTrie(allowed_symbols=allowed_symbols, ambiguous_symbol=ambiguous_symbol)
+    elif engine == 'node':
+        return TrieNode()
+    elif engine == 'bitset':
+        return BitsetIndex(allowed_symbols=allowed_symbols, ambiguous_symbol=ambiguous_symbol)
+    raise ValueError(f"[ERROR]: Unknown trie engine {engine}; should be one of [node, flat, bitset]")
+
+
+class BudgetedTrie:
+    """
+    Wrap a trie so that each search visits at most max_visits nodes; a search over budget falls back to a linear scan
+    of all the sequences in the trie (lib.linearScan.LinearScanner), which gives the same result in a time
+    that does not depend on the Ns of the query
+
+    The scanner is built and filled from the trie at the first fallback, and then kept up to date by add().
+    LinearScanner supports at most 7 symbols besides the ambiguous one; with more, a search over budget is
+    done again by the trie without budget, with a warning at the first one.
+    BitsetIndex has no node visits to budget, so its searches never fall back.
+    fell_back tells whether the last search fell back, and scanned how many sequences its linear scan compared.
+    """
+
+    def __init__(self, trie, max_visits, allowed_symbols='ACGTN', ambiguous_symbol='N'):
+        self.trie = trie
+        self.max_visits = max_visits
+        self.fell_back = False
+        self.num_fallbacks = 0
+        self._allowed_symbols = allowed_symbols
+        self._ambiguous_symbol = ambiguous_symbol
+        self._scanner = None   # built at the first fallback
+        self._is_scanner_supported = True
+
+    def add(self, sequence, value=None):
+        self.trie.add(sequence, value)
+        if self._scanner is not None:
+            self._scanner.add(sequence)
+
+    @property
+    def scanned(self):
+        return self._scanner.num_scanned if self.fell_back else 0
+
+    def _fall_back(self):
+        """
+        Return the scanner to search a query over budget, or None if the alphabet is too large for it
+        """
+        if self._scanner is None and self._is_scanner_supported:
+            try:
+                self._scanner = LinearScanner(allowed_symbols=self._allowed_symbols, ambiguous_symbol=self._ambiguous_symbol)
+            except ValueError:   # too many symbols
+                print('[WARNING] The linear scan supports at most 7 symbols besides the ambiguous one; '
+                      'the searches over budget are done by the trie without budget', file=sys.stderr)
+                self._is_scanner_supported = False
+                return None
+            for sequence in self.trie:
+                self._scanner.add(sequence)
+        if self._scanner is None:
+            return None
+        self.fell_back = True
+        self.num_fallbacks += 1
+        return self._scanner
+
+    def search(self, sequence, counters=None):
+        self.fell_back = False
+        try:
+            return self.trie.search(sequence, max_visits=self.max_visits, counters=counters)
+        except SearchBudgetExceeded:
+            scanner = self._fall_back()
+            if scanner is None:
+                return self.trie.search(sequence, counters=counters)
+            return scanner.search(sequence)
+
+    def search_with_traceback(self, sequence, counters=None):
+        """
+        Return the matched sequence; after a fallback, the one that the search of the trie would have found first
+        """
+        self.fell_back = False
+        try:
+            return self.trie.search_with_traceback(sequence, max_visits=self.max_visits, counters=counters)
+        except SearchBudgetExceeded:
+            scanner = self._fall_back()
+            if scanner is None:
+                return self.trie.search_with_traceback(sequence, counters=counters)
+            matches = list(scanner.search_all(sequence))
+            if len(matches) == 0:
+                return None
+            return min(matches, key=lambda match: self.trie.search_order_key(sequence, match))
+
+    def search_value(self, sequence, counters=None):
+        """
+        Return the value of the matched sequence; after a fallback, of the one that the search of the trie would have found first
+        """
+        self.fell_back = False
+        try:
+            return self.trie.search_value(sequence, max_visits=self.max_visits, counters=counters)
+        except SearchBudgetExceeded:
+            scanner = self._fall_back()
+            if scanner is None:
+                return self.trie.search_value(sequence, counters=counters)
+            matches = list(scanner.search_all(sequence))
+            if len(matches) == 0:
+                return None
+            return self.trie.get(min(matches, key=lambda match: self.trie.search_order_key(sequence, match)))
+
+
+def dedupTiers(tiers, trie, allowed_symbols='ACGTN', ambiguous_symbols='N', should_traceback=False, hash_max_missing=2,
+               search_stats=None, max_visits=None, fallback_idxes=None):
+    """
+    Deduplicate unique reads tier by tier of num_N, adding the unique ones to trie
+
+    Arguments:
+      tiers : an iterable of (num_N, iterable of (seq, uniqIdx)), in increasing order of num_N;
+              reads are exactly unique, and have their ambiguous symbols converted to ambiguous_symbols[0]
+      trie : an empty TrieNode, FlatTrie or BitsetIndex
+      should_traceback : should I find which unique read each duplicate matches?
+      hash_max_missing : for reads with at most this number of Ns, look up unique reads without N by hash instead of the trie
+      search_stats : lib.metrics.SearchStats object to record the cost of the search of each read
+      max_visits : the budget of node visits of each search; the reads over budget are searched by a linear scan instead
+                   (see BudgetedTrie), with the same results; None for no budget
+      fallback_idxes : a list to append the uniqIdx of each read searched by the linear scan to
+
+    Returns:
+      an iterator of (uniqIdx, matchedIdx) for each read:
+          matchedIdx = uniqIdx if the read is unique after TrieDedup
+          matchedIdx = the uniqIdx of the matched unique read if should_traceback, otherwise None
+    """
+    # a read can only match a unique read that has Ns, unless they are exactly the same (already dropped before)
+    ambiguous_symbol = ambiguous_symbols[0]
+    bases = [x for x in allowed_symbols if x not in ambiguous_symbols]
+    zeroN_uniq = dict()   # unique reads without N, kept out of the trie while hash lookups are used; values are not used
+    has_N_in_trie = False   # whether any unique read with Ns has been added to the trie
+    # with traceback, each unique read is added to the trie with its uniqIdx as the value
+    counters = search_stats.counters if search_stats is not None else None
+    budgeted = None
+    if max_visits is not None:
+        trie = budgeted = BudgetedTrie(trie, max_visits, allowed_symbols, ambiguous_symbol)
+    should_report = search_stats is not None or budgeted is not None
+
+    def report(num_N, uniqIdx, is_found, num_lookups=0, is_searched=True):
+        is_fallback = is_searched and budgeted is not None and budgeted.fell_back
+        if is_fallback and fallback_idxes is not None:
+            fallback_idxes.append(uniqIdx)
+        if search_stats is not None:
+            search_stats.record(num_N, uniqIdx, is_found, num_lookups, is_searched, is_fallback,
+                                budgeted.scanned if is_fallback else 0)
+
+    for num_N, tier in tiers:
+        # hash lookups give no traceback order compatible with the trie, so only use them without traceback
+        should_use_hash = not should_traceback and num_N <= hash_max_missing
+        if not should_use_hash and len(zeroN_uniq) > 0:   # move the unique reads without N into the trie
+            for seq in zeroN_uniq:
+                trie.add(seq)
+            zeroN_uniq = dict()
+        if num_N == 0 and not has_N_in_trie:
+            # no unique read has Ns yet, so the whole tier is unique; bulk insert it without searching
+            for seq, uniqIdx in tier:
+                if should_use_hash:
+                    zeroN_uniq[seq] = None
+                else:
+                    trie.add(seq, uniqIdx if should_traceback else None)
+                yield uniqIdx, uniqIdx
+            continue
+        if should_traceback:
+            for seq, uniqIdx in tier:
+                matchedIdx = trie.search_value(seq, counters=counters)
+                if should_report:
+                    report(num_N, uniqIdx, matchedIdx is not None)
+                if matchedIdx is None:   # not found, uniq after TrieDedup
+                    trie.add(seq, uniqIdx)
+                    has_N_in_trie = has_N_in_trie or num_N > 0
+                    yield uniqIdx, uniqIdx
+                else:   # seq is duplicates of the unique read matchedIdx
+                    yield uniqIdx, matchedIdx
         else:
-            for base in self._keys:
-                if sequence[i] == base or sequence[i] == 'N' or base == 'N':
-                    ans =  self._child[base].search_with_traceback(sequence, i + 1)
-                    if ans is not None:
-                        return base + ans
-        return None
+            for seq, uniqIdx in tier:
+                if should_use_hash:
+                    # look up every way to fill in the Ns among the unique reads without N, then search those with Ns
+                    num_lookups = 0
+                    if search_stats is None:
+                        is_found = any(x in zeroN_uniq for x in expandAmbiguous(seq, ambiguous_symbol, bases))
+                    else:
+                        is_found = False
+                        for x in expandAmbiguous(seq, ambiguous_symbol, bases):
+                            num_lookups += 1
+                            if x in zeroN_uniq:
+                                is_found = True
+                                break
+                    is_searched = not is_found and has_N_in_trie
+                    if is_searched:
+                        is_found = trie.search(seq, counters=counters)
+                    if should_report:
+                        report(num_N, uniqIdx, is_found, num_lookups, is_searched)
+                else:
+                    is_found = trie.search(seq, counters=counters)
+                    if should_report:
+                        report(num_N, uniqIdx, is_found)
+                if is_found:
+                    yield uniqIdx, None
+                else:  # not found, uniq after TrieDedup
+                    if should_use_hash and num_N == 0:
+                        zeroN_uniq[seq] = None
+                    else:
+                        trie.add(seq)
+                        has_N_in_trie = has_N_in_trie or num_N > 0
+                    yield uniqIdx, uniqIdx
+    for seq in zeroN_uniq:
+        trie.add(seq)
+
+
+class FrozenTrieWorkers:
+    """
+    Worker processes forked with a copy-on-write copy of a trie, to search batches of sequences in it
+
+    Call mark_changed() when the trie is changed; the workers are then forked again before the next search,
+    since adding the new sequences to the copy of every worker would cost num_workers times the adds.
+    While the trie does not change, the same workers serve the searches.
+    Call close() at the end to stop the workers.
+    """
+
+    def __init__(self, trie, num_workers, should_traceback=False):
+        self._trie = trie
+        self._num_workers = num_workers
+        self._should_traceback = should_traceback
+        self.num_forks = 0
+        self._is_changed = True   # is the trie changed since the workers were forked?
+        self._conns = []
+        self._procs = []
+
+    def _fork(self):
+        context = multiprocessing.get_context('fork')
+        self.num_forks += 1
+        for _ in range(self._num_workers):
+            conn, worker_conn = context.Pipe()
+            proc = context.Process(target=FrozenTrieWorkers._serve, args=(worker_conn, self._trie, self._should_traceback),
+                                   daemon=True)
+            proc.start()
+            worker_conn.close()
+            self._conns.append(conn)
+            self._procs.append(proc)
+        self._is_changed = False
+
+    @staticmethod
+    def _serve(conn, trie, should_traceback):
+        """
+        The loop of a worker process: search each batch received, until None is received
+        """
+        while True:
+            batch = conn.recv()
+            if batch is None:
+                break
+            if should_traceback:
+                conn.send([trie.search_value(seq) for seq in batch])
+            else:
+                conn.send([trie.search(seq) for seq in batch])
+        conn.close()
+
+    def mark_changed(self):
+        self._is_changed = True
+
+    def search_batches(self, batches):
+        """
+        Search the batches of sequences in the workers, each worker taking the next batch when done;
+        return the list of the results of each batch, in the order of batches
+        """
+        if self._is_changed:
+            self.close()
+            self._fork()
+        results = [None] * len(batches)
+        conn2batch = dict()
+        next_batch = 0
+        for conn in self._conns[:len(batches)]:
+            conn.send(batches[next_batch])
+            conn2batch[conn] = next_batch
+            next_batch += 1
+        while conn2batch:
+            for conn in wait(list(conn2batch)):
+                results[conn2batch.pop(conn)] = conn.recv()
+                if next_batch < len(batches):
+                    conn.send(batches[next_batch])
+                    conn2batch[conn] = next_batch
+                    next_batch += 1
+        return results
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send(None)
+                conn.close()
+            except OSError:
+                pass
+        for proc in self._procs:
+            proc.join(timeout=1)
+            if proc.is_alive():
+                proc.terminate()
+        self._conns = []
+        self._procs = []
+
+
+def dedupTiersParallel(tiers, trie, engine='node', allowed_symbols='ACGTN', ambiguous_symbols='N', should_traceback=False,
+                       num_workers=2, batch_size=1024, min_parallel_reads=None):
+    """
+    Deduplicate reads bucketed by num_N like dedupTiers(), searching each tier in num_workers processes; same results
+
+    Within a tier, the trie of the unique reads of the previous tiers does not change, so the reads of the tier are
+    searched in it in batches by num_workers worker processes (FrozenTrieWorkers), which share the trie copy-on-write
+    (FlatTrie is the cheapest to share, being a few arrays rather than one object per node). The workers are forked
+    again only for a tier after which the trie changed; tiers with fewer than min_parallel_reads reads are searched
+    in this process, without workers.
+    Then a sequential pass resolves the reads in order against the unique reads of the same tier before them,
+    kept in a small trie of their own; a read that matches one of them is searched again in the whole trie,
+    which then holds exactly the unique reads that the serial search would see, so that the traceback is the same.
+    Hash lookups (see hash_max_missing of dedupTiers()) are not used.
+
+    Arguments:
+      tiers : an iterable of (num_N, an iterable of (seq, uniqIdx)) in increasing order of num_N
+      trie : an empty trie, or one with the unique reads of previous calls
+      engine : the engine of trie, for the tries of the unique reads of each tier, see newTrie()
+      allowed_symbols : the list of allowed symbols, such as bases 'ACGTN'
+      ambiguous_symbols: the list of ambiguous symbols, such as 'N'; seqs should only use the first one
+      should_traceback : should I find the uniqIdx of the matched unique read of each duplicate?
+      num_workers : number of worker processes
+      batch_size : number of reads searched by a worker at a time
+      min_parallel_reads : tiers with fewer reads are searched in this process; default is 2 * batch_size
+
+    Returns:
+      an iterator of (uniqIdx, matchedIdx) for each read, like dedupTiers()
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise ValueError('[ERROR]: parallel deduplication requires the fork start method of multiprocessing')
+    if min_parallel_reads is None:
+        min_parallel_reads = 2 * batch_size
+    ambiguous_symbol = ambiguous_symbols[0]
+    has_N_in_trie = False
+    workers = None
+    try:
+        for num_N, tier in tiers:
+            if num_N == 0 and not has_N_in_trie:
+                # no unique read has Ns yet, so the whole tier is unique; bulk insert it without searching
+                for seq, uniqIdx in tier:
+                    trie.add(seq, uniqIdx if should_traceback else None)
+                    if workers is not None:
+                        workers.mark_changed()
+                    yield uniqIdx, uniqIdx
+                continue
+            tier = list(tier)
+            if num_workers > 1 and len(tier) >= min_parallel_reads:
+                if workers is None:
+                    workers = FrozenTrieWorkers(trie, num_workers, should_traceback)   # forked at the first search
+                batches = [[seq for seq, uniqIdx in tier[start:start + batch_size]] for start in range(0, len(tier), batch_size)]
+                results = chain.from_iterable(workers.search_batches(batches))
+            elif should_traceback:
+                results = [trie.search_value(seq) for seq, uniqIdx in tier]
+            else:
+                results = [trie.search(seq) for seq, uniqIdx in tier]
+            # resolve the reads in order against the unique reads of this tier before them
+            tier_trie = newTrie(engine, allowed_symbols, ambiguous_symbol)
+            num_tier_uniq = 0
+            for (seq, uniqIdx), found in zip(tier, results):
+                if num_tier_uniq > 0 and (should_traceback or not found) and tier_trie.search(seq):
+                    found = trie.search_value(seq) if should_traceback else True
+                if found is None or found is False:   # not found, uniq after TrieDedup
+                    trie.add(seq, uniqIdx if should_traceback else None)
+                    if workers is not None:
+                        workers.mark_changed()
+                    tier_trie.add(seq)
+                    num_tier_uniq += 1
+                    has_N_in_trie = has_N_in_trie or num_N > 0
+                    yield uniqIdx, uniqIdx
+                elif should_traceback:   # seq is duplicates of the unique read found
+                    yield uniqIdx, found
+                else:
+                    yield uniqIdx, None
+    finally:
+        if workers is not None:
+            workers.close()
 
 
 def collapseSeq(seqs, allowed_symbols='ACGTN', ambiguous_symbols='N', is_input_sorted=False, max_missing=500,
-                hp=None, should_just_uniq_sort=False, should_traceback=False):
+                hp=None, should_just_uniq_sort=False, should_traceback=False, engine='node', hash_max_missing=2, num_N_vec=None,
+                metrics=None, search_stats=None, max_visits=None, fallback_idxes=None, num_workers=1):
     """
     Removes duplicate sequences
 
     Arguments:
-      seqs : the input sequences
+      seqs : the input sequences; any iterable, e.g. lib.seqReader.iterSeqs() streaming from a file
       allowed_symbols : the list of allowed symbols, such as bases 'ACGTN'
       ambiguous_symbols: the list of ambiguous symbols, such as 'N'
-      is_input_sorted : is the input seqs already sorted by num_N; if not, I will sort in this function
+      is_input_sorted : is the input seqs already sorted by num_N; kept for compatibility, the unique reads are always bucketed by num_N, which keeps the order of sorted input
       max_missing : number of ambiguous characters to allow in a unique sequence.
-      hp : hyp() object for memory benchmarking.
+      hp : lib.metrics.MemoryTracker (or guppy's hpy()) object for memory benchmarking.
       should_just_uniq_sort : just do uniq of exact matching and sort by number of Ns
       should_traceback : should I return mapping_vec instead of uniqIdx_vec?
+      engine : which trie to use, 'node' for TrieNode, 'flat' for the array-backed FlatTrie, or 'bitset' for BitsetIndex
+      hash_max_missing : for reads with at most this number of Ns, look up unique reads without N by hash instead of the trie
+      num_N_vec : the number of ambiguous symbols in each seq, if already counted, e.g. by the caller while reading input
+      metrics : lib.metrics.DedupMetrics object to record the phases exact_dedup (including the conversion of ambiguous
+                symbols, which is done on the fly), filter_N, then trie_dedup or sort
+      search_stats : lib.metrics.SearchStats object to record the cost of the trie search of each read, by its index in seqs
+      max_visits : the budget of node visits of each trie search; the reads over budget are searched by a linear scan
+                   instead, with the same results; None for no budget
+      fallback_idxes : a list to append the index in seqs of each read searched by the linear scan to
+      num_workers : number of processes to search the trie in, see dedupTiersParallel(); not with search_stats or max_visits
 
     Returns:
       uniqIdx_vec, time cost, [memory usage]
-      (or mapping_vec, time cost, [memory usage] if should_traceback=True)
+      (or mapping_vec as an array('q'), time cost, [memory usage] if should_traceback=True)
           mapping_vec[i] = -1 if seqs[i] is discarded
           mapping_vec[i] = j  if seqs[i] is duplicates of j (j=i means uniq)
     """
+    if num_workers > 1 and (search_stats is not None or max_visits is not None):
+        raise ValueError('[ERROR]: num_workers > 1 does not support search_stats and max_visits')
     start_time = timeit.default_timer()
-    restrictedListDict.addAllowedKeys(allowed_symbols)
-    trie = TrieNode()
+    if metrics is not None:
+        metrics.restart()
+    trie = newTrie(engine, allowed_symbols, ambiguous_symbols[0])
     
     if len(ambiguous_symbols) > 1:  # convert all ambiguous symbols to ambiguous_symbols[0]
         for ch in ambiguous_symbols[1:]:
-            seqs = [seq.replace(ch, ambiguous_symbols[0]) for seq in seqs]
-    print(f"[NOTE] Number of reads (raw) = {len(seqs)}", file=sys.stderr)
+            seqs = (seq.replace(ch, ambiguous_symbols[0]) for seq in seqs)
     
+    # seqs is consumed only once, so it can also be an iterator streaming from the input file
     if should_traceback:
-        mapping_vec = [-1] * len(seqs)
-        uniqIdx2idxes = dict()
+        mapping_vec = array('q')   # the first occurrence of each read, then its unique read
     seq2uniqIdx = dict()
+    tier2seqs = dict()   # counting sort by num_N: unique seqs of each num_N, in the order of their first occurrence
+    num_seqs = 0
     for idx, seq in enumerate(seqs):
+        num_seqs += 1
         uniqIdx = idx
         if seq in seq2uniqIdx:
             uniqIdx = seq2uniqIdx[seq]
         else:
             seq2uniqIdx[seq] = idx
+            num_N = seq.count(ambiguous_symbols[0]) if num_N_vec is None else num_N_vec[idx]
+            if num_N in tier2seqs:
+                tier2seqs[num_N].append(seq)
+            else:
+                tier2seqs[num_N] = [seq]
         if should_traceback:
-            mapping_vec[idx] = uniqIdx
-            if uniqIdx not in uniqIdx2idxes:
-                uniqIdx2idxes[uniqIdx] = []
-            uniqIdx2idxes[uniqIdx].append(idx)
-    unique_seqs = list(seq2uniqIdx.keys())
-    print(f"[NOTE] Number of reads (filtering out exact matches) = {len(unique_seqs)}", file=sys.stderr)
+            mapping_vec.append(uniqIdx)
+    print(f"[NOTE] Number of reads (raw) = {num_seqs}", file=sys.stderr)
+    print(f"[NOTE] Number of reads (filtering out exact matches) = {len(seq2uniqIdx)}", file=sys.stderr)
+    markPhase(hp, 'exact_dedup')
+    if metrics is not None:
+        metrics.mark('exact_dedup', num_seqs)
+        metrics.count('num_reads', num_seqs)
+        metrics.count('num_exact_unique', len(seq2uniqIdx))
 
+    num_Ns = sorted(tier2seqs)   # only a few distinct values, so the tiers are in order of num_N in linear time
     if should_traceback:
-        unique_seqs_filtered = []
-        for idx, seq in enumerate(seqs):
-            uniqIdx = seq2uniqIdx[seq]
-            if idx == uniqIdx:   # unique_seqs
-                if seq.count(ambiguous_symbols[0]) <= max_missing:   # unique_seqs_filtered
-                    unique_seqs_filtered.append(seq)
-                else:
-                    for now_idx in uniqIdx2idxes[uniqIdx]:
-                        mapping_vec[now_idx] = -1   # filtered out due to too many Ns
-    else:
-        unique_seqs_filtered = [u_s for u_s in unique_seqs if u_s.count(ambiguous_symbols[0]) <= max_missing]
-    
-    unique_seqs_Nfiltered_sorted = unique_seqs_filtered
-    if not is_input_sorted:
-        print(f"[NOTE] sorting...",file=sys.stderr)
-        unique_seqs_Nfiltered_sorted.sort(key=lambda x: x.count(ambiguous_symbols[0]))
-    print( f"[NOTE] Number of reads (filtering out exact matches) that have {max_missing} N or less = {len(unique_seqs_Nfiltered_sorted)}", file=sys.stderr)
+        for num_N in num_Ns:
+            if num_N > max_missing:
+                for seq in tier2seqs[num_N]:
+                    mapping_vec[seq2uniqIdx[seq]] = -1   # filtered out due to too many Ns
+    num_Ns = [num_N for num_N in num_Ns if num_N <= max_missing]
+    num_kept = sum(len(tier2seqs[num_N]) for num_N in num_Ns)
+    print( f"[NOTE] Number of reads (filtering out exact matches) that have {max_missing} N or less = {num_kept}", file=sys.stderr)
+    if metrics is not None:
+        metrics.mark('filter_N', len(seq2uniqIdx))
+        metrics.count('num_kept', num_kept)
 
     # TIMESPENT2 = timeit.default_timer() - start_time
     # print(f"[NOTE] collapseSeq_v2 drop, filter, sort {TIMESPENT2}", file=sys.stderr)
@@ -179,29 +1029,41 @@ def collapseSeq(seqs, allowed_symbols='ACGTN', ambiguous_symbols='N', is_input_s
 #    uniq_dict = {}
     uniqIdx_vec = []
     if should_just_uniq_sort:
-        for seq in unique_seqs_Nfiltered_sorted:
-            uniqIdx_vec.append(seq2uniqIdx[seq])
+        for num_N in num_Ns:
+            for seq in tier2seqs[num_N]:
+                uniqIdx_vec.append(seq2uniqIdx[seq])
     else:
-        if should_traceback:
-            for seq in unique_seqs_Nfiltered_sorted:
-                matched_seq = trie.search_with_traceback(seq)
-                if matched_seq is None:   # not found, uniq after TrieDedup
-                    trie.add(seq)
-                else:   # seq is duplicates of matched_seq
-                    uniqIdx = seq2uniqIdx[seq]
-                    for now_idx in uniqIdx2idxes[uniqIdx]:
-                        mapping_vec[now_idx] = seq2uniqIdx[matched_seq]
-#                        uniqIdx2idxes[seq2uniqIdx[matched_seq]].append(now_idx)   # skip this because trie dedup is the last step; otherwise, uncomment this line
+        tiers = ((num_N, ((seq, seq2uniqIdx[seq]) for seq in tier2seqs[num_N])) for num_N in num_Ns)
+        if num_workers > 1:
+            matches = dedupTiersParallel(tiers, trie, engine, allowed_symbols, ambiguous_symbols, should_traceback, num_workers)
         else:
-            for seq in unique_seqs_Nfiltered_sorted:
-                if not trie.search(seq):  # not found, uniq after TrieDedup
-                    trie.add(seq)
-                    uniqIdx_vec.append(seq2uniqIdx[seq])
-#                    uniq_dict[seq] = True
+            matches = dedupTiers(tiers, trie, allowed_symbols, ambiguous_symbols, should_traceback, hash_max_missing,
+                                 search_stats, max_visits, fallback_idxes)
+        for uniqIdx, matchedIdx in matches:
+            if should_traceback:
+                mapping_vec[uniqIdx] = matchedIdx
+            elif matchedIdx == uniqIdx:   # not found, uniq after TrieDedup
+                uniqIdx_vec.append(uniqIdx)
+#                uniq_dict[seq] = True
 
+    if should_traceback:
+        # exact duplicates point to their first occurrence, which now points to its unique read
+        for idx in range(num_seqs):
+            if mapping_vec[idx] >= 0:
+                mapping_vec[idx] = mapping_vec[mapping_vec[idx]]
 #    print(f'uniqIdx_vec[1:5] = {uniqIdx_vec[1:5]}', file=sys.stderr)
     TIMESPENT = timeit.default_timer() - start_time
+    if metrics is not None:
+        metrics.mark('sort' if should_just_uniq_sort else 'trie_dedup', num_kept)
+        if should_traceback:
+            metrics.count('num_unique', sum(1 for idx, uniqIdx in enumerate(mapping_vec) if idx == uniqIdx))
+        else:
+            metrics.count('num_unique', len(uniqIdx_vec))
     if hp:
+        if should_just_uniq_sort:
+            markPhase(hp, 'sort')
+        else:
+            markPhase(hp, 'trie_dedup', trie)
         h = hp.heap()
 #    is_uniq_vec = [0] * len(seqs)
 #    for i in range(len(seqs)):
@@ -217,3 +1079,191 @@ def collapseSeq(seqs, allowed_symbols='ACGTN', ambiguous_symbols='N', is_input_s
         return [uniqIdx_vec, TIMESPENT, h]
     return [uniqIdx_vec, TIMESPENT]
 
+
+class Deduper:
+    """
+    Online deduplication: reads can be added batch by batch in any order of num_N, and results() always gives
+    the same unique reads as collapseSeq() of all the reads added so far
+
+    collapseSeq() processes the exactly unique reads in the order of (num_N, first occurrence), and a read is unique
+    if it matches no unique read before it. A read added later may come before existing unique reads in that order;
+    if it is unique, the unique reads after it that it matches are no longer unique (found by searching the read
+    itself, since matching is symmetric), and the duplicates of those unique reads have to be resolved again.
+    Affected reads are resolved in the same (num_N, first occurrence) order, so each is resolved at most once per batch.
+
+    The unique reads of each num_N are kept in a FlatTrie, with the index of the read as the value;
+    those without N are also kept in a dict, to be looked up by hash like dedupTiers() does.
+    """
+
+    def __init__(self, allowed_symbols='ACGTN', ambiguous_symbols='N', max_missing=500, hash_max_missing=2):
+        self.allowed_symbols = allowed_symbols
+        self.ambiguous_symbols = ambiguous_symbols
+        self.max_missing = max_missing
+        self.hash_max_missing = hash_max_missing
+        self._bases = [x for x in allowed_symbols if x not in ambiguous_symbols]
+        self._ids = []   # the id of each read
+        self._read2uid = array('q')   # the index of the first occurrence of each read, -1 if filtered out
+        self._seq2uid = dict()
+        self._uid2seq = dict()
+        self._uid2num_N = dict()
+        self._uid2match = dict()   # the unique read that each exactly unique read matches (itself if unique)
+        self._dependents = dict()   # the exactly unique reads that match each unique read
+        self._tiers = dict()   # num_N -> FlatTrie of the unique reads
+        self._zeroN_uniq = dict()   # the unique reads without N -> uid
+        self._tier_max_uid = dict()   # num_N -> the max uid ever added to the tier
+        self._num_reads = 0
+
+    def __len__(self):
+        """
+        Return the number of the reads added
+        """
+        return self._num_reads
+
+    def add_batch(self, seqs, ids=None, match_idxes=None):
+        """
+        Add a batch of reads, and update the unique reads
+
+        Arguments:
+          seqs : the sequences of the reads
+          ids : the ids of the reads, e.g. readIDs; default is the index of each read in all the reads added
+          match_idxes : the reads already resolved, e.g. by collapseSeq() of a shard of the reads (see lib.sharding):
+                        the index in this batch of the unique read that each read matches (itself if unique),
+                        or None for the reads to resolve here; the resolved reads must have been resolved
+                        among themselves only, as if the other reads had not been added
+        """
+        if ids is None:
+            ids = range(self._num_reads, self._num_reads + len(seqs))
+        ambiguous_symbol = self.ambiguous_symbols[0]
+        start = self._num_reads
+        dirty = []   # heap of (num_N, uid) to resolve
+        resolved = []   # (uid, uid of the matched unique read) of the reads resolved by the caller
+        for k, (seq, read_id) in enumerate(zip(seqs, ids)):
+            idx = self._num_reads
+            self._num_reads += 1
+            self._ids.append(read_id)
+            for ch in self.ambiguous_symbols[1:]:   # convert all ambiguous symbols to ambiguous_symbols[0]
+                seq = seq.replace(ch, ambiguous_symbol)
+            if seq in self._seq2uid:
+                self._read2uid.append(self._seq2uid[seq])
+                continue
+            num_N = seq.count(ambiguous_symbol)
+            if num_N > self.max_missing:
+                self._seq2uid[seq] = -1   # filtered out due to too many Ns
+                self._read2uid.append(-1)
+                continue
+            self._seq2uid[seq] = idx
+            self._read2uid.append(idx)
+            self._uid2seq[idx] = seq
+            self._uid2num_N[idx] = num_N
+            if match_idxes is None or match_idxes[k] is None:
+                dirty.append((num_N, idx))
+            else:
+                resolved.append((idx, start + match_idxes[k]))
+        for uid, match in resolved:   # the unique reads first, so that their duplicates can depend on them
+            if match == uid:
+                self._add_unique(uid)
+        for uid, match in resolved:
+            if match != uid:
+                self._uid2match[uid] = match
+                self._dependents[match].add(uid)
+        heapq.heapify(dirty)
+        self._resolve(dirty)
+
+    def _add_unique(self, uid):
+        """
+        Record the exactly unique read uid as unique
+        """
+        seq = self._uid2seq[uid]
+        num_N = self._uid2num_N[uid]
+        self._uid2match[uid] = uid
+        self._dependents[uid] = set()
+        if num_N not in self._tiers:
+            self._tiers[num_N] = FlatTrie(allowed_symbols=self.allowed_symbols, ambiguous_symbol=self.ambiguous_symbols[0])
+        self._tiers[num_N].add(seq, uid)
+        self._tier_max_uid[num_N] = max(self._tier_max_uid.get(num_N, -1), uid)
+        if num_N == 0:
+            self._zeroN_uniq[seq] = uid
+
+    def _resolve(self, dirty):
+        """
+        Resolve the exactly unique reads in the heap dirty, and those affected by them, in the order of (num_N, uid)
+        """
+        queued = set(uid for num_N, uid in dirty)
+        while dirty:
+            num_N, uid = heapq.heappop(dirty)
+            queued.discard(uid)
+            seq = self._uid2seq[uid]
+            old_match = self._uid2match.get(uid)
+            match = self._find_match(seq, num_N, uid)
+            if match is None:
+                if old_match == uid:
+                    continue
+                if old_match in self._dependents:   # the unique read it matched may be a duplicate now
+                    self._dependents[old_match].discard(uid)
+                self._add_unique(uid)
+                affected = self._find_covered(seq, num_N, uid)   # unique reads after uid that are duplicates of uid now
+            else:
+                if old_match == match:
+                    continue
+                affected = []
+                if old_match == uid:   # no longer unique; never happens to reads without N
+                    self._tiers[num_N].discard(seq)
+                    affected = self._dependents.pop(uid)
+                elif old_match in self._dependents:
+                    self._dependents[old_match].discard(uid)
+                self._uid2match[uid] = match
+                self._dependents[match].add(uid)
+            for other in affected:
+                if other not in queued:
+                    queued.add(other)
+                    heapq.heappush(dirty, (self._uid2num_N[other], other))
+
+    def _find_match(self, seq, num_N, uid):
+        """
+        Return a unique read before (num_N, uid) that seq matches, or None
+        """
+        if num_N == 0:   # exactly unique reads without N match no other read
+            return None
+        for tier_num_N in sorted(self._tiers):
+            if tier_num_N > num_N:
+                break
+            if tier_num_N == 0 and num_N <= self.hash_max_missing:
+                for candidate in expandAmbiguous(seq, self.ambiguous_symbols[0], self._bases):
+                    if candidate in self._zeroN_uniq:
+                        return self._zeroN_uniq[candidate]
+                continue
+            for value in self._tiers[tier_num_N].search_values(seq):
+                if tier_num_N < num_N or value < uid:
+                    return value
+        return None
+
+    def _find_covered(self, seq, num_N, uid):
+        """
+        Return the unique reads after (num_N, uid) that seq matches
+        """
+        covered = []
+        for tier_num_N in sorted(self._tiers):
+            if tier_num_N < num_N or len(self._tiers[tier_num_N]) == 0:
+                continue
+            if tier_num_N == num_N and self._tier_max_uid[num_N] <= uid:   # no unique read after uid in this tier
+                continue
+            for value in self._tiers[tier_num_N].search_values(seq):
+                if tier_num_N > num_N or value > uid:
+                    covered.append(value)
+        return covered
+
+    def results(self, should_traceback=False):
+        """
+        Return the ids of the unique reads, in the order of (num_N, first occurrence) like collapseSeq();
+        or if should_traceback, the id of the matched unique read of each read in the order of adding, None if filtered out
+        """
+        if should_traceback:
+            mapping = []
+            for uid in self._read2uid:
+                mapping.append(None if uid < 0 else self._ids[self._uid2match[uid]])
+            return mapping
+        uniq_ids = []
+        for num_N in sorted(self._tiers):
+            for uid in sorted(value for seq, value in self._tiers[num_N].items()):
+                uniq_ids.append(self._ids[uid])
+        return uniq_ids
@@ -0,0 +1,110 @@
+# Persistent index of deduplicated reads: a FlatTrie of the unique reads, with the readID of each, saved to a binary file
+# the file is laid out as the FlatTrie arrays, so that it can be memory-mapped and searched without rebuilding the trie
+#
+# layout (little-endian, every section starts at a multiple of 8 bytes):
+#   MAGIC (16 bytes)
+#   header: num_symbols, num_nodes, num_seqs, num_names, names_nbytes (5 int64)
+#   symbols (num_symbols bytes, latin-1; the ambiguous symbol is the last one)
+#   child columns (num_nodes int32 for each symbol)
+#   end bits (num_nodes // 8 + 1 bytes)
+#   values (num_nodes int64; the index of the readID in names, -1 = no value)
+#   names (utf-8, joined by '\n')
+
+import sys
+import mmap
+import struct
+from array import array
+
+from lib.trie import FlatTrie
+
+MAGIC = b'TrieDedupIndex\x00\x01'
+HEADER = struct.Struct('<5q')
+
+
+def _padding(offset):
+    return -offset % 8
+
+
+def saveIndex(index_path, trie, names):
+    """
+    Save a FlatTrie whose values are indexes of names (e.g. the readIDs of the unique reads) to index_path
+    """
+    symbols, child, end, value, num_nodes, num_seqs = trie.toBuffers()
+    if value is None:
+        raise ValueError('[ERROR]: Cannot save an index of a FlatTrie without values')
+    names_bytes = '\n'.join(names).encode('utf-8')
+    symbols = ''.join(symbols).encode('latin-1')
+    sections = [symbols]
+    for column in child:
+        sections.append(_littleEndian(array('i', column[:num_nodes])))
+    sections.append(bytes(end[:(num_nodes >> 3) + 1]))
+    sections.append(_littleEndian(array('q', value[:num_nodes])))
+    sections.append(names_bytes)
+    with open(index_path, 'wb') as outfile:
+        outfile.write(MAGIC)
+        outfile.write(HEADER.pack(len(symbols), num_nodes, num_seqs, len(names), len(names_bytes)))
+        for section in sections:
+            outfile.write(section)
+            outfile.write(bytes(_padding(len(section))))
+
+
+def _littleEndian(values):
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+def loadIndex(index_path, copy=False):
+    """
+    Load an index saved by saveIndex()
+
+    Arguments:
+      index_path : the path to the index file
+      copy : False to memory-map the file and search it read-only, with near-zero startup;
+             True to copy it into a new FlatTrie that more sequences can be added to, e.g. to seed a new dedup
+
+    Returns:
+      trie, names
+    """
+    with open(index_path, 'rb') as infile:
+        buffer = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(buffer)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f'[ERROR]: {index_path} is not a TrieDedup index file')
+    offset = len(MAGIC)
+    num_symbols, num_nodes, num_seqs, num_names, names_nbytes = HEADER.unpack_from(view, offset)
+    offset += HEADER.size
+    symbols = bytes(view[offset:offset + num_symbols]).decode('latin-1')
+    offset += num_symbols + _padding(num_symbols)
+    columns = []
+    for _ in range(num_symbols):
+        columns.append(view[offset:offset + 4 * num_nodes])
+        offset += 4 * num_nodes + _padding(4 * num_nodes)
+    end_nbytes = (num_nodes >> 3) + 1
+    end = view[offset:offset + end_nbytes]
+    offset += end_nbytes + _padding(end_nbytes)
+    value = view[offset:offset + 8 * num_nodes]
+    offset += 8 * num_nodes
+    names = bytes(view[offset:offset + names_nbytes]).decode('utf-8').split('\n') if num_names > 0 else []
+
+    if copy or sys.byteorder != 'little':   # the memory-mapped arrays can only be used as is on little-endian machines
+        child = [_toArray('i', column) for column in columns]
+        trie = FlatTrie.fromBuffers(symbols, child, bytearray(end), _toArray('q', value), num_nodes, num_seqs, readonly=not copy)
+        for column in columns:
+            column.release()
+        end.release()
+        value.release()
+        view.release()
+        buffer.close()
+    else:
+        child = [column.cast('i') for column in columns]
+        trie = FlatTrie.fromBuffers(symbols, child, end, value.cast('q'), num_nodes, num_seqs, readonly=True)
+    return trie, names
+
+
+def _toArray(typecode, view):
+    values = array(typecode)
+    values.frombytes(view)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
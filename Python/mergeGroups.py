@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Merge the deduplication results of several inputs (e.g. lanes), written by TrieDedup.py --output_format groups
+"""
+Usage example:
+python3 TrieDedup.py -i lane1.fq.gz -o groups --output lane1.groups.tsv.gz
+python3 TrieDedup.py -i lane2.fq.gz -o groups --output lane2.groups.tsv.gz
+python3 mergeGroups.py -i lane1.groups.tsv.gz lane2.groups.tsv.gz -o readID >uniq_readIDs.txt
+
+The unique reads are the same as those of TrieDedup.py on the concatenation of the inputs, in the order given;
+only the unique reads of each input are searched again, with the duplicates of those that turn out to be duplicates,
+not all the reads.
+The merged groups file (-o groups) can be merged again with others.
+"""
+import sys
+import argparse
+import timeit
+
+import lib.groups
+import lib.seqWriter
+
+TRIE_ENGINES = {'trie': 'node', 'flattrie': 'flat', 'bitset': 'bitset'}   # function -> engine of lib.groups.mergeGroups
+
+
+def parseArg():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('--verbose', '-v', default=False, action='store_true',
+                        help='Print extra information to the error stream')
+    parser.add_argument('--input', '-i', nargs='+', required=True, type=str,
+                        help='The groups files to merge, in the order of the inputs; compressed by gzip or not')
+    parser.add_argument('--symbols', '-s', dest='symbols', default='ACGTN', type=str,
+                        help='The symbols in the input; should be the same as those of TrieDedup.py; default is ACGTN')
+    parser.add_argument('--ambiguous', '-m', dest='ambiguous', default='N', type=str,
+                        help='The ambiguous symbols; should be the same as those of TrieDedup.py; default is N')
+    parser.add_argument('--function', '-f', default='trie', type=str,
+                        help='The trie to search the unique reads of the inputs again; default is trie [trie, flattrie, bitset]')
+    parser.add_argument('--max_missing', '-N', dest='N', default=500, type=int,
+                        help='The max number of ambiguous symbols of a unique read; should be the same as that of TrieDedup.py; default is 500')
+    parser.add_argument('--output_format', '-o', default='groups', type=str,
+                        help='Output format; default is groups [readID, sequence, fasta, groups]')
+    parser.add_argument('--output', default=None, type=str,
+                        help='The path to the output file instead of STDOUT; compressed by gzip if it ends with .gz')
+    args = parser.parse_args().__dict__
+    return args
+
+
+def main():
+    param_dict = parseArg()
+    output_format = param_dict['output_format']
+    if output_format not in ('readID', 'sequence', 'fasta', 'groups'):
+        raise ValueError(f'[ERROR]: Unknown output_format {output_format}; should be one of [readID, sequence, fasta, groups]')
+    if param_dict['function'] not in TRIE_ENGINES:
+        raise ValueError(f"[ERROR]: Unknown function {param_dict['function']}; should be one of [trie, flattrie, bitset]")
+    start_time = timeit.default_timer()
+    group_lists = [lib.groups.readGroups(input_path) for input_path in param_dict['input']]
+    merged, uniq_groups = lib.groups.mergeGroups(group_lists, allowed_symbols=param_dict['symbols'],
+                                                 ambiguous_symbols=param_dict['ambiguous'], max_missing=param_dict['N'],
+                                                 engine=TRIE_ENGINES[param_dict['function']])
+    time_spent = timeit.default_timer() - start_time
+    with lib.seqWriter.SeqWriter(param_dict['output']) as writer:
+        if output_format == 'groups':
+            lib.groups.writeGroups(writer, merged)
+        else:
+            for i in uniq_groups:   # each unique read is named by the first readID of its sequence
+                seq, match, readIDs = merged[i]
+                writer.write_record(output_format, readIDs[0], seq)
+    if param_dict['verbose']:
+        print(f'[NOTE] Merged {sum(len(groups) for groups in group_lists)} exactly unique sequences of {len(group_lists)} inputs into {len(uniq_groups)} unique reads. Time spent: {time_spent} s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# Simulate a large test set of reads with duplicates and Ns, streamed to a fasta or fastq file, with the ground truth
+"""
+Usage example:
+python3 simulateReads.py -n 50000000 -l 150 --family poisson --family_mean 3 --n_profile quality \
+    --output sim_50M.fq.gz --truth sim_50M.truth.tsv.gz -v
+
+The ground truth tsv has 2 columns: readID and the ID of the template it is simulated from;
+reads of the same template are true duplicates
+"""
+import sys
+import argparse
+import timeit
+
+from lib.simulate import writeSimulatedReads, FAMILY_DISTRIBUTIONS, N_PROFILES
+
+
+def parseArg():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('--verbose', '-v', default=False, action='store_true',
+                        help='Print extra information to the error stream')
+    parser.add_argument('--output', '-o', type=str, required=True,
+                        help='The path to the output file; fastq if it ends with .fastq or .fq, otherwise fasta; compressed by gzip if it ends with .gz')
+    parser.add_argument('--truth', default=None, type=str,
+                        help='The path to the ground truth tsv file of readID and templateID; compressed by gzip if it ends with .gz')
+    parser.add_argument('--num_reads', '-n', default=10000, type=int, help='Number of reads; default is 10000')
+    parser.add_argument('--read_length', '-l', default=200, type=int, help='Length of reads; default is 200')
+    parser.add_argument('--family', default='poisson', type=str,
+                        help=f'The distribution of the number of reads of each template {list(FAMILY_DISTRIBUTIONS)}; default is poisson')
+    parser.add_argument('--family_mean', default=2.0, type=float, help='The mean number of reads of each template; default is 2')
+    parser.add_argument('--n_profile', default='region', type=str,
+                        help=f'How to insert Ns {list(N_PROFILES)}; default is region')
+    parser.add_argument('--fctN', default=0.01, type=float,
+                        help='For uniform and region N profiles, the fraction of bases in the N region converted to N; default is 0.01')
+    parser.add_argument('--regionN', default='0-1', type=str,
+                        help='For region N profile, the region where Ns are inserted, as start-end (from 0~1); default is 0-1')
+    parser.add_argument('--quality_profile', default='36,20', type=str,
+                        help='For quality N profile, comma-separated mean qualities evenly spaced along the read, linearly interpolated to each cycle; bases sampled to quality 2 are N; default is 36,20')
+    parser.add_argument('--quality_sd', default=8.0, type=float,
+                        help='For quality N profile, the standard deviation of qualities; default is 8')
+    parser.add_argument('--seed', default=1, type=int, help='Random seed; default is 1')
+    parser.add_argument('--batch_size', default=1 << 16, type=int, help='Number of reads simulated at once; default is 65536')
+    args = parser.parse_args().__dict__
+    return args
+
+
+def main():
+    param_dict = parseArg()
+    start_time = timeit.default_timer()
+    num_reads, num_templates = writeSimulatedReads(
+        param_dict['output'], param_dict['truth'], param_dict['num_reads'], param_dict['read_length'],
+        family=param_dict['family'], family_mean=param_dict['family_mean'], n_profile=param_dict['n_profile'],
+        fctN=param_dict['fctN'], regionN=[float(x) for x in param_dict['regionN'].split('-')],
+        quality_profile=[float(x) for x in param_dict['quality_profile'].split(',')], quality_sd=param_dict['quality_sd'],
+        seed=param_dict['seed'], batch_size=param_dict['batch_size'])
+    if param_dict['verbose']:
+        print(f'[NOTE] Simulated {num_reads} reads of {num_templates} templates in {timeit.default_timer() - start_time:.3f} s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 
-import sys, os, os.path, subprocess, time
+import sys, os, os.path, subprocess, time, tempfile, shutil
 
 
 ### flushing print, reference: https://mail.python.org/pipermail/python-list/2015-November/698426.html
@@ -120,7 +120,8 @@ def check_file_then_exec_command(filenames, command, should_time=False, error_st
 	
 	if not not_run:
 #		returnValue = os.system('/bin/bash -c ' + command)
-		returnValue = subprocess.call(['/bin/bash', '-c', command])
+		# pipefail, so that a failed command piped into gzip is not hidden behind the return value of gzip
+		returnValue = subprocess.call(['/bin/bash', '-o', 'pipefail', '-c', command])
 		if returnValue != 0:
 			if error_stop:
 				_print('Error: when exec last command, return value = {}'.format(returnValue), file=sys.stderr)
@@ -176,9 +177,9 @@ Usage: python this.py <implementation> <subcommand> <input>
 
 <implementation>\t one of 'cpp', 'java' or 'python'
 <subcommand>    \t one of 'sortuniq', 'trie' or 'pairwise'
-<input>         \t input *.fasta, *.fa, *.fastq or *.fq file
+<input>         \t input *.fasta, *.fa, *.fastq or *.fq file, optionally compressed as *.gz (gzip or bgzip)
 [output_format] \t one of 'fasta', 'readID', 'sequence', 'dup2uniq', or 'uniq2dup' (default: fasta)
-[output]        \t output filename (default: empty = STDOUT)
+[output]        \t output filename (default: empty = STDOUT); compressed by gzip if it ends with .gz
 [max_missing]   \t max allowed ambiguous Ns per read (default: 9999)
 [sorted]        \t is the input file has already been sorted by the number of Ns (default: False)
 '''
@@ -243,33 +244,69 @@ my_script_dir = os.path.dirname(my_script_path)
 start_time = time.time()
 _print('[PYTHON-START] ' + time.ctime(), file=sys.stderr)
 
-if implementation.lower() == 'python':
-	script_path = os.path.join(my_script_dir, 'Python', 'TrieDedup.py')
-	command = f'python {script_path} --function {subcommand} --max_missing {max_missing} --output_format {output_format}'
-	if is_input_sorted:
-		command += ' --sorted'
-	command += f' --input {input_filename} >{output_filename}'
-	check_file_then_exec_command([output_filename], command, True, True, False)
-elif implementation.lower() == 'java':
-	script_path = os.path.join(my_script_dir, 'Java', 'TrieDedup.jar')
-	command = f'java -jar {script_path} {subcommand} -m {max_missing}'
-	if is_input_sorted:
-		command += ' -s'
-	if output_filename != '':
-		command += f' -o {output_filename}'
-	command += f' {input_filename}'
-	check_file_then_exec_command([output_filename], command, True, True, False)
-elif implementation.lower() == 'cpp':
-	script_path = os.path.join(my_script_dir, 'Cpp', 'bin', 'TrieDedup')
-	command = f'{script_path} {subcommand} -m {max_missing} -f {output_format}'
-	if is_input_sorted:
-		command += ' -s'
-	if output_filename != '':
-		command += f' -o {output_filename}'
-	command += f' {input_filename}'
-	check_file_then_exec_command([output_filename], command, True, True, False)
-else:
-	die('Error: unrecognized implementation "{implementation}"' + ", which should be one of 'cpp', 'java' or 'python'" + usage)
+is_input_gzipped = input_filename.endswith(('.gz', '.bgz', '.bgzf'))
+is_output_gzipped = output_filename.endswith('.gz')
+fifo_dir = None
+command_prefix = ''
+command_suffix = ''
+command_input_filename = input_filename
+if is_input_gzipped and implementation.lower() != 'python':
+	# cpp and java cannot read gzip, so decompress in a separate process into a named pipe with the uncompressed extension
+	fifo_dir = tempfile.mkdtemp(prefix='TrieDedupWrapper.')
+	command_input_filename = os.path.join(fifo_dir, os.path.splitext(os.path.basename(input_filename))[0])
+	os.mkfifo(command_input_filename)
+	command_prefix = f'gzip -dc {input_filename} >{command_input_filename} & gz=$!; '
+	# pipefail does not cover the background gzip, so wait for it, and fail if it failed (e.g. a truncated .gz);
+	# if the command failed, gzip may be blocked on the named pipe that was never opened, so kill it first
+	command_suffix = '; rc=$?; if [ $rc -ne 0 ]; then kill $gz 2>/dev/null; wait $gz; exit $rc; fi; wait $gz || exit 1; exit $rc'
+
+try:
+	if implementation.lower() == 'python':
+		script_path = os.path.join(my_script_dir, 'Python', 'TrieDedup.py')
+		command = f'python {script_path} --function {subcommand} --max_missing {max_missing} --output_format {output_format}'
+		if is_input_sorted:
+			command += ' --sorted'
+		if output_filename != '':
+			command += f' --output {output_filename}'
+		command += f' --input {input_filename}'
+		check_file_then_exec_command([output_filename], command, True, True, False)
+	elif implementation.lower() == 'java':
+		script_path = os.path.join(my_script_dir, 'Java', 'TrieDedup.jar')
+		command = f'java -jar {script_path} {subcommand} -m {max_missing}'
+		if is_input_sorted:
+			command += ' -s'
+		if output_filename != '' and not is_output_gzipped:
+			command += f' -o {output_filename}'
+		command += f' {command_input_filename}'
+		if is_output_gzipped:
+			command += f' | gzip -c >{output_filename}'
+		check_file_then_exec_command([output_filename], command_prefix + command + command_suffix, True, True, False)
+	elif implementation.lower() == 'cpp':
+		script_path = os.path.join(my_script_dir, 'Cpp', 'bin', 'TrieDedup')
+		command = f'{script_path} {subcommand} -m {max_missing} -f {output_format}'
+		if is_input_sorted:
+			command += ' -s'
+		if output_filename != '' and not is_output_gzipped:
+			command += f' -o {output_filename}'
+		command += f' {command_input_filename}'
+		if is_output_gzipped:
+			command += f' | gzip -c >{output_filename}'
+		check_file_then_exec_command([output_filename], command_prefix + command + command_suffix, True, True, False)
+	else:
+		die('Error: unrecognized implementation "{implementation}"' + ", which should be one of 'cpp', 'java' or 'python'" + usage)
+except SystemExit:
+	# the output may be truncated if gzip -c or gzip -dc failed
+	if (is_output_gzipped or fifo_dir is not None) and implementation.lower() != 'python' and os.path.exists(output_filename):
+		_print('[PYTHON-REMOVE] ' + output_filename + ' (incomplete)', file=sys.stderr)
+		os.remove(output_filename)   # so that a rerun does not skip the command because of a truncated output
+	raise
+finally:
+	if fifo_dir is not None:
+		try:   # open the named pipe for reading once, so that gzip -dc is not blocked forever if the command did not read it
+			os.close(os.open(command_input_filename, os.O_RDONLY | os.O_NONBLOCK))
+		except OSError:
+			pass
+		shutil.rmtree(fifo_dir)
 
 _print('[PYTHON-END] ' + time.ctime(), file=sys.stderr)
 check_elapsed_time(start_time)